@@ -0,0 +1,307 @@
+# active_view.py
+
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+ACTIVE_STATUSES = ("pending", "accepted", "in_progress")
+BUSY_STATUSES = ("accepted", "in_progress")
+
+# Set ACTIVE_VIEW=0 to turn the listeners off; every read then goes to Firestore.
+ACTIVE_VIEW_ENABLED = os.environ.get("ACTIVE_VIEW", "1") == "1"
+# After a warm start the listeners only cover changes since the snapshot.
+# Their result sets grow with every change, so they are re-attached from
+# the latest read times this often (the view answers None for a moment).
+ACTIVE_VIEW_REBASE_SECONDS = float(os.environ.get("ACTIVE_VIEW_REBASE_SECONDS", 3600))
+
+
+class ActiveDeliveryView:
+    """
+    In-process copy of the active deliveries and courier locations.
+
+    Loaded by two Firestore on_snapshot listeners (deliveries whose status
+    is pending/accepted/in_progress, and all courier_locations) and kept
+    current by their change events. Secondary indexes by createdBy,
+    assignedCourier and status make per-user and per-courier lookups
+    dictionary reads.
+
+    Readers must treat None from get()/for_user() as "ask Firestore": the
+    view is only authoritative once both listeners delivered their first
+    snapshot and are still running.
+
+    Warm start (see fleet_snapshot.py): load_state() fills the view from a
+    snapshot, and start() then listens only to what changed since the
+    snapshot's read times. That means deliveries by timestampUpdated,
+    courier_locations by timestamp, and delivery tombstones for deletes.
+    The first events from those listeners are the catch-up. Deliveries
+    that are no longer active are dropped.
+    """
+
+    def __init__(self):
+        self._deliveries: Dict[str, dict] = {}
+        self._by_created: Dict[str, set] = {}
+        self._by_courier: Dict[str, set] = {}
+        self._by_status: Dict[str, set] = {}
+        self._couriers: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._watches = []
+        self._loaded = {"deliveries": False, "couriers": False}
+        self._last_event = {"deliveries": None, "couriers": None}   # (wall time, read_time)
+        self._since = None          # {"deliveries", "couriers"} read times to resume from
+        self._db = None
+        self._rebase_timer = None
+        self._started_at = None
+        self.startup = {"source": None, "seconds_to_ready": None, "catch_up_events": 0}
+        self.counters = {"hits": 0, "misses": 0, "fallbacks": 0, "events": 0}
+
+    # -- lifecycle -----------------------------------------------------
+
+    def start(self, db) -> None:
+        """Attach the listeners (once per process, after any fork)."""
+        if self._watches:
+            return
+        self._db = db
+        self._started_at = time.time()
+        if self._since is not None:
+            self.startup["source"] = "snapshot"
+            self._attach_since(db, self._since)
+            return
+        self.startup["source"] = "full"
+        active = db.collection("deliveries").where("status", "in", list(ACTIVE_STATUSES))
+        self._watches = [
+            active.on_snapshot(self._on_deliveries),
+            db.collection("courier_locations").on_snapshot(self._on_couriers),
+        ]
+
+    def _attach_since(self, db, since: dict) -> None:
+        from delta_sync import TOMBSTONE_COLLECTION
+
+        self._loaded = {"deliveries": False, "couriers": False, "tombstones": False}
+        self._last_event.setdefault("tombstones", None)
+        deliveries = db.collection("deliveries").where("timestampUpdated", ">=", since["deliveries"])
+        couriers = db.collection("courier_locations").where("timestamp", ">=", since["couriers"])
+        tombstones = db.collection(TOMBSTONE_COLLECTION).where("timestampDeleted", ">=", since["deliveries"])
+        # Attached outside the lock: a listener's first snapshot may arrive
+        # before on_snapshot returns, and the callbacks take the lock
+        watches = [
+            deliveries.on_snapshot(self._on_deliveries),
+            couriers.on_snapshot(self._on_couriers),
+            tombstones.on_snapshot(self._on_tombstones),
+        ]
+        with self._lock:
+            self._watches = watches
+        if ACTIVE_VIEW_REBASE_SECONDS > 0:
+            self._rebase_timer = threading.Timer(ACTIVE_VIEW_REBASE_SECONDS, self._rebase)
+            self._rebase_timer.daemon = True
+            self._rebase_timer.start()
+
+    def _rebase(self) -> None:
+        """Re-attach the since-listeners from the current read times."""
+        # Read times and the watch list together, so no callback lands in between
+        with self._lock:
+            since = self.as_of()
+            old, self._watches = self._watches, []
+            # Not ready (a listener died): the last good read times still hold
+            self._since = since or self._since
+        # Unsubscribing waits for the listener threads, which may be waiting for the lock
+        for watch in old:
+            watch.unsubscribe()
+        self._attach_since(self._db, self._since)
+
+    def stop(self) -> None:
+        if self._rebase_timer is not None:
+            self._rebase_timer.cancel()
+            self._rebase_timer = None
+        for watch in self._watches:
+            watch.unsubscribe()
+        self._watches = []
+
+    @property
+    def ready(self) -> bool:
+        if not self._watches or not all(self._loaded.values()):
+            return False
+        # A watch that died (auth/network error) stops delivering changes
+        return all(getattr(w, "is_active", True) for w in self._watches)
+
+    # -- listener callbacks (run on the Firestore watch thread) ---------
+
+    def _index(self, index: Dict[str, set], key, delivery_id: str, add: bool) -> None:
+        if key is None:
+            return
+        if add:
+            index.setdefault(key, set()).add(delivery_id)
+        else:
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(delivery_id)
+                if not ids:
+                    del index[key]
+
+    def _put(self, delivery_id: str, data: Optional[dict]) -> None:
+        old = self._deliveries.pop(delivery_id, None)
+        if old is not None:
+            self._index(self._by_created, old.get("createdBy"), delivery_id, False)
+            self._index(self._by_courier, old.get("assignedCourier"), delivery_id, False)
+            self._index(self._by_status, old.get("status"), delivery_id, False)
+        if data is not None:
+            self._deliveries[delivery_id] = data
+            self._index(self._by_created, data.get("createdBy"), delivery_id, True)
+            self._index(self._by_courier, data.get("assignedCourier"), delivery_id, True)
+            self._index(self._by_status, data.get("status"), delivery_id, True)
+
+    def _mark(self, name: str, read_time, events: int) -> None:
+        """Listener bookkeeping (caller holds the lock)."""
+        first = not self._loaded[name]
+        self._loaded[name] = True
+        self._last_event[name] = (time.time(), read_time)
+        self.counters["events"] += events
+        if first and self.startup["seconds_to_ready"] is None:
+            self.startup["catch_up_events"] += events
+            if all(self._loaded.values()):
+                self.startup["seconds_to_ready"] = round(time.time() - self._started_at, 3)
+                print(f"[active view] ready in {self.startup['seconds_to_ready']}s "
+                      f"({self.startup['source']}, {self.startup['catch_up_events']} initial events)")
+
+    def _on_deliveries(self, docs, changes, read_time) -> None:
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                # REMOVED also fires when a delivery leaves the query (completed/cancelled);
+                # the since-listener instead sees the change and drops the delivery here
+                data = None if change.type.name == "REMOVED" else doc.to_dict() or {}
+                if data is not None and data.get("status") not in ACTIVE_STATUSES:
+                    data = None
+                self._put(doc.id, data)
+            self._mark("deliveries", read_time, len(changes))
+
+    def _on_couriers(self, docs, changes, read_time) -> None:
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                if change.type.name == "REMOVED":
+                    self._couriers.pop(doc.id, None)
+                else:
+                    self._couriers[doc.id] = doc.to_dict() or {}
+            self._mark("couriers", read_time, len(changes))
+
+    def _on_tombstones(self, docs, changes, read_time) -> None:
+        with self._lock:
+            for change in changes:
+                # REMOVED here is the tombstone being purged, not the delivery
+                if change.type.name != "REMOVED":
+                    self._put(change.document.id, None)
+            self._mark("tombstones", read_time, len(changes))
+
+    # -- snapshots (fleet_snapshot.py) ------------------------------------
+
+    def as_of(self) -> Optional[dict]:
+        """Read times the view is current at, per source (None unless ready)."""
+        if not self.ready:
+            return None
+        events = self._last_event
+        deliveries = [events[n][1] for n in ("deliveries", "tombstones") if events.get(n)]
+        return {"deliveries": min(deliveries), "couriers": events["couriers"][1]}
+
+    def export_state(self) -> Optional[dict]:
+        """Copy of the view for a snapshot, or None if it isn't ready."""
+        with self._lock:
+            since = self.as_of()
+            if since is None:
+                return None
+            # Shallow copies suffice: listeners replace documents, never mutate them
+            return {
+                "since": since,
+                "deliveries": dict(self._deliveries),
+                "couriers": dict(self._couriers),
+            }
+
+    def load_state(self, deliveries: Dict[str, dict], couriers: Dict[str, dict], since: dict) -> None:
+        """Fill the view from a snapshot before start() (which then only catches up)."""
+        with self._lock:
+            self._deliveries.clear()
+            self._by_created.clear()
+            self._by_courier.clear()
+            self._by_status.clear()
+            for delivery_id, data in deliveries.items():
+                self._put(delivery_id, data)
+            self._couriers = dict(couriers)
+            self._since = since
+
+    # -- reads -----------------------------------------------------------
+
+    def get(self, delivery_id: str) -> Optional[dict]:
+        """A copy of an active delivery, or None (not active, or view not ready)."""
+        if not self.ready:
+            self.counters["fallbacks"] += 1
+            return None
+        data = self._deliveries.get(delivery_id)
+        self.counters["hits" if data is not None else "misses"] += 1
+        return dict(data) if data is not None else None
+
+    def for_user(self, uid: str) -> Optional[List[tuple]]:
+        """[(delivery_id, data)] the user created or is assigned to, or None if not ready."""
+        if not self.ready:
+            self.counters["fallbacks"] += 1
+            return None
+        with self._lock:
+            ids = self._by_created.get(uid, set()) | self._by_courier.get(uid, set())
+            result = [(d, dict(self._deliveries[d])) for d in ids]
+        self.counters["hits"] += 1
+        return result
+
+    def with_status(self, status: str) -> Optional[List[str]]:
+        if not self.ready:
+            return None
+        with self._lock:
+            return list(self._by_status.get(status, ()))
+
+    def courier_locations(self) -> Optional[Dict[str, dict]]:
+        if not self.ready:
+            return None
+        with self._lock:
+            return dict(self._couriers)
+
+    def courier_load(self, courier_uid: str) -> int:
+        """Number of accepted/in_progress deliveries assigned to the courier."""
+        with self._lock:
+            ids = self._by_courier.get(courier_uid, ())
+            return sum(1 for d in ids if self._deliveries[d].get("status") in BUSY_STATUSES)
+
+    # -- metrics ----------------------------------------------------------
+
+    def stats(self) -> dict:
+        now = time.time()
+        staleness = {}
+        for name, event in self._last_event.items():
+            # Seconds since the listener last delivered a snapshot. Firestore
+            # sends nothing while the data is unchanged, so a quiet collection
+            # also ages; `ready` is what says whether the view can be trusted.
+            staleness[name] = round(now - event[0], 3) if event else None
+        return {
+            "enabled": ACTIVE_VIEW_ENABLED,
+            "ready": self.ready,
+            "deliveries": len(self._deliveries),
+            "couriers": len(self._couriers),
+            "seconds_since_snapshot": staleness,
+            "startup": self.startup,
+            **self.counters,
+        }
+
+
+active_view = ActiveDeliveryView()
+
+
+def start_active_view(db) -> None:
+    """Start the listeners if enabled; failures leave callers on direct reads."""
+    if not ACTIVE_VIEW_ENABLED:
+        return
+    try:
+        from fleet_snapshot import load_into
+        load_into(active_view)
+    except Exception as e:
+        print(f"[active view] snapshot not loaded, full start: {e}")
+    try:
+        active_view.start(db)
+    except Exception as e:
+        print(f"[active view] listeners not started, using direct reads: {e}")
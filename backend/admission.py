@@ -0,0 +1,280 @@
+# admission.py
+"""
+Admission control for the REST API: load shedding by route class and
+per-user rate limits.
+
+Load shedding (per process, before authentication): every route belongs
+to a class. A class is refused once its own in-flight requests reach its
+cap, or once the process as a whole is busier than the class tolerates.
+Low-priority traffic (location updates, list refreshes) is shed first,
+then ordinary calls, then delivery creation. Status transitions are
+refused only when every slot is taken.
+
+    class      routes                                  cap   shed when total >=
+    critical   updateDelivery, deleteDelivery          100%  100%
+    create     createDelivery(ies), quoteDeliveries     50%   90%
+    normal     everything not listed                    75%   75%
+    low        updateLocation, list/read endpoints      50%   50%
+    (percentages of ADMISSION_MAX_INFLIGHT)
+
+Rate limits (after authentication, see auth.require_token): a token
+bucket per (uid, route), plus optional route-wide buckets, held in
+Redis so every worker shares them. The check is one Lua call that uses
+Redis' clock. If Redis is unreachable or slower than
+FAST_REDIS_TIMEOUT_MS (see redis_client.get_fast_redis), the buckets
+fall back to process memory for ADMISSION_REDIS_BACKOFF_SECONDS (each
+worker then enforces the limit on its own).
+
+Refusals are 429 with Retry-After. Counts per class and route are in
+/internal/metrics under "admission".
+"""
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, jsonify, request
+
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "1") == "1"
+# Requests one process serves at once. gunicorn.conf.py sets it to the
+# worker's thread count (connections under gevent), so shedding starts
+# before every thread is busy; 8 matches its default thread count.
+ADMISSION_MAX_INFLIGHT = int(os.environ.get(
+    "ADMISSION_MAX_INFLIGHT", os.environ.get("GUNICORN_THREADS", 8)))
+ADMISSION_REDIS_BACKOFF_SECONDS = float(os.environ.get("ADMISSION_REDIS_BACKOFF_SECONDS", 30))
+# Retry-After for shed requests is drawn from this range (seconds), so
+# refused clients don't all come back at the same moment
+ADMISSION_SHED_RETRY_AFTER = (1, 3)
+ADMISSION_LOCAL_BUCKETS_MAX = 100_000
+
+# class -> (cap, shed once total in flight reaches), as shares of ADMISSION_MAX_INFLIGHT
+ROUTE_CLASSES = {
+    "critical": (1.0, 1.0),
+    "create": (0.5, 0.9),
+    "normal": (0.75, 0.75),
+    "low": (0.5, 0.5),
+}
+
+# Flask endpoint -> class (anything else is "normal")
+ENDPOINT_CLASSES = {
+    "update_delivery_status": "critical",
+    "delete_delivery": "critical",
+    "create_delivery": "create",
+    "create_deliveries": "create",
+    "quote_deliveries": "create",
+    "update_location": "low",
+    "get_deliveries": "low",
+    "sync_deliveries": "low",
+    "get_delivery": "low",
+    "get_delivery_history": "low",
+    "get_courier_locations": "low",
+    "get_courier_location": "low",
+    "get_stats": "low",
+}
+
+# Never shed or limited: health checks, internal bridges, API docs
+_EXEMPT_PREFIXES = ("internal_", "ws_broadcast", "health", "flasgger", "static", "apispec")
+
+
+def _parse_rates(raw: str) -> dict:
+    """'update_location=1/5,create_delivery=2/10' -> {endpoint: (per second, burst)}."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in raw.split(","))):
+        endpoint, _, spec = item.partition("=")
+        rate, _, burst = spec.partition("/")
+        rates[endpoint.strip()] = (float(rate), float(burst or rate))
+    return rates
+
+
+# Per (uid, route): requests per second and burst. Couriers send a fix every
+# 3-120 s (see location_filter), so 1/s with a burst of 5 only stops abuse.
+USER_RATES = {
+    "update_location": (1.0, 5),
+    "create_delivery": (1.0, 10),
+    "create_deliveries": (0.1, 3),
+    "quote_deliveries": (2.0, 10),
+    "get_deliveries": (2.0, 10),
+    "sync_deliveries": (2.0, 10),
+    "get_courier_locations": (2.0, 10),
+    **_parse_rates(os.environ.get("ADMISSION_USER_RATES", "")),
+}
+DEFAULT_USER_RATE = (10.0, 30)
+# Per route across all users, e.g. "create_deliveries=20/40" (none by default)
+ROUTE_RATES = _parse_rates(os.environ.get("ADMISSION_ROUTE_RATES", ""))
+
+# KEYS: bucket hashes. ARGV: rate per second and burst for each key.
+# Takes one token from every bucket, or none if any is empty; returns
+# 0 when admitted, else the milliseconds until all have a token.
+_TAKE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local wait, tokens = 0, {}
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[2 * i - 1]) / 1000
+  local burst = tonumber(ARGV[2 * i])
+  local b = redis.call('HMGET', key, 'tokens', 'ts')
+  local level = math.min(burst, (tonumber(b[1]) or burst) + (now - (tonumber(b[2]) or now)) * rate)
+  if level < 1 then wait = math.max(wait, math.ceil((1 - level) / rate)) end
+  tokens[i] = level
+end
+if wait > 0 then return wait end
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[2 * i - 1]) / 1000
+  redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+  redis.call('PEXPIRE', key, math.ceil(tonumber(ARGV[2 * i]) / rate) + 1000)
+end
+return 0
+"""
+
+
+class AdmissionController:
+    def __init__(self, max_inflight: int = ADMISSION_MAX_INFLIGHT, redis_client=None):
+        self.max_inflight = max_inflight
+        self._redis = redis_client
+        self._take = None
+        self._redis_down_until = 0.0
+        self._lock = threading.Lock()
+        self._inflight = {name: 0 for name in ROUTE_CLASSES}
+        self._total = 0
+        self._local: "OrderedDict[str, tuple]" = OrderedDict()   # key -> (tokens, ts)
+        self.counters = {"admitted": 0, "shed": {name: 0 for name in ROUTE_CLASSES},
+                         "throttled": {}, "redis_fallbacks": 0}
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            from redis_client import get_fast_redis
+            self._redis = get_fast_redis()
+        return self._redis
+
+    # -- load shedding ----------------------------------------------------
+
+    def route_class(self, endpoint) -> str:
+        if not endpoint or endpoint.startswith(_EXEMPT_PREFIXES) or "." in endpoint:
+            return None
+        return ENDPOINT_CLASSES.get(endpoint, "normal")
+
+    def try_acquire(self, route_class: str) -> bool:
+        cap_share, shed_share = ROUTE_CLASSES[route_class]
+        cap = max(1, int(cap_share * self.max_inflight))
+        with self._lock:
+            if self._inflight[route_class] >= cap or self._total >= shed_share * self.max_inflight:
+                self.counters["shed"][route_class] += 1
+                return False
+            self._inflight[route_class] += 1
+            self._total += 1
+            self.counters["admitted"] += 1
+            return True
+
+    def release(self, route_class: str) -> None:
+        with self._lock:
+            self._inflight[route_class] -= 1
+            self._total -= 1
+
+    # -- rate limits ------------------------------------------------------
+
+    def _buckets(self, uid: str, endpoint: str):
+        buckets = [(f"ratelimit:{endpoint}:{uid}", USER_RATES.get(endpoint, DEFAULT_USER_RATE))]
+        if endpoint in ROUTE_RATES:
+            buckets.append((f"ratelimit:{endpoint}", ROUTE_RATES[endpoint]))
+        return buckets
+
+    def _take_local(self, buckets) -> float:
+        now = time.monotonic()
+        with self._lock:
+            levels, wait = [], 0.0
+            for key, (rate, burst) in buckets:
+                tokens, ts = self._local.get(key, (burst, now))
+                level = min(burst, tokens + (now - ts) * rate)
+                if level < 1:
+                    wait = max(wait, (1 - level) / rate)
+                levels.append(level)
+            if wait:
+                return wait
+            for (key, _), level in zip(buckets, levels):
+                self._local[key] = (level - 1, now)
+                self._local.move_to_end(key)
+            while len(self._local) > ADMISSION_LOCAL_BUCKETS_MAX:
+                self._local.popitem(last=False)
+        return 0.0
+
+    def take(self, uid: str, endpoint: str) -> float:
+        """0 if the request may proceed, else seconds until it would."""
+        buckets = self._buckets(uid, endpoint)
+        if time.time() >= self._redis_down_until:
+            try:
+                if self._take is None:
+                    self._take = self.redis.register_script(_TAKE_LUA)
+                args = [v for _, (rate, burst) in buckets for v in (rate, burst)]
+                return int(self._take(keys=[k for k, _ in buckets], args=args)) / 1000.0
+            except Exception as e:
+                self.counters["redis_fallbacks"] += 1
+                self._redis_down_until = time.time() + ADMISSION_REDIS_BACKOFF_SECONDS
+                print(f"[admission] Redis unavailable, local buckets for "
+                      f"{ADMISSION_REDIS_BACKOFF_SECONDS:.0f}s: {e}")
+        return self._take_local(buckets)
+
+    def limit(self, uid: str, endpoint: str) -> float:
+        """take(), counting refusals per endpoint; shared by Flask and the ASGI routes."""
+        wait = self.take(uid, endpoint)
+        if wait:
+            with self._lock:
+                throttled = self.counters["throttled"]
+                throttled[endpoint] = throttled.get(endpoint, 0) + 1
+        return wait
+
+    def init_app(self, app) -> None:
+        """Shed requests by route class before they reach auth or the view."""
+        if not ADMISSION_ENABLED:
+            return
+
+        @app.before_request
+        def _admit():
+            route_class = self.route_class(request.endpoint)
+            if route_class is None:
+                return None
+            if not self.try_acquire(route_class):
+                return _too_many("Server busy, retry shortly",
+                                 random.uniform(*ADMISSION_SHED_RETRY_AFTER))
+            g.admission_class = route_class
+            return None
+
+        @app.teardown_request
+        def _done(exc=None):
+            route_class = g.pop("admission_class", None)
+            if route_class is not None:
+                self.release(route_class)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "max_inflight": self.max_inflight,
+            "inflight": dict(self._inflight),
+            **self.counters,
+        }
+
+
+admission = AdmissionController()
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+def _too_many(error: str, retry_after: float):
+    resp = jsonify(success=False, error=error)
+    resp.status_code = 429
+    resp.headers["Retry-After"] = retry_after_header(retry_after)
+    return resp
+
+
+def throttle(uid: str):
+    """Rate-limit the current request for `uid`; a 429 response, or None to proceed."""
+    if not ADMISSION_ENABLED or admission.route_class(request.endpoint) is None:
+        return None
+    wait = admission.limit(uid, request.endpoint)
+    if not wait:
+        return None
+    return _too_many("Rate limit exceeded", wait)
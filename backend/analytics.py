@@ -0,0 +1,331 @@
+# analytics.py
+"""
+Fleet KPIs from a columnar copy of the deliveries.
+
+    python analytics.py export                  # incremental, resumable
+    python analytics.py kpis --since 2025-01-01 --until 2025-02-01
+    python analytics.py compact                 # merge small export files
+    GET /internal/analytics/kpis?since=...&until=...
+
+`export` copies deliveries (live and archived) and deletion tombstones to
+Parquet under ANALYTICS_URI, which is a local directory or a
+pyarrow-supported URI such as gs://bucket/analytics. Each collection is
+read in timestampUpdated order, ANALYTICS_CHUNK_ROWS documents at a
+time, with only the fields the KPIs use. Every chunk becomes one file,
+and the (timestamp, id) high-water mark is saved right after it. A run
+therefore only reads what changed since the last one, and an
+interrupted run resumes from its last chunk. Updated deliveries are
+exported again, and readers keep the latest row per id.
+
+KPIs are computed with vectorized pandas operations on those files
+only, so reporting never queries Firestore.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import uuid
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from archive import ARCHIVE_COLLECTION
+from delta_sync import TOMBSTONE_COLLECTION
+from geo import geohash
+
+ANALYTICS_URI = os.environ.get("ANALYTICS_URI", "analytics_data")
+ANALYTICS_CHUNK_ROWS = int(os.environ.get("ANALYTICS_CHUNK_ROWS", 5000))
+# Geohash length of the pickup areas fees are grouped by (5 ~ 5 km cells)
+ANALYTICS_AREA_PRECISION = int(os.environ.get("ANALYTICS_AREA_PRECISION", 5))
+
+_TS = pa.timestamp("us", tz="UTC")
+DELIVERY_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("source", pa.string()),
+    ("status", pa.string()),
+    ("createdBy", pa.string()),
+    ("assignedCourier", pa.string()),
+    ("fee", pa.float64()),
+    ("pickupLat", pa.float64()),
+    ("pickupLng", pa.float64()),
+    ("dropoffLat", pa.float64()),
+    ("dropoffLng", pa.float64()),
+    ("pickupArea", pa.string()),
+    ("timestampCreated", _TS),
+    ("timestampAssigned", _TS),
+    ("timestampPickedUp", _TS),
+    ("timestampDelivered", _TS),
+    ("timestampUpdated", _TS),
+])
+DELETED_SCHEMA = pa.schema([("id", pa.string()), ("timestampDeleted", _TS)])
+
+_DELIVERY_FIELDS = [
+    "status", "createdBy", "assignedCourier", "fee", "pickupLocation", "dropoffLocation",
+    "timestampCreated", "timestampAssigned", "timestampPickedUp", "timestampDelivered",
+    "timestampUpdated",
+]
+
+
+def _ts(value):
+    return value if isinstance(value, dt.datetime) else None
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _delivery_row(snap, source: str) -> dict:
+    d = snap.to_dict() or {}
+    pickup = d.get("pickupLocation") or {}
+    dropoff = d.get("dropoffLocation") or {}
+    lat, lng = _float(pickup.get("lat")), _float(pickup.get("lng"))
+    return {
+        "id": snap.id,
+        "source": source,
+        "status": d.get("status"),
+        "createdBy": d.get("createdBy"),
+        "assignedCourier": d.get("assignedCourier"),
+        "fee": _float(d.get("fee")),
+        "pickupLat": lat,
+        "pickupLng": lng,
+        "dropoffLat": _float(dropoff.get("lat")),
+        "dropoffLng": _float(dropoff.get("lng")),
+        "pickupArea": geohash(lat, lng, ANALYTICS_AREA_PRECISION) if lat is not None and lng is not None else None,
+        **{f: _ts(d.get(f)) for f in ("timestampCreated", "timestampAssigned", "timestampPickedUp",
+                                       "timestampDelivered", "timestampUpdated")},
+    }
+
+
+def _deleted_row(snap, source: str) -> dict:
+    d = snap.to_dict() or {}
+    return {"id": snap.id, "timestampDeleted": _ts(d.get("timestampDeleted"))}
+
+
+# source -> (collection, ordering field, fields read, row builder, schema, dataset)
+SOURCES = {
+    "archive": (ARCHIVE_COLLECTION, "timestampUpdated", _DELIVERY_FIELDS, _delivery_row, DELIVERY_SCHEMA, "deliveries"),
+    "live": ("deliveries", "timestampUpdated", _DELIVERY_FIELDS, _delivery_row, DELIVERY_SCHEMA, "deliveries"),
+    "deleted": (TOMBSTONE_COLLECTION, "timestampDeleted", ["timestampDeleted"], _deleted_row, DELETED_SCHEMA, "deleted"),
+}
+
+
+class ParquetStore:
+    """Parquet files plus the export state, on a local disk or any pyarrow filesystem."""
+
+    def __init__(self, uri: str = ANALYTICS_URI):
+        if "://" in uri:
+            self.fs, self.root = pafs.FileSystem.from_uri(uri)
+        else:
+            self.fs, self.root = pafs.LocalFileSystem(), os.path.abspath(uri)
+        self.fs.create_dir(self.root, recursive=True)
+
+    def _replace(self, path: str, write) -> None:
+        # Write then move, so readers never see a partial file
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        write(tmp)
+        self.fs.move(tmp, path)
+
+    def write(self, dataset: str, name: str, table: pa.Table) -> None:
+        directory = f"{self.root}/{dataset}"
+        self.fs.create_dir(directory, recursive=True)
+        self._replace(f"{directory}/{name}",
+                      lambda p: pq.write_table(table, p, filesystem=self.fs, compression="zstd"))
+
+    def files(self, dataset: str):
+        selector = pafs.FileSelector(f"{self.root}/{dataset}", allow_not_found=True)
+        return sorted(i.path for i in self.fs.get_file_info(selector) if i.path.endswith(".parquet"))
+
+    def read(self, dataset: str, schema: pa.Schema, paths=None) -> pa.Table:
+        paths = self.files(dataset) if paths is None else paths
+        if not paths:
+            return schema.empty_table()
+        return pa.concat_tables(pq.read_table(p, filesystem=self.fs, schema=schema) for p in paths)
+
+    def delete(self, paths) -> None:
+        for path in paths:
+            self.fs.delete_file(path)
+
+    def read_state(self) -> dict:
+        try:
+            with self.fs.open_input_stream(f"{self.root}/_state.json") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def write_state(self, state: dict) -> None:
+        def write(path):
+            with self.fs.open_output_stream(path) as f:
+                f.write(json.dumps(state).encode())
+        self._replace(f"{self.root}/_state.json", write)
+
+
+def _export_source(db, store: ParquetStore, state: dict, source: str, chunk_rows: int) -> int:
+    collection, ts_field, fields, row, schema, dataset = SOURCES[source]
+    exported = 0
+    while True:
+        query = (db.collection(collection).select(fields)
+                 .order_by(ts_field).order_by("__name__").limit(chunk_rows))
+        mark = state.get(source)
+        if mark:
+            # (timestamp, id): documents written in one batch share a timestamp
+            query = query.start_after({ts_field: dt.datetime.fromisoformat(mark["ts"]),
+                                       "__name__": mark["id"]})
+        snaps = list(query.stream())
+        if not snaps:
+            break
+        last_ts = snaps[-1].get(ts_field)
+        store.write(dataset, f"{source}-{int(last_ts.timestamp() * 1e6)}-{uuid.uuid4().hex[:8]}.parquet",
+                    pa.Table.from_pylist([row(s, source) for s in snaps], schema=schema))
+        state[source] = {"ts": last_ts.isoformat(), "id": snaps[-1].id}
+        store.write_state(state)
+        exported += len(snaps)
+        if len(snaps) < chunk_rows:
+            break
+    return exported
+
+
+def export(db, uri: str = ANALYTICS_URI, chunk_rows: int = ANALYTICS_CHUNK_ROWS) -> dict:
+    """Copy everything changed since the last export; returns rows written per source."""
+    store = ParquetStore(uri)
+    state = store.read_state()
+    # Archive first: on the very first run, most history lives there. Later
+    # runs rarely find anything new in it: archiving only moves deliveries
+    # untouched for ARCHIVE_AFTER_DAYS, whose final state the live export
+    # already has (the id is the same, so readers merge the two).
+    return {source: _export_source(db, store, state, source, chunk_rows) for source in SOURCES}
+
+
+def compact(uri: str = ANALYTICS_URI) -> dict:
+    """Rewrite the deliveries files as one, keeping only the latest row per id."""
+    store = ParquetStore(uri)
+    paths = store.files("deliveries")
+    if len(paths) < 2:
+        return {"files": len(paths)}
+    df = _latest(store.read("deliveries", DELIVERY_SCHEMA, paths).to_pandas())
+    store.write("deliveries", f"compacted-{int(dt.datetime.now(dt.timezone.utc).timestamp() * 1e6)}.parquet",
+                pa.Table.from_pandas(df, schema=DELIVERY_SCHEMA, preserve_index=False))
+    store.delete(paths)
+    return {"files": len(paths), "rows": len(df)}
+
+
+def _latest(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values("timestampUpdated", kind="stable").drop_duplicates("id", keep="last")
+
+
+def load_deliveries(uri: str = ANALYTICS_URI) -> pd.DataFrame:
+    """One row per delivery (latest export wins), deleted deliveries dropped."""
+    store = ParquetStore(uri)
+    df = _latest(store.read("deliveries", DELIVERY_SCHEMA).to_pandas())
+    deleted = store.read("deleted", DELETED_SCHEMA).column("id").to_pandas()
+    return df[~df["id"].isin(deleted)].reset_index(drop=True)
+
+
+_loaded = {}   # uri -> (file list, DataFrame)
+
+
+def cached_deliveries(uri: str = ANALYTICS_URI) -> pd.DataFrame:
+    """load_deliveries(), reused until an export or compaction changes the files."""
+    store = ParquetStore(uri)
+    key = (tuple(store.files("deliveries")), tuple(store.files("deleted")))
+    cached = _loaded.get(uri)
+    if cached is None or cached[0] != key:
+        cached = _loaded[uri] = (key, load_deliveries(uri))
+    return cached[1]
+
+
+def _distribution(seconds: pd.Series) -> dict:
+    seconds = seconds.dropna()
+    seconds = seconds[seconds >= 0]
+    if seconds.empty:
+        return {"count": 0, "mean": None, "p50": None, "p90": None}
+    p50, p90 = seconds.quantile([0.5, 0.9])
+    return {"count": int(len(seconds)), "mean": round(float(seconds.mean()), 1),
+            "p50": round(float(p50), 1), "p90": round(float(p90), 1)}
+
+
+def kpis(df: pd.DataFrame, since: Optional[dt.datetime] = None,
+         until: Optional[dt.datetime] = None, top_areas: int = 20) -> dict:
+    """KPIs for deliveries created in [since, until)."""
+    if since is not None:
+        df = df[df["timestampCreated"] >= pd.Timestamp(since)]
+    if until is not None:
+        df = df[df["timestampCreated"] < pd.Timestamp(until)]
+    start = pd.Timestamp(since) if since is not None else df["timestampCreated"].min()
+    end = pd.Timestamp(until) if until is not None else df["timestampUpdated"].max()
+    window = (end - start).total_seconds() if len(df) and pd.notna(start) and pd.notna(end) else 0
+
+    # Utilization: share of the window each courier spent between being
+    # assigned and delivering. Two overlapping deliveries count twice, so
+    # a courier's value is capped at 1.
+    done = df[(df["status"] == "completed") & df["assignedCourier"].notna()]
+    busy = (done["timestampDelivered"] - done["timestampAssigned"]).dt.total_seconds()
+    per_courier = busy.groupby(done["assignedCourier"]).sum()
+    utilization = (per_courier / window).clip(upper=1.0) if window > 0 else per_courier * 0
+
+    billed = df[df["status"] != "cancelled"]
+    areas = (billed[billed["pickupArea"].notna()].groupby("pickupArea")["fee"].agg(["count", "sum", "mean"])
+             .sort_values("sum", ascending=False).head(top_areas))
+
+    return {
+        "window": {"since": start.isoformat() if pd.notna(start) else None,
+                   "until": end.isoformat() if pd.notna(end) else None},
+        "deliveries": int(len(df)),
+        "byStatus": {k: int(v) for k, v in df["status"].value_counts().items()},
+        "timeToAssignmentSeconds": _distribution(
+            (df["timestampAssigned"] - df["timestampCreated"]).dt.total_seconds()),
+        "pickupToDropoffSeconds": _distribution(
+            (df["timestampDelivered"] - df["timestampPickedUp"]).dt.total_seconds()),
+        "courierUtilization": {
+            "couriers": int(len(per_courier)),
+            "mean": round(float(utilization.mean()), 4) if len(utilization) else None,
+            "p90": round(float(utilization.quantile(0.9)), 4) if len(utilization) else None,
+            "deliveriesPerCourier": round(float(done.groupby("assignedCourier").size().mean()), 2)
+            if len(done) else None,
+        },
+        "feesByArea": [
+            {"area": area, "deliveries": int(row["count"]), "total": round(float(row["sum"]), 2),
+             "average": round(float(row["mean"]), 2)}
+            for area, row in areas.iterrows()
+        ],
+        "fees": {"total": round(float(billed["fee"].sum()), 2),
+                 "average": round(float(billed["fee"].mean()), 2) if len(billed) else None},
+    }
+
+
+def parse_date(value: Optional[str]) -> Optional[dt.datetime]:
+    if not value:
+        return None
+    parsed = dt.datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=dt.timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--uri", default=ANALYTICS_URI)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("export", help="copy new/changed deliveries to Parquet")
+    sub.add_parser("compact", help="merge export files, latest row per delivery")
+    k = sub.add_parser("kpis", help="print KPIs computed from the Parquet files")
+    k.add_argument("--since", help="ISO date/time (UTC if no offset)")
+    k.add_argument("--until", help="ISO date/time, exclusive")
+    k.add_argument("--areas", type=int, default=20, help="top pickup areas by fees")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        from firebase_init import db
+        result = export(db, args.uri)
+    elif args.command == "compact":
+        result = compact(args.uri)
+    else:
+        result = kpis(load_deliveries(args.uri), parse_date(args.since), parse_date(args.until), args.areas)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
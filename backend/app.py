@@ -1,94 +1,165 @@
 # app.py
-from math import radians, sin, cos, sqrt, atan2
-from firebase_admin import auth as firebase_auth
+import os
+from functools import wraps
 
+import click
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 
 from models import Order, Carrier, Business
-from auth import require_token
+from auth import require_admin_token, require_token
 
-from firebase_init import db
+from firebase_init import db, firebase_auth
 from google.cloud import firestore
+from google.api_core.exceptions import FailedPrecondition, NotFound
 
-from tasks.delivery_tasks import match_and_assign_courier
+from celery_app import celery
 from websocket_manager import manager
-from flasgger import Swagger
+from pending_index import pending_index
+from location_history import location_history
+from location_filter import location_filter
+from eta import eta_cache, ETA_SPEED_WINDOW_SECONDS
+from pricing import delivery_fee, quote_fees
+from distance import get_distance_provider
+from geo import parse_point
+from concurrency import gather
+from etags import delivery_etag, list_etag, not_modified
+from encoding import encode_response
+from change_feed import change_feed
+from notifications_utils import push_dispatcher, DEVICE_TOKENS_FIELD
+from delta_sync import (
+    TOMBSTONE_COLLECTION, decode_token, encode_token, sync_read_time, token_expired, tombstone,
+)
+from active_view import active_view, start_active_view, ACTIVE_STATUSES
+from expand import parse_expand, related_expander
+import delivery_stats
+from admission import admission
+from profiling import profiler, PROFILE_MAX_SECONDS
+from traffic_capture import traffic_capture
+from archive import (
+    ARCHIVE_AFTER_DAYS, ARCHIVE_COLLECTION, HISTORY_DEFAULT_PAGE, HISTORY_MAX_PAGE,
+    archive_finished, history_page,
+)
 import uuid, decimal, datetime as dt
 
 app = Flask(__name__)
 app.config["SWAGGER"] = {"uiversion": 3}  # UI only
 
-swagger = Swagger(
-    app,
-    config={
-        "headers": [],
-        "openapi": "3.0.0",
-        "specs": [
-            {
-                "endpoint": "apispec_1",
-                "route": "/apispec_1.json",
-                "rule_filter": lambda rule: True,   # include all routes
-                "model_filter": lambda tag: True,   # include all models
-            }
-        ],
-        "static_url_path": "/flasgger_static",
-        "swagger_ui": True,
-        "specs_route": "/apidocs/",
-    },
-    template={
-        "openapi": "3.0.0",
-        "info": {"title": "FETCH API", "version": "1.0.0",
-                 "description": "Docs for business and courier apps"},
-        "components": {
-            "securitySchemes": {
-                "BearerAuth": {"type": "http", "scheme": "bearer", "bearerFormat": "JWT"}
-            },
-            "schemas": {
-                "Delivery": {
-                    "type": "object",
-                    "properties": {
-                        "id": {"type": "string"},
-                        "createdBy": {"type": "string"},
-                        "assignedCourier": {"type": "string", "nullable": True},
-                        "status": {"type": "string", "enum":
-                                   ["pending","accepted","in_progress","completed","cancelled"]},
-                        "pickupAddress": {"type": "string"},
-                        "dropoffAddress": {"type": "string"},
-                        "pickupLocation": {"type": "object",
-                            "properties": {"lat":{"type":"number"}, "lng":{"type":"number"}}},
-                        "dropoffLocation": {"type": "object",
-                            "properties": {"lat":{"type":"number"}, "lng":{"type":"number"}}},
-                        "timestampUpdated": {"type": "string", "format": "date-time"}
-                    },
-                    "required": ["id","createdBy","status","pickupLocation","dropoffLocation"]
+
+def _enqueue(task_name, *args):
+    """Queue a Celery task by name; only the workers import the task modules."""
+    return celery.send_task(task_name, args=list(args))
+
+SWAGGER_CONFIG = {
+    "headers": [],
+    "openapi": "3.0.0",
+    "specs": [
+        {
+            "endpoint": "apispec_1",
+            "route": "/apispec_1.json",
+            "rule_filter": lambda rule: True,   # include all routes
+            "model_filter": lambda tag: True,   # include all models
+        }
+    ],
+    "static_url_path": "/flasgger_static",
+    "swagger_ui": True,
+    "specs_route": "/apidocs/",
+}
+
+SWAGGER_TEMPLATE = {
+    "openapi": "3.0.0",
+    "info": {"title": "FETCH API", "version": "1.0.0",
+             "description": "Docs for business and courier apps"},
+    "components": {
+        "securitySchemes": {
+            "BearerAuth": {"type": "http", "scheme": "bearer", "bearerFormat": "JWT"}
+        },
+        "schemas": {
+            "Delivery": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "createdBy": {"type": "string"},
+                    "assignedCourier": {"type": "string", "nullable": True},
+                    "status": {"type": "string", "enum":
+                               ["pending","accepted","in_progress","completed","cancelled"]},
+                    "pickupAddress": {"type": "string"},
+                    "dropoffAddress": {"type": "string"},
+                    "pickupLocation": {"type": "object",
+                        "properties": {"lat":{"type":"number"}, "lng":{"type":"number"}}},
+                    "dropoffLocation": {"type": "object",
+                        "properties": {"lat":{"type":"number"}, "lng":{"type":"number"}}},
+                    "timestampUpdated": {"type": "string", "format": "date-time"}
                 },
-                "Error": {"type": "object",
-                          "properties": {"success":{"type":"boolean"}, "error":{"type":"string"}}},
-                "DeliveriesResponse": {
-                    "type": "object",
-                    "properties": {
-                        "success": {"type": "boolean"},
-                        "deliveries": {"type": "array",
-                                       "items": {"$ref":"#/components/schemas/Delivery"}}
-                    }
+                "required": ["id","createdBy","status","pickupLocation","dropoffLocation"]
+            },
+            "Error": {"type": "object",
+                      "properties": {"success":{"type":"boolean"}, "error":{"type":"string"}}},
+            "DeliveriesResponse": {
+                "type": "object",
+                "properties": {
+                    "success": {"type": "boolean"},
+                    "deliveries": {"type": "array",
+                                   "items": {"$ref":"#/components/schemas/Delivery"}}
                 }
             }
-        },
-        "security": [{"BearerAuth": []}],
-        "tags": [
-            {"name":"Auth","description":"Authentication"},
-            {"name":"Deliveries","description":"Business and courier operations"},
-            {"name":"Internal","description":"Internal utilities"}
-        ]
-    }
-)
-
-# hard-stop any Swagger 2 leftovers if present
-for k in ("swagger", "basePath", "schemes", "definitions", "parameters", "responses"):
-    swagger.template.pop(k, None)
+        }
+    },
+    "security": [{"BearerAuth": []}],
+    "tags": [
+        {"name":"Auth","description":"Authentication"},
+        {"name":"Deliveries","description":"Business and courier operations"},
+        {"name":"Internal","description":"Internal utilities"}
+    ]
+}
+
+# Prebuilt spec (see `flask --app app dump-apispec`); served instead of
+# generating it from the route docstrings.
+APISPEC_FILE = os.environ.get("APISPEC_FILE")
+
+def _init_swagger(app):
+    from flasgger import Swagger
+
+    swagger = Swagger(app, config=SWAGGER_CONFIG, template=SWAGGER_TEMPLATE)
+
+    # hard-stop any Swagger 2 leftovers if present
+    for k in ("swagger", "basePath", "schemes", "definitions", "parameters", "responses"):
+        swagger.template.pop(k, None)
+
+    # Flasgger re-parses every route docstring on each spec request; build it once
+    endpoint = "flasgger." + SWAGGER_CONFIG["specs"][0]["endpoint"]
+    build_spec = app.view_functions[endpoint]
+    cached = {}
+
+    @wraps(build_spec)
+    def cached_spec(*args, **kwargs):
+        if "body" not in cached:
+            if APISPEC_FILE and os.path.exists(APISPEC_FILE):
+                with open(APISPEC_FILE, "rb") as f:
+                    cached["body"] = f.read()
+            else:
+                cached["body"] = build_spec(*args, **kwargs).get_data()
+        return app.response_class(cached["body"], mimetype="application/json")
+
+    app.view_functions[endpoint] = cached_spec
+    return swagger
+
+swagger = _init_swagger(app) if os.environ.get("ENABLE_SWAGGER", "1") == "1" else None
+admission.init_app(app)
+profiler.init_app(app)
+
+# Long-poll waiters (asgi.py) wake on the same events the sockets get
+manager.add_listener(change_feed.publish)
+# Users with no open socket get assignment/status events as FCM pushes
+push_dispatcher.watch(manager)
 
 CORS(app)  
+
+@app.after_request
+def _encode_response(response):
+    # MessagePack and gzip/brotli bodies for clients that ask (encoding.py)
+    return encode_response(response, request)
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({"success": True, "status": "ok"}), 200
@@ -131,6 +202,7 @@ def create_user_profile():
 
         # Save to Firestore 
         user_doc_ref.set(profile, merge=True)
+        related_expander.invalidate(uid)
 
         return jsonify({'success': True}), 201
 
@@ -172,8 +244,6 @@ def update_user_profile():
         uid = request.uid
        # uid = 'TEST_UID'  
         user_doc_ref = db.collection('users').document(uid)
-        if not user_doc_ref.get().exists:
-            return jsonify({'success': False, 'error': 'Profile not found'}), 404
 
         updates = {}
         if 'displayName' in data:
@@ -192,7 +262,34 @@ def update_user_profile():
         if not updates:
             return jsonify({'success': False, 'error': 'No valid fields to update'}), 400
 
-        user_doc_ref.update(updates)
+        # update() fails on a missing document, so no separate existence read
+        try:
+            user_doc_ref.update(updates)
+        except NotFound:
+            return jsonify({'success': False, 'error': 'Profile not found'}), 404
+        related_expander.invalidate(uid)
+        return jsonify({'success': True}), 200
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/registerDeviceToken', methods=['POST'])
+@require_token
+def register_device_token():
+    """Store an FCM registration token for push notifications while the app is closed."""
+    try:
+        data = request.get_json() or {}
+        token = data.get('token')
+        if not isinstance(token, str) or not token:
+            return jsonify({'success': False, 'error': 'Missing token'}), 400
+
+        uid = request.uid
+        try:
+            db.collection('users').document(uid).update(
+                {DEVICE_TOKENS_FIELD: firestore.ArrayUnion([token])})
+        except NotFound:
+            return jsonify({'success': False, 'error': 'Profile not found'}), 404
+        push_dispatcher.forget_tokens(uid)
         return jsonify({'success': True}), 200
 
     except Exception as e:
@@ -429,36 +526,81 @@ def get_courier_locations():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.get("/couriers/<uid>/location")
-@require_token
-def get_courier_location(uid):
-    snap = db.collection("courier_locations").document(uid).get()
+def courier_location_payload(snap):
+    """(body, status) for a courier_locations snapshot; the ASGI route serves the same."""
     if not snap.exists:
-        return jsonify({"success": False, "error": "not_found"}), 405
+        return {"success": False, "error": "not_found"}, 404
     d = snap.to_dict() or {}
-    lat = d.get("lat") 
+    lat = d.get("lat")
     lng = d.get("lng")
     if lat is None or lng is None:
-        return jsonify({"success": False, "error": "no_coords"}), 404
-    return jsonify({"success": True, "data": {"lat": float(lat), "lng": float(lng)}}), 200
+        return {"success": False, "error": "no_coords"}, 404
+    return {"success": True, "data": {"lat": float(lat), "lng": float(lng)}}, 200
+
+@app.get("/couriers/<uid>/location")
+@require_token
+def get_courier_location(uid):
+    body, status = courier_location_payload(db.collection("courier_locations").document(uid).get())
+    return jsonify(body), status
 
 @app.route('/updateLocation', methods=['PUT'])
 @require_token
 def update_location():
     data = request.get_json() or {}
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Body must be a JSON object'}), 400
     lat = data.get('lat')
     lng = data.get('lng')
     if lat is None or lng is None:
         return jsonify({'success': False, 'error': 'Missing lat or lng'}), 400
+    point = parse_point(lat, lng)
+    if point is None:
+        return jsonify({'success': False, 'error': 'lat and lng must be valid coordinates'}), 400
 
    #uid = 'test_uid'
     uid = request.uid
-    db.collection('courier_locations').document(uid).set({
-        'lat': lat,
-        'lng': lng,
-        'timestamp': firestore.SERVER_TIMESTAMP
-    })
-    return jsonify({'success': True}), 200
+    lat, lng = point
+    # Every fix feeds the courier's shared track; only the ones that moved the
+    # courier meaningfully (or refresh a stale position) are written.
+    location_history.record(uid, lat, lng)
+    speed = location_history.average_speed_kmh(uid, ETA_SPEED_WINDOW_SECONDS)
+    accepted, next_interval = location_filter.offer(uid, lat, lng, _courier_is_active(uid), speed)
+    if accepted:
+        db.collection('courier_locations').document(uid).set({
+            'lat': lat,
+            'lng': lng,
+            'timestamp': firestore.SERVER_TIMESTAMP
+        })
+        _push_eta_updates(uid, lat, lng, speed)
+    traffic_capture.location(uid, lat, lng, accepted)
+    return jsonify({'success': True, 'accepted': accepted,
+                    'nextUpdateSeconds': next_interval}), 200
+
+def _courier_is_active(uid):
+    """Courier has an accepted/in_progress delivery (view if ready, else cached query)."""
+    if active_view.ready:
+        return active_view.courier_load(uid) > 0
+    try:
+        return eta_cache.has_active(db, uid)
+    except Exception as e:
+        print(f"[location] active check failed for {uid}: {e}")
+        return True   # err on the side of tracking closely
+
+def _push_eta_updates(uid, lat, lng, speed):
+    """Recompute ETAs for the courier's active deliveries; push the ones that moved."""
+    try:
+        for eta in eta_cache.on_fix(db, uid, lat, lng, speed):
+            payload = {
+                'event': 'delivery_eta_updated',
+                'delivery_id': eta['delivery_id'],
+                'eta': {k: eta[k] for k in ('target', 'distanceKm', 'seconds')},
+            }
+            if eta['createdBy']:
+                manager.send_to_user(eta['createdBy'], payload)
+            manager.send_to_user(uid, payload)
+    except Exception as e:
+        # Non-fatal: the location itself is already stored
+        print(f"[eta] update failed for courier {uid}: {e}")
 
 def _jsonable(x):
     if isinstance(x, dt.datetime): return x.isoformat()
@@ -481,43 +623,46 @@ def _sanitize(obj):
         return [_sanitize(v) for v in obj]
     return _jsonable(obj)
 
-@app.route('/createDelivery', methods=['POST'])
-@require_token
-def create_delivery():
-    data = request.get_json() or {}
+MAX_BULK_DELIVERIES = 500   # one Firestore batch
+
+def _parse_delivery_request(data, require_recipient=True):
+    """
+    Validate one delivery request body.
+    Returns (fields, None) on success or (None, error_message).
+    """
+    if not isinstance(data, dict):
+        return None, 'Delivery must be a JSON object'
     pickup = data.get('pickupLocation')
     dropoff = data.get('dropoffLocation')
     recipient_name = data.get('recipientName')
     recipient_phone = data.get('recipientPhone')
-    instructions = data.get('instructions', "")
-
-    if not pickup or 'lat' not in pickup or 'lng' not in pickup:
-        return jsonify({'success': False, 'error': 'Missing pickupLocation'}), 400
-    if not dropoff or 'lat' not in dropoff or 'lng' not in dropoff:
-        return jsonify({'success': False, 'error': 'Missing dropoffLocation'}), 400
-    if not recipient_name:
-        return jsonify({'success': False, 'error': 'Missing recipientName'}), 400
-    if not recipient_phone:
-        return jsonify({'success': False, 'error': 'Missing recipientPhone'}), 400
-    
-    def haversine(lat1, lon1, lat2, lon2):
-        R = 6371  # km
-        dlat = radians(lat2 - lat1)
-        dlon = radians(lon2 - lon1)
-        a = sin(dlat/2)**2 + cos(radians(lat1))*cos(radians(lat2))*sin(dlon/2)**2
-        return 2*R*atan2(sqrt(a), sqrt(1-a))
-    
-    uid = request.uid
-    dist_km = haversine(pickup['lat'], pickup['lng'], dropoff['lat'], dropoff['lng'])
-    fee = round(2.0 * dist_km + 5.0, 2)
-    #uid = 'test_uid'
 
-    delivery_data = {
-        'pickupLocation': {'lat': pickup['lat'], 'lng': pickup['lng']},
-        'dropoffLocation': {'lat': dropoff['lat'], 'lng': dropoff['lng']},
+    if not isinstance(pickup, dict) or 'lat' not in pickup or 'lng' not in pickup:
+        return None, 'Missing pickupLocation'
+    if not isinstance(dropoff, dict) or 'lat' not in dropoff or 'lng' not in dropoff:
+        return None, 'Missing dropoffLocation'
+    pickup_point = parse_point(pickup['lat'], pickup['lng'])
+    if pickup_point is None:
+        return None, 'pickupLocation lat/lng must be valid coordinates'
+    dropoff_point = parse_point(dropoff['lat'], dropoff['lng'])
+    if dropoff_point is None:
+        return None, 'dropoffLocation lat/lng must be valid coordinates'
+    if require_recipient and not recipient_name:
+        return None, 'Missing recipientName'
+    if require_recipient and not recipient_phone:
+        return None, 'Missing recipientPhone'
+
+    return {
+        'pickupLocation': {'lat': pickup_point[0], 'lng': pickup_point[1]},
+        'dropoffLocation': {'lat': dropoff_point[0], 'lng': dropoff_point[1]},
         'recipientName': recipient_name,
         'recipientPhone': recipient_phone,
-        'instructions': instructions,
+        'instructions': data.get('instructions', ""),
+    }, None
+
+def _new_delivery_doc(fields, uid, fee):
+    return {
+        **fields,
         'status': 'pending',
         'createdBy': uid,
         'assignedCourier': None,
@@ -526,12 +671,57 @@ def create_delivery():
         'timestampCreated': firestore.SERVER_TIMESTAMP,
         'timestampUpdated': firestore.SERVER_TIMESTAMP
     }
-    doc_ref = db.collection('deliveries').add(delivery_data)[1]
+
+def _parse_delivery_list(data, require_recipient=True):
+    """Validate a bulk body {'deliveries': [...]}; returns (fields_list, errors)."""
+    if not isinstance(data, dict):
+        return None, [{'index': None, 'error': "Body must be an object with a 'deliveries' array"}]
+    items = data.get('deliveries')
+    if not isinstance(items, list) or not items:
+        return None, [{'index': None, 'error': 'Missing deliveries array'}]
+    if len(items) > MAX_BULK_DELIVERIES:
+        return None, [{'index': None,
+                       'error': f'At most {MAX_BULK_DELIVERIES} deliveries per request'}]
+
+    parsed, errors = [], []
+    for i, item in enumerate(items):
+        fields, error = _parse_delivery_request(item, require_recipient)
+        if error:
+            errors.append({'index': i, 'error': error})
+        else:
+            parsed.append(fields)
+    return parsed, errors
+
+@app.route('/createDelivery', methods=['POST'])
+@require_token
+def create_delivery():
+    data = request.get_json() or {}
+    fields, error = _parse_delivery_request(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    pickup = fields['pickupLocation']
+
+    uid = request.uid
+    fee = delivery_fee(pickup, fields['dropoffLocation'])
+    #uid = 'test_uid'
+
+    delivery_data = _new_delivery_doc(fields, uid, fee)
+    doc_ref = db.collection('deliveries').document()
+    batch = db.batch()
+    batch.set(doc_ref, delivery_data)
+    delivery_stats.record_created(batch, db, uid, [fee])
+    batch.commit()
     delivery_id = doc_ref.id
+    traffic_capture.created(uid, delivery_id, pickup, fields['dropoffLocation'], fee)
+    try:
+        pending_index.add(delivery_id)
+    except Exception as e:
+        # Non-fatal: the periodic reconcile picks it up from Firestore
+        print(f"[pending index] add failed for {delivery_id}: {e}")
 
     #manager.send_to_user(uid,delivery_data)
     # Enqueue the background task that finds & assigns the nearest courier
-    async_res = match_and_assign_courier.apply_async(args=[delivery_id])
+    async_res = _enqueue('delivery_tasks.match_and_assign_courier', delivery_id)
 
     # Try to get result quickly; fall back to async if slow
     assigned_uid = None
@@ -570,6 +760,144 @@ def create_delivery():
     return jsonify({'success': True, 'delivery_id': delivery_id}), 200
 
 
+@app.route('/quoteDeliveries', methods=['POST'])
+@require_token
+def quote_deliveries():
+    """
+    Price many pickup/dropoff pairs without creating anything
+    The quote is not kept; /createDeliveries prices again, and with road
+    distances the fee can differ (see pricing.quote_fees).
+    ---
+    tags: [Deliveries]
+    security:
+      - BearerAuth: []
+    requestBody:
+      required: true
+      content:
+        application/json:
+          schema:
+            type: object
+            properties:
+              deliveries:
+                type: array
+                items:
+                  type: object
+                  properties:
+                    pickupLocation: { type: object }
+                    dropoffLocation: { type: object }
+            required: [deliveries]
+    responses:
+      200:
+        description: One quote per input pair, in order
+      400:
+        description: Invalid items (all errors are listed)
+    """
+    data = request.get_json() or {}
+    parsed, errors = _parse_delivery_list(data, require_recipient=False)
+    if errors:
+        return jsonify({'success': False, 'errors': errors}), 400
+
+    dist_km, fees = quote_fees([f['pickupLocation'] for f in parsed],
+                               [f['dropoffLocation'] for f in parsed])
+    quotes = [{'index': i, 'distanceKm': round(float(d), 3), 'fee': float(f)}
+              for i, (d, f) in enumerate(zip(dist_km, fees))]
+    return jsonify({'success': True, 'quotes': quotes,
+                    'totalFee': round(float(fees.sum()), 2)}), 200
+
+
+@app.route('/createDeliveries', methods=['POST'])
+@require_token
+def create_deliveries():
+    """
+    Create many deliveries in one request
+    ---
+    tags: [Deliveries]
+    security:
+      - BearerAuth: []
+    requestBody:
+      required: true
+      content:
+        application/json:
+          schema:
+            type: object
+            properties:
+              deliveries:
+                type: array
+                description: Same fields as /createDelivery, one object per order
+                items: { type: object }
+            required: [deliveries]
+    responses:
+      201:
+        description: Created; matching runs in the background
+      400:
+        description: Invalid items (nothing is created)
+    """
+    data = request.get_json() or {}
+    parsed, errors = _parse_delivery_list(data)
+    if errors:
+        return jsonify({'success': False, 'errors': errors}), 400
+
+    uid = request.uid
+    _, fees = quote_fees([f['pickupLocation'] for f in parsed],
+                         [f['dropoffLocation'] for f in parsed])
+
+    deliveries_ref = db.collection('deliveries')
+    batch = db.batch()
+    created = []
+    for fields, fee in zip(parsed, fees):
+        doc_ref = deliveries_ref.document()
+        batch.set(doc_ref, _new_delivery_doc(fields, uid, float(fee)))
+        created.append({'id': doc_ref.id, 'fee': float(fee), **fields})
+    delivery_stats.record_created(batch, db, uid, fees)
+    batch.commit()
+
+    delivery_ids = [d['id'] for d in created]
+    for d in created:
+        traffic_capture.created(uid, d['id'], d['pickupLocation'], d['dropoffLocation'], d['fee'])
+    try:
+        pending_index.add_many(delivery_ids)
+    except Exception as e:
+        print(f"[pending index] bulk add failed: {e}")
+
+    # One matching run for the whole batch; results arrive over WS
+    _enqueue('delivery_tasks.match_and_assign_couriers', delivery_ids)
+
+    manager.send_to_user(uid, _sanitize({
+        'event': 'new_deliveries',
+        'deliveries': [{**d, 'status': 'pending'} for d in created],
+    }))
+
+    return jsonify({'success': True, 'delivery_ids': delivery_ids}), 201
+
+
+def _not_modified(etag):
+    """Empty 304 for a conditional GET whose If-None-Match still matches."""
+    resp = app.response_class(status=304)
+    resp.set_etag(etag)
+    return resp
+
+
+def _expanded_version(items, expand):
+    """ETag input for inlined profiles: an edited profile changes no delivery."""
+    return sorted((d['id'], [d.get(name) for name in expand]) for d in items)
+
+
+def _deliveries_response(deliveries, expand=()):
+    """List response for [(delivery_id, data)], with ETag / 304 handling."""
+    items = [{'id': doc_id, **data} for doc_id, data in deliveries]
+    extra = None
+    if expand:
+        related_expander.expand(items, expand)
+        extra = _expanded_version(items, expand)
+    etag = list_etag(deliveries, extra)
+    if not_modified(etag):
+        return _not_modified(etag)
+
+    resp = jsonify({'success': True, 'deliveries': items})
+    resp.set_etag(etag)
+    return resp, 200
+
+
 @app.route('/getDeliveries', methods=['GET'])
 @require_token
 def get_deliveries():
@@ -579,13 +907,34 @@ def get_deliveries():
     tags: [Deliveries]
     security:
       - BearerAuth: []
+    parameters:
+      - in: query
+        name: status
+        required: false
+        description: "'active' returns only pending/accepted/in_progress deliveries"
+        schema: { type: string, enum: [active] }
+      - in: query
+        name: expand
+        required: false
+        description: >
+          Comma-separated: `courier` and/or `business`. Inlines that party's
+          profile (a few public fields, or null) into each delivery.
+        schema: { type: string, example: "courier,business" }
     responses:
       200:
-        description: Deliveries list
+        description: Deliveries list (with an ETag header)
         content:
           application/json:
             schema:
               $ref: '#/components/schemas/DeliveriesResponse'
+      304:
+        description: Not modified since the ETag sent in If-None-Match
+      400:
+        description: Unknown expand value
+        content:
+          application/json:
+            schema:
+              $ref: '#/components/schemas/Error'
       401:
         description: Unauthorized or token expired
         content:
@@ -601,8 +950,34 @@ def get_deliveries():
     """
     try:
         uid = request.uid
-        
-        user_doc = db.collection('users').document(uid).get()
+        try:
+            expand = parse_expand(request.args.get('expand'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        # Active deliveries only: answer from the in-process view, one profile read
+        if request.args.get('status') == 'active':
+            deliveries = active_view.for_user(uid)
+            if deliveries is not None:
+                user_doc = db.collection('users').document(uid).get()
+                if not user_doc.exists:
+                    return jsonify({'success': False, 'error': 'Profile not found'}), 404
+                # Same side of the delivery as the Firestore queries below
+                party_field = delivery_stats.PARTY_FIELDS.get((user_doc.to_dict() or {}).get('role'))
+                if party_field is None:
+                    return jsonify({'success': False, 'error': 'Invalid role'}), 400
+                return _deliveries_response(
+                    [(d, data) for d, data in deliveries if data.get(party_field) == uid], expand)
+
+        # The role decides which query we need, but both are cheap (a user
+        # is never on both sides), so run them alongside the profile read
+        # instead of waiting for it: one round trip instead of two.
+        deliveries_ref = db.collection('deliveries')
+        user_doc, created_docs, assigned_docs = gather(
+            lambda: db.collection('users').document(uid).get(),
+            lambda: list(deliveries_ref.where('createdBy', '==', uid).stream()),
+            lambda: list(deliveries_ref.where('assignedCourier', '==', uid).stream()),
+        )
         if not user_doc.exists:
             return jsonify({'success': False, 'error': 'Profile not found'}), 404
 
@@ -610,23 +985,117 @@ def get_deliveries():
         role = profile.get('role')
 
         if role == 'business':
-            
-            query = db.collection('deliveries').where('createdBy', '==', uid)
+            docs = created_docs
         elif role == 'courier':
-           
-            query = db.collection('deliveries').where('assignedCourier', '==', uid)
+            docs = assigned_docs
         else:
             return jsonify({'success': False, 'error': 'Invalid role'}), 400
 
-        docs = query.stream()
+        deliveries = [(doc.id, doc.to_dict()) for doc in docs]
+        if request.args.get('status') == 'active':
+            deliveries = [(d, data) for d, data in deliveries
+                          if data.get('status') in ACTIVE_STATUSES]
+        return _deliveries_response(deliveries, expand)
 
-        deliveries = []
-        for doc in docs:
-            data = doc.to_dict()
-            
-            deliveries.append({'id': doc.id, **data})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/syncDeliveries', methods=['GET'])
+@require_token
+def sync_deliveries():
+    """
+    Incremental delivery sync for clients that keep a local cache
+    ---
+    tags: [Deliveries]
+    security:
+      - BearerAuth: []
+    parameters:
+      - in: query
+        name: since
+        required: false
+        description: Token from the previous sync; omit for a full sync
+        schema: { type: string }
+    responses:
+      200:
+        description: >
+          Deliveries created or updated after `since`, ids deleted after it,
+          and the token for the next call. `full: true` means the list is
+          complete and replaces the client's cache (no/expired token).
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                success: { type: boolean }
+                full: { type: boolean }
+                deliveries:
+                  type: array
+                  items: { $ref: '#/components/schemas/Delivery' }
+                deleted:
+                  type: array
+                  items: { type: string }
+                token: { type: string }
+      400:
+        description: Invalid token or role
+        content:
+          application/json:
+            schema:
+              $ref: '#/components/schemas/Error'
+      404:
+        description: Profile not found
+        content:
+          application/json:
+            schema:
+              $ref: '#/components/schemas/Error'
+    """
+    try:
+        uid = request.uid
+        since = None
+        if request.args.get('since'):
+            try:
+                since = decode_token(request.args['since'])
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+        full = since is None or token_expired(since)
+
+        # Every query reads at the same instant, which becomes the next token
+        read_time = sync_read_time()
+
+        def changed(collection, party, ts_field):
+            query = db.collection(collection).where(party, '==', uid)
+            if not full:
+                query = query.where(ts_field, '>', since)
+            return lambda: list(query.stream(read_time=read_time))
+
+        calls = [
+            lambda: db.collection('users').document(uid).get(),
+            changed('deliveries', 'createdBy', 'timestampUpdated'),
+            changed('deliveries', 'assignedCourier', 'timestampUpdated'),
+        ]
+        if not full:
+            calls += [
+                changed(TOMBSTONE_COLLECTION, 'createdBy', 'timestampDeleted'),
+                changed(TOMBSTONE_COLLECTION, 'assignedCourier', 'timestampDeleted'),
+            ]
+        user_doc, created, assigned, *tombstones = gather(*calls)
+        if not user_doc.exists:
+            return jsonify({'success': False, 'error': 'Profile not found'}), 404
 
-        return jsonify({'success': True, 'deliveries': deliveries}), 200
+        role = user_doc.to_dict().get('role')
+        if role == 'business':
+            docs, deleted = created, (tombstones[0] if tombstones else [])
+        elif role == 'courier':
+            docs, deleted = assigned, (tombstones[1] if tombstones else [])
+        else:
+            return jsonify({'success': False, 'error': 'Invalid role'}), 400
+
+        return jsonify({
+            'success': True,
+            'full': full,
+            'deliveries': [{'id': d.id, **d.to_dict()} for d in docs],
+            'deleted': [t.id for t in deleted],
+            'token': encode_token(read_time),
+        }), 200
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -636,15 +1105,42 @@ def get_deliveries():
 def get_delivery(delivery_id):
     """
     Return the delivery document with ID == delivery_id.
+    Active deliveries are served from the in-process view when it is ready.
+    Honours If-None-Match: an unchanged delivery gets an empty 304.
+    ?expand=courier,business inlines those profiles, as on /getDeliveries.
     """
     try:
-        doc_ref = db.collection('deliveries').document(delivery_id)
-        doc = doc_ref.get()
-        if not doc.exists:
-            return jsonify({'success': False, 'error': 'Delivery not found'}), 404
+        try:
+            expand = parse_expand(request.args.get('expand'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        data = active_view.get(delivery_id)
+        if data is None:
+            doc = db.collection('deliveries').document(delivery_id).get()
+            if not doc.exists:
+                # Finished long ago: moved to the archive
+                doc = db.collection(ARCHIVE_COLLECTION).document(delivery_id).get()
+            if not doc.exists:
+                return jsonify({'success': False, 'error': 'Delivery not found'}), 404
+            data = doc.to_dict()
 
-        data = doc.to_dict()
-        return jsonify({'success': True, 'delivery': {'id': doc.id, **data}}), 200
+        eta = eta_cache.get(delivery_id, data.get('status'))
+        if eta:
+            data['eta'] = {k: eta[k] for k in ('target', 'distanceKm', 'seconds')}
+
+        delivery = {'id': delivery_id, **data}
+        extra = data.get('eta', {}).get('seconds')
+        if expand:
+            related_expander.expand([delivery], expand)
+            extra = (extra, _expanded_version([delivery], expand))
+        etag = delivery_etag(delivery_id, data, extra)
+        if not_modified(etag):
+            return _not_modified(etag)
+
+        resp = jsonify({'success': True, 'delivery': delivery})
+        resp.set_etag(etag)
+        return resp, 200
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -684,7 +1180,7 @@ def update_delivery_status(delivery_id):
               properties:
                 success: { type: boolean }
       400:
-        description: Missing fields or invalid role
+        description: Missing or unknown status
         content:
           application/json:
             schema:
@@ -701,12 +1197,20 @@ def update_delivery_status(delivery_id):
           application/json:
             schema:
               $ref: '#/components/schemas/Error'
+      409:
+        description: The delivery changed since it was read; retry
+        content:
+          application/json:
+            schema:
+              $ref: '#/components/schemas/Error'
     """
     try:
         data = request.get_json() or {}
         new_status = data.get('status')
         if not new_status:
             return jsonify({'success': False, 'error': 'Missing status field'}), 400
+        if new_status not in delivery_stats.STATUSES or new_status == 'pending':
+            return jsonify({'success': False, 'error': 'status must be accepted, in_progress, completed or cancelled'}), 400
 
         uid = request.uid
         #  Verify the delivery exists and that this user is actually the assigned courier
@@ -720,11 +1224,48 @@ def update_delivery_status(delivery_id):
         if assigned != uid:
             return jsonify({'success': False, 'error': 'Forbidden—You are not assigned to this delivery'}), 403
 
-        
-        doc_ref.update({
+        # One write for the status and its timestamps
+        updates = {
             'status': new_status,
             'timestampUpdated': firestore.SERVER_TIMESTAMP
-        })
+        }
+        if new_status == 'in_progress':
+            updates['timestampPickedUp'] = firestore.SERVER_TIMESTAMP
+        seconds = None
+        if new_status == 'completed':
+            updates['timestampDelivered'] = firestore.SERVER_TIMESTAMP
+            # Kept on the delivery so a stats rebuild can aggregate it
+            picked_up = delivery.get('timestampPickedUp')
+            seconds = delivery_stats.delivery_seconds(picked_up)
+            if seconds is not None:
+                updates['deliverySeconds'] = round(seconds, 1)
+            # Keep a downsampled trace of the pickup -> dropoff leg
+            route = location_history.route(
+                assigned, since=picked_up.timestamp() if hasattr(picked_up, 'timestamp') else None
+            )
+            if route:
+                updates['route'] = route
+
+        # Status and the counters of both parties in one commit
+        # Only if the delivery is as read, so the counters move from the right status
+        batch = db.batch()
+        batch.update(doc_ref, updates, option=db.write_option(last_update_time=doc.update_time))
+        delivery_stats.record_status_change(batch, db, delivery, new_status, seconds)
+
+        # The Redis read for the rematch doesn't depend on the Firestore write
+        calls = [batch.commit]
+        if new_status == 'completed':
+            calls.append(_pending_delivery_ids)
+        try:
+            results = gather(*calls)
+        except FailedPrecondition:
+            return jsonify({'success': False, 'error': 'Delivery was changed meanwhile, try again'}), 409
+        traffic_capture.status(uid, delivery_id, new_status)
+
+        # Next fix re-reads the courier's deliveries so the ETA switches leg
+        eta_cache.invalidate_courier(assigned)
+        if new_status in ('completed', 'cancelled'):
+            eta_cache.forget(delivery_id)
         business_uid = delivery.get('createdBy')    # fallback if you store creator uid
         payload = {
             'event': 'delivery_status_updated',
@@ -740,20 +1281,15 @@ def update_delivery_status(delivery_id):
         except Exception:
             # Non-fatal: WS failures shouldn't block the HTTP success path
             pass
-        if new_status == 'in_progress':
-            doc_ref.update({
-            'timestampPickedUp' : firestore.SERVER_TIMESTAMP
-            })
+        if new_status == 'cancelled':
+            try:
+                pending_index.remove(delivery_id)
+            except Exception as e:
+                print(f"[pending index] remove failed for {delivery_id}: {e}")
         if new_status == 'completed':
-            doc_ref.update({
-            'timestampDelivered': firestore.SERVER_TIMESTAMP
-            })
-        
-            pending = db.collection('deliveries') \
-                .where('status', '==', 'pending') \
-                .stream()
-            for p in pending:
-                match_and_assign_courier.delay(p.id)
+            # A courier just freed up: retry everything still waiting
+            for pending_id in results[1]:
+                _enqueue('delivery_tasks.match_and_assign_courier', pending_id)
 
         return jsonify({'success': True}), 200
 
@@ -763,21 +1299,187 @@ def update_delivery_status(delivery_id):
     
     
     
+def _pending_delivery_ids():
+    """Pending delivery ids from the Redis index, or a Firestore scan if Redis is down."""
+    try:
+        return pending_index.oldest()
+    except Exception as e:
+        print(f"[pending index] read failed, scanning Firestore: {e}")
+        pending = db.collection('deliveries') \
+            .where('status', '==', 'pending') \
+            .stream()
+        return [p.id for p in pending]
+
+
 @app.route('/deleteDelivery/<delivery_id>', methods=['DELETE'])
 @require_token
 def delete_delivery(delivery_id):
     try:
         doc_ref = db.collection('deliveries').document(delivery_id)
-        if not doc_ref.get().exists:
+        snap = doc_ref.get()
+        if not snap.exists:
             return jsonify({'success': False, 'error': 'delivery not found'}), 404
 
-        doc_ref.delete()
+        # Delete and leave a tombstone for /syncDeliveries in one commit. The
+        # counters drop the status read here, so only if nothing changed it since
+        batch = db.batch()
+        batch.delete(doc_ref, option=db.write_option(last_update_time=snap.update_time))
+        batch.set(db.collection(TOMBSTONE_COLLECTION).document(delivery_id),
+                  tombstone(snap.to_dict() or {}))
+        delivery_stats.record_deleted(batch, db, snap.to_dict() or {})
+        try:
+            batch.commit()
+        except FailedPrecondition:
+            return jsonify({'success': False, 'error': 'Delivery was changed meanwhile, try again'}), 409
+        try:
+            pending_index.remove(delivery_id)
+        except Exception as e:
+            print(f"[pending index] remove failed for {delivery_id}: {e}")
         return jsonify({'success': True}), 200
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/stats', methods=['GET'])
+@require_token
+def get_stats():
+    """
+    Delivery totals for the current business or courier
+    ---
+    tags: [Deliveries]
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: >
+          Counts by status, fee totals (cancelled excluded; `fees.completed`
+          is a courier's earnings) and the average pickup-to-delivery time.
+          Served from counters, so the cost doesn't grow with history.
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                success: { type: boolean }
+                stats:
+                  type: object
+                  properties:
+                    role: { type: string }
+                    counts: { type: object, additionalProperties: { type: integer } }
+                    total: { type: integer }
+                    fees:
+                      type: object
+                      properties:
+                        total: { type: number }
+                        average: { type: number, nullable: true }
+                        completed: { type: number }
+                    averageDeliverySeconds: { type: integer, nullable: true }
+      400:
+        description: Invalid role
+        content:
+          application/json:
+            schema:
+              $ref: '#/components/schemas/Error'
+      404:
+        description: Profile not found
+        content:
+          application/json:
+            schema:
+              $ref: '#/components/schemas/Error'
+    """
+    try:
+        uid = request.uid
+        user_doc = db.collection('users').document(uid).get()
+        if not user_doc.exists:
+            return jsonify({'success': False, 'error': 'Profile not found'}), 404
+        role = (user_doc.to_dict() or {}).get('role')
+        if role not in delivery_stats.PARTY_FIELDS:
+            return jsonify({'success': False, 'error': 'Invalid role'}), 400
+        return jsonify({'success': True, 'stats': delivery_stats.read(db, uid, role)}), 200
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/getDeliveryHistory', methods=['GET'])
+@require_token
+def get_delivery_history():
+    """
+    Archived deliveries of the current user, newest first
+    ---
+    tags: [Deliveries]
+    security:
+      - BearerAuth: []
+    parameters:
+      - in: query
+        name: limit
+        required: false
+        schema: { type: integer, default: 50, maximum: 200 }
+      - in: query
+        name: cursor
+        required: false
+        description: nextCursor from the previous page
+        schema: { type: string }
+    responses:
+      200:
+        description: >
+          One page of finished deliveries moved out of the live collection
+          (recent ones are still returned by /getDeliveries). nextCursor is
+          null on the last page.
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                success: { type: boolean }
+                deliveries:
+                  type: array
+                  items: { $ref: '#/components/schemas/Delivery' }
+                nextCursor: { type: string, nullable: true }
+      400:
+        description: Invalid limit, cursor or role
+        content:
+          application/json:
+            schema:
+              $ref: '#/components/schemas/Error'
+      404:
+        description: Profile not found
+        content:
+          application/json:
+            schema:
+              $ref: '#/components/schemas/Error'
+    """
+    try:
+        uid = request.uid
+        try:
+            limit = int(request.args.get('limit', HISTORY_DEFAULT_PAGE))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid limit'}), 400
+        limit = min(max(limit, 1), HISTORY_MAX_PAGE)
+
+        user_doc = db.collection('users').document(uid).get()
+        if not user_doc.exists:
+            return jsonify({'success': False, 'error': 'Profile not found'}), 404
+        role = (user_doc.to_dict() or {}).get('role')
+        if role not in delivery_stats.PARTY_FIELDS:
+            return jsonify({'success': False, 'error': 'Invalid role'}), 400
+
+        try:
+            page, next_cursor = history_page(db, delivery_stats.PARTY_FIELDS[role], uid,
+                                             limit, request.args.get('cursor'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        return jsonify({
+            'success': True,
+            'deliveries': [{'id': doc_id, **data} for doc_id, data in page],
+            'nextCursor': next_cursor,
+        }), 200
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 #---------------------------------------------------
 #GOOGLE AND FACEBOOK 
 #----------------------------------------------------
@@ -894,13 +1596,181 @@ def ws_broadcast():
         return jsonify(ok=False, error=str(e)), 500
 
 
+@app.get('/internal/metrics')
+@require_admin_token
+def internal_metrics():
+    """
+    Internal: in-process caches and views
+    ---
+    tags: [Internal]
+    parameters:
+      - in: header
+        name: X-Admin-Token
+        required: true
+        description: Must equal ADMIN_TOKEN
+        schema: { type: string }
+    responses:
+      200:
+        description: Per-subsystem counters and gauges
+      403:
+        description: Missing or wrong token, or ADMIN_TOKEN not set
+    """
+    return jsonify({
+        'active_view': active_view.stats(),
+        'location_history': location_history.stats(),
+        'location_filter': location_filter.stats(),
+        'eta': eta_cache.stats(),
+        'distance': get_distance_provider().stats(),
+        'push': push_dispatcher.stats(),
+        'expand': related_expander.stats(),
+        'ws': {**manager.stats(), 'event_log': manager.event_log.stats()},
+        'change_feed': change_feed.stats(),
+        'admission': admission.stats(),
+        'profiler': profiler.stats(),
+        'capture': traffic_capture.stats(),
+    })
+
+
+@app.get('/internal/analytics/kpis')
+@require_admin_token
+def internal_analytics_kpis():
+    """
+    Internal: fleet KPIs from the Parquet export (no Firestore reads)
+    ---
+    tags: [Internal]
+    parameters:
+      - in: header
+        name: X-Admin-Token
+        required: true
+        description: Must equal ADMIN_TOKEN
+        schema: { type: string }
+      - in: query
+        name: since
+        required: false
+        description: ISO date/time, deliveries created at or after (UTC if no offset)
+        schema: { type: string }
+      - in: query
+        name: until
+        required: false
+        description: ISO date/time, deliveries created before
+        schema: { type: string }
+      - in: query
+        name: areas
+        required: false
+        description: Top pickup areas by fees
+        schema: { type: integer, default: 20 }
+    responses:
+      200:
+        description: Status counts, time to assignment, pickup-to-dropoff time, courier utilization, fees by area
+      400:
+        description: Invalid since/until
+      403:
+        description: Missing or wrong token, or ADMIN_TOKEN not set
+      503:
+        description: pandas/pyarrow not installed
+    """
+    try:
+        import analytics
+    except ImportError as e:
+        return jsonify({'success': False, 'error': f'analytics unavailable: {e}'}), 503
+    try:
+        since = analytics.parse_date(request.args.get('since'))
+        until = analytics.parse_date(request.args.get('until'))
+        areas = int(request.args.get('areas', 20))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid since/until/areas'}), 400
+    try:
+        result = analytics.kpis(analytics.cached_deliveries(), since, until, areas)
+        return jsonify({'success': True, 'kpis': result}), 200
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/internal/profile', methods=['GET', 'POST'])
+@require_admin_token
+def internal_profile():
+    """
+    Internal: turn request/task profiling on or off in every process
+    ---
+    tags: [Internal]
+    parameters:
+      - in: header
+        name: X-Admin-Token
+        required: true
+        description: Must equal ADMIN_TOKEN
+        schema: { type: string }
+    requestBody:
+      required: false
+      content:
+        application/json:
+          schema:
+            type: object
+            properties:
+              rate: { type: number, description: "Fraction of requests/tasks profiled, 0 turns it off" }
+              mode: { type: string, enum: [sample, cprofile, both] }
+              seconds: { type: integer, description: "How long the setting lasts (default PROFILE_MAX_SECONDS)" }
+    responses:
+      200:
+        description: GET returns this process' profiler state, POST the new setting
+      400:
+        description: Invalid rate/mode/seconds
+      403:
+        description: Missing or wrong token, or ADMIN_TOKEN not set
+    """
+    if request.method == 'GET':
+        return jsonify({'success': True, 'profiler': profiler.stats()}), 200
+    body = request.get_json(silent=True) or {}
+    try:
+        config = profiler.configure(float(body.get('rate', 0)), body.get('mode'),
+                                    int(body.get('seconds', PROFILE_MAX_SECONDS)))
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Could not publish setting: {e}'}), 500
+    return jsonify({'success': True, 'profiling': config}), 200
+
+
 # ------------------------
 # RUN THE APP
 # ------------------------
 
+@app.cli.command('dump-apispec')
+@click.argument('path')
+def dump_apispec(path):
+    """Write the OpenAPI spec to PATH (serve it with APISPEC_FILE=PATH)."""
+    if swagger is None:
+        raise click.ClickException('Swagger is disabled (ENABLE_SWAGGER=0)')
+    spec = app.test_client().get(SWAGGER_CONFIG['specs'][0]['route']).get_data()
+    with open(path, 'wb') as f:
+        f.write(spec)
+    click.echo(f'wrote {len(spec)} bytes to {path}')
+
+
+@app.cli.command('archive-deliveries')
+@click.option('--days', type=int, default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive finished deliveries last updated more than this many days ago')
+def archive_deliveries(days):
+    """Move old completed/cancelled deliveries to the archive collection now."""
+    click.echo(f'archived {archive_finished(db, days)} deliveries')
+
+
+@app.cli.command('rebuild-stats')
+@click.argument('uid', required=False)
+def rebuild_stats(uid):
+    """Recompute delivery_stats from the deliveries, for one user or everyone."""
+    docs = [db.collection('users').document(uid).get()] if uid else db.collection('users').stream()
+    rebuilt = 0
+    for doc in docs:
+        role = (doc.to_dict() or {}).get('role') if doc.exists else None
+        if role in delivery_stats.PARTY_FIELDS:
+            delivery_stats.rebuild(db, doc.id, role)
+            rebuilt += 1
+    click.echo(f'rebuilt stats for {rebuilt} users')
+
+
 if __name__ == '__main__':
-    import os
     # Start WS server only in the reloader's main process
     if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
         manager.start()
+        start_active_view(db)
     app.run(host='0.0.0.0', port=5001, debug=True)
@@ -0,0 +1,104 @@
+# archive.py
+"""
+Cold storage for finished deliveries.
+
+Completed and cancelled deliveries whose last update is older than
+ARCHIVE_AFTER_DAYS move from `deliveries` to ARCHIVE_COLLECTION. Each
+document is copied and deleted in the same batch, so a delivery is
+always in exactly one of the two collections. The delete only applies
+to the version that was copied; a delivery changed in between is left
+for a later run. The live collection then
+holds only the working set plus recent history. That bounds the
+matcher's capacity queries, the pending scan, listeners and listings,
+and the indexes behind them.
+
+Archived deliveries keep their ids and fields, plus archivedAt. They are
+read through /getDeliveryHistory, newest first, one page at a time.
+Archiving isn't a delete: no tombstone is written, so clients that sync
+incrementally keep their cached copies, and delivery_stats counts them
+the same as before.
+"""
+import datetime as dt
+import os
+from typing import List, Optional, Tuple
+
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud import firestore
+
+from concurrency import get_all
+
+ARCHIVE_COLLECTION = "deliveries_archive"
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 30))
+# Deliveries moved per commit (each is a set plus a delete)
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 200))
+ARCHIVED_STATUSES = ("completed", "cancelled")
+
+HISTORY_DEFAULT_PAGE = 50
+HISTORY_MAX_PAGE = 200
+
+
+def archive_finished(db, older_than_days: int = ARCHIVE_AFTER_DAYS,
+                     max_batches: Optional[int] = None) -> int:
+    """Move finished deliveries last updated before the cutoff; returns how many moved."""
+    cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=older_than_days)
+    deliveries = db.collection("deliveries")
+    archive = db.collection(ARCHIVE_COLLECTION)
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        old = list(
+            deliveries
+            .where("status", "in", list(ARCHIVED_STATUSES))
+            .where("timestampUpdated", "<", cutoff)
+            .limit(ARCHIVE_BATCH_SIZE)
+            .stream()
+        )
+        if not old:
+            break
+        moved += _move(db, archive, old)
+        batches += 1
+    return moved
+
+
+def _move(db, archive, snaps) -> int:
+    """Copy and delete `snaps` in one commit, minus any changed since they were read."""
+    while snaps:
+        batch = db.batch()
+        for snap in snaps:
+            batch.set(archive.document(snap.id),
+                      {**(snap.to_dict() or {}), "archivedAt": firestore.SERVER_TIMESTAMP})
+            batch.delete(snap.reference, option=db.write_option(last_update_time=snap.update_time))
+        try:
+            batch.commit()
+            return len(snaps)
+        except FailedPrecondition:
+            # The batch fails as a whole; find the documents that changed and retry without them
+            current = get_all(db, [snap.reference for snap in snaps])
+            unchanged = [snap for snap in snaps
+                         if snap.id in current and current[snap.id].exists
+                         and current[snap.id].update_time == snap.update_time]
+            if len(unchanged) == len(snaps):
+                raise
+            snaps = unchanged
+    return 0
+
+
+def history_page(db, party_field: str, uid: str, limit: int = HISTORY_DEFAULT_PAGE,
+                 cursor: Optional[str] = None) -> Tuple[List[tuple], Optional[str]]:
+    """
+    One page of a user's archived deliveries, newest first: ([(id, data)], next_cursor).
+    The cursor is the last id of the previous page; next_cursor is None on the last page.
+    Raises ValueError for a cursor that isn't an archived delivery of this user.
+    """
+    archive = db.collection(ARCHIVE_COLLECTION)
+    query = (archive.where(party_field, "==", uid)
+             .order_by("timestampUpdated", direction=firestore.Query.DESCENDING))
+    if cursor:
+        start = archive.document(cursor).get()
+        if not start.exists or (start.to_dict() or {}).get(party_field) != uid:
+            raise ValueError("invalid cursor")
+        query = query.start_after(start)
+    # One extra document tells us whether another page exists
+    docs = list(query.limit(limit + 1).stream())
+    page = [(d.id, d.to_dict() or {}) for d in docs[:limit]]
+    next_cursor = page[-1][0] if len(docs) > limit else None
+    return page, next_cursor
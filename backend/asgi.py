@@ -0,0 +1,210 @@
+# asgi.py
+"""
+ASGI serving mode: REST routes and the WebSocket endpoint in one process
+and one event loop.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5001 --loop uvloop
+    # or: python asgi.py
+
+The WebSocket endpoint is ws://<host>:5001/ws (same register protocol as
+the standalone server on :6789). Flask routes are mounted as-is behind
+WSGIMiddleware; hot read-only routes are served natively with the
+Firestore AsyncClient.
+
+Long-poll endpoints for clients that can't keep a socket open exist only
+here, since a waiting request must not hold a worker thread:
+
+    GET /deliveries/<id>/wait?since=<version>&timeout=<seconds>
+    GET /deliveries/wait?since=<version>&timeout=<seconds>   (any of my deliveries)
+"""
+import asyncio
+import os
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route, WebSocketRoute
+
+from admission import ADMISSION_ENABLED, admission, retry_after_header
+from app import app as flask_app, courier_location_payload
+from auth import verify_authorization_header
+from change_feed import change_feed
+from encoding import select_subprotocol
+from active_view import start_active_view
+from firebase_init import db, get_async_db
+from websocket_manager import (
+    WS_COMPRESSION, WS_MAX_MESSAGE_BYTES, WS_PING_INTERVAL, WS_PING_TIMEOUT, WS_BACKLOG,
+    manager, raise_fd_limit,
+)
+
+
+class _StarletteSocket:
+    """The small slice of the `websockets` connection API that WebSocketManager uses."""
+
+    def __init__(self, websocket, subprotocol=None):
+        self._ws = websocket
+        self.subprotocol = subprotocol
+
+    async def send(self, data):
+        if isinstance(data, bytes):
+            await self._ws.send_bytes(data)
+        else:
+            await self._ws.send_text(data)
+
+    async def close(self, code=1000, reason=""):
+        await self._ws.close(code, reason)
+
+    async def __aiter__(self):
+        while True:
+            message = await self._ws.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            yield message.get("text") if message.get("text") is not None else message.get("bytes")
+
+
+async def _authenticate(request, endpoint: str):
+    """
+    Async counterpart of @require_token, per-user rate limit included
+    (`endpoint` names the bucket, as a Flask endpoint does); returns
+    (uid, error_response).
+    """
+    uid, error = await run_in_threadpool(
+        verify_authorization_header, request.headers.get("Authorization")
+    )
+    if error:
+        return None, JSONResponse({"success": False, "error": error}, status_code=401)
+    if ADMISSION_ENABLED:
+        wait = await run_in_threadpool(admission.limit, uid, endpoint)
+        if wait:
+            return None, JSONResponse({"success": False, "error": "Rate limit exceeded"}, status_code=429,
+                                      headers={"Retry-After": retry_after_header(wait)})
+    return uid, None
+
+
+async def health(request):
+    return JSONResponse({"success": True, "status": "ok"})
+
+
+async def get_courier_location(request):
+    # Flask's /couriers/<uid>/location with the async client; same body and limits
+    _, error = await _authenticate(request, "get_courier_location")
+    if error:
+        return error
+    uid = request.path_params["uid"]
+    snap = await get_async_db().collection("courier_locations").document(uid).get()
+    body, status = courier_location_payload(snap)
+    return JSONResponse(body, status_code=status)
+
+
+LONG_POLL_DEFAULT_SECONDS = 25.0
+LONG_POLL_MAX_SECONDS = 55.0
+
+
+def _wait_params(request):
+    """(since, timeout); since is None when the client has no version yet. Raises ValueError."""
+    since = request.query_params.get("since")
+    since = int(since) if since is not None else None
+    timeout = float(request.query_params.get("timeout", LONG_POLL_DEFAULT_SECONDS))
+    return since, min(max(timeout, 0.0), LONG_POLL_MAX_SECONDS)
+
+
+async def _long_poll(key, since, timeout):
+    if since is None:
+        # First call: hand out the current version to wait from
+        return JSONResponse({"success": True, "changed": False, "version": change_feed.version})
+    result = await change_feed.wait(key, since, timeout)
+    if result is None:
+        return JSONResponse({"success": True, "changed": False, "version": change_feed.version})
+    version, event = result
+    return JSONResponse({
+        "success": True,
+        "changed": True,
+        "version": version,
+        "event": event,
+        # No event means the server restarted since `since`: refetch
+        "resync": event is None,
+    })
+
+
+async def wait_for_delivery(request):
+    uid, error = await _authenticate(request, "wait_for_delivery")
+    if error:
+        return error
+    try:
+        since, timeout = _wait_params(request)
+    except ValueError:
+        return JSONResponse({"success": False, "error": "Invalid since/timeout"}, status_code=400)
+
+    delivery_id = request.path_params["delivery_id"]
+    snap = await get_async_db().collection("deliveries").document(delivery_id).get()
+    if not snap.exists:
+        return JSONResponse({"success": False, "error": "Delivery not found"}, status_code=404)
+    data = snap.to_dict() or {}
+    if uid not in (data.get("createdBy"), data.get("assignedCourier")):
+        return JSONResponse({"success": False, "error": "Forbidden"}, status_code=403)
+
+    return await _long_poll(("delivery", delivery_id), since, timeout)
+
+
+async def wait_for_user(request):
+    uid, error = await _authenticate(request, "wait_for_user")
+    if error:
+        return error
+    try:
+        since, timeout = _wait_params(request)
+    except ValueError:
+        return JSONResponse({"success": False, "error": "Invalid since/timeout"}, status_code=400)
+    return await _long_poll(("user", uid), since, timeout)
+
+
+async def websocket_endpoint(websocket):
+    if manager.at_capacity():
+        # Closing before accept refuses the handshake (uvicorn answers 403)
+        manager.counters["rejected"] += 1
+        await websocket.close(1013)
+        return
+    # JSON text or MessagePack binary frames (see encoding.py)
+    subprotocol = select_subprotocol(websocket.scope.get("subprotocols"))
+    await websocket.accept(subprotocol=subprotocol)
+    await manager.handler(_StarletteSocket(websocket, subprotocol))
+
+
+async def _startup():
+    # Sends from Flask worker threads are scheduled onto this loop
+    loop = asyncio.get_running_loop()
+    manager.attach(loop)
+    change_feed.attach(loop)
+    # The listeners run on their own threads; starting them only opens the streams
+    await run_in_threadpool(start_active_view, db)
+
+
+application = Starlette(
+    routes=[
+        Route("/health", health),
+        Route("/couriers/{uid}/location", get_courier_location),
+        Route("/deliveries/wait", wait_for_user),
+        Route("/deliveries/{delivery_id}/wait", wait_for_delivery),
+        WebSocketRoute("/ws", websocket_endpoint),
+        Mount("/", WSGIMiddleware(flask_app)),
+    ],
+    on_startup=[_startup],
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    raise_fd_limit()
+    uvicorn.run(
+        application,
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 5001)),
+        loop=os.environ.get("ASGI_LOOP", "uvloop"),
+        # Same socket settings as the standalone server (websocket_manager.py)
+        ws_ping_interval=WS_PING_INTERVAL or None,
+        ws_ping_timeout=WS_PING_TIMEOUT or None,
+        ws_max_size=WS_MAX_MESSAGE_BYTES,
+        ws_per_message_deflate=WS_COMPRESSION == "deflate",
+        backlog=WS_BACKLOG,
+    )
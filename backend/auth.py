@@ -1,37 +1,71 @@
 # auth.py
 
+import hmac
+import os
 from functools import wraps
 from flask import request, jsonify
 from firebase_init import firebase_auth  # your initialized Admin SDK
+from admission import throttle
+
+# Shared secret for the /internal/* endpoints, sent as X-Admin-Token; they
+# answer 403 while it is unset. PROFILE_ADMIN_TOKEN is the older name.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN") or os.environ.get("PROFILE_ADMIN_TOKEN", "")
+
+def verify_authorization_header(auth_header):
+    """
+    Validate a 'Bearer <Firebase ID token>' header.
+    Returns (uid, None) on success or (None, error_message).
+    Shared by the Flask decorator and the ASGI routes.
+    """
+    # 1) Extract and validate the Authorization header
+    if not auth_header:
+        return None, "Missing Authorization header"
+
+    parts = auth_header.split()
+    if parts[0].lower() != "bearer" or len(parts) != 2:
+        return None, "Malformed Authorization header"
+
+    id_token = parts[1]
+
+    # 2) Verify the Firebase ID token
+    try:
+        decoded = firebase_auth.verify_id_token(id_token)
+    except firebase_auth.ExpiredIdTokenError:
+        return None, "Token expired"
+    except firebase_auth.InvalidIdTokenError:
+        return None, "Invalid token"
+    except Exception as e:
+        return None, f"Token verification failed: {e}"
+
+    return decoded.get("uid"), None
 
 def require_token(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        # 1) Extract and validate the Authorization header
-        auth_header = request.headers.get("Authorization", None)
-        if not auth_header:
-            return jsonify(success=False, error="Missing Authorization header"), 401
-
-        parts = auth_header.split()
-        if parts[0].lower() != "bearer" or len(parts) != 2:
-            return jsonify(success=False, error="Malformed Authorization header"), 401
-
-        id_token = parts[1]
-
-        # 2) Verify the Firebase ID token
-        try:
-            decoded = firebase_auth.verify_id_token(id_token)
-        except firebase_auth.ExpiredIdTokenError:
-            return jsonify(success=False, error="Token expired"), 401
-        except firebase_auth.InvalidIdTokenError:
-            return jsonify(success=False, error="Invalid token"), 401
-        except Exception as e:
-            return jsonify(success=False, error=f"Token verification failed: {e}"), 401
+        uid, error = verify_authorization_header(request.headers.get("Authorization", None))
+        if error:
+            return jsonify(success=False, error=error), 401
 
         # 3) Inject the UID for downstream use
-        request.uid = decoded.get("uid")
+        request.uid = uid
+
+        # 4) Per-user rate limit for this route
+        limited = throttle(uid)
+        if limited is not None:
+            return limited
 
-        # 4) Call the protected route
+        # 5) Call the protected route
+        return f(*args, **kwargs)
+
+    return wrapper
+
+def require_admin_token(f):
+    """For operator endpoints: the X-Admin-Token header must equal ADMIN_TOKEN."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get("X-Admin-Token", "").encode()
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN.encode()):
+            return jsonify(success=False, error="Forbidden"), 403
         return f(*args, **kwargs)
 
     return wrapper
@@ -0,0 +1,109 @@
+# bench/bench_encoding.py
+"""
+Payload size and encode CPU per response encoding.
+
+    python bench/bench_encoding.py                 # default payload sizes
+    python bench/bench_encoding.py --deliveries 200 --couriers 500
+
+Builds payloads shaped like the dashboard responses (/getDeliveries for a
+business, /getCourierLocations, one delivery_eta_updated WS event) and
+reports, for JSON / MessagePack with no compression, gzip and brotli (if
+installed): body bytes, ratio to plain JSON, and median encode time. Times
+cover serialization plus compression, i.e. what encoding.py adds per
+response.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import encoding  # noqa: E402
+
+STATUSES = ["pending", "accepted", "in_progress", "completed", "cancelled"]
+
+
+def _delivery(rng):
+    now = dt.datetime(2025, 1, 1, tzinfo=dt.timezone.utc) + dt.timedelta(minutes=rng.randint(0, 10_000))
+    return {
+        "id": uuid.UUID(int=rng.getrandbits(128)).hex[:20],
+        "createdBy": "biz_" + uuid.UUID(int=rng.getrandbits(128)).hex[:24],
+        "assignedCourier": "cour_" + uuid.UUID(int=rng.getrandbits(128)).hex[:23],
+        "status": rng.choice(STATUSES),
+        "pickupAddress": f"{rng.randint(1, 999)} King St W, Toronto, ON",
+        "dropoffAddress": f"{rng.randint(1, 999)} Queen St E, Toronto, ON",
+        "pickupLocation": {"lat": 43.6 + rng.random() / 10, "lng": -79.4 + rng.random() / 10},
+        "dropoffLocation": {"lat": 43.6 + rng.random() / 10, "lng": -79.4 + rng.random() / 10},
+        "packageDetails": "Small parcel, handle with care",
+        "fee": round(5 + rng.random() * 20, 2),
+        "eta_seconds": rng.randint(60, 3600),
+        "timestampCreated": now.isoformat(),
+        "timestampUpdated": (now + dt.timedelta(minutes=5)).isoformat(),
+    }
+
+
+def payloads(n_deliveries, n_couriers, seed=1):
+    rng = random.Random(seed)
+    deliveries = [_delivery(rng) for _ in range(n_deliveries)]
+    locations = [
+        {"courier_id": "cour_" + uuid.UUID(int=rng.getrandbits(128)).hex[:23],
+         "lat": 43.6 + rng.random() / 10, "lng": -79.4 + rng.random() / 10}
+        for _ in range(n_couriers)
+    ]
+    event = {"type": "delivery_eta_updated", "delivery_id": deliveries[0]["id"],
+             "eta_seconds": 412, "courier": {"lat": 43.65, "lng": -79.38}}
+    return {
+        f"getDeliveries ({n_deliveries})": {"success": True, "deliveries": deliveries},
+        f"getCourierLocations ({n_couriers})": {"success": True, "locations": locations},
+        "ws delivery_eta_updated": event,
+    }
+
+
+def _encoders():
+    codings = [None, "gzip"] + (["br"] if encoding.brotli is not None else [])
+    for fmt in ("json", "msgpack"):
+        for coding in codings:
+            def encode(obj, fmt=fmt, coding=coding):
+                body = encoding.encode_frame(obj, fmt)
+                if isinstance(body, str):
+                    body = body.encode()
+                return encoding.compress(body, coding) if coding else body
+            yield f"{fmt}+{coding}" if coding else fmt, encode
+
+
+def _median_us(fn, obj, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn(obj)
+        times.append(time.perf_counter() - t)
+    return statistics.median(times) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--deliveries", type=int, default=50)
+    parser.add_argument("--couriers", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    if encoding.brotli is None:
+        print("(brotli not installed: br rows skipped)")
+    for name, obj in payloads(args.deliveries, args.couriers).items():
+        baseline = len(json.dumps(obj).encode())
+        print(f"\n{name}")
+        print(f"  {'encoding':<14}{'bytes':>9}{'ratio':>8}{'encode us':>12}")
+        for label, encode in _encoders():
+            size = len(encode(obj))
+            us = _median_us(encode, obj, args.repeat)
+            print(f"  {label:<14}{size:>9}{size / baseline:>8.2f}{us:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
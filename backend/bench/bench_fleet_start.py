@@ -0,0 +1,177 @@
+# bench/bench_fleet_start.py
+"""
+Cold start of the matcher's fleet view: full rebuild vs snapshot + catch-up.
+
+    python bench/bench_fleet_start.py --couriers 5000 --active 20000 --finished 200000 --changes 2000
+    python bench/bench_fleet_start.py --firestore      # read-only, against the configured project
+
+By default it runs on the in-memory stand-in (bench/firestore_standin.py)
+filled with synthetic couriers, active deliveries and finished ones.
+
+1. Time a full start: listeners over all active deliveries and all
+   courier locations.
+2. Snapshot that view with fleet_snapshot.encode.
+3. Apply --changes writes: courier moves, new deliveries, completions
+   and deletes with tombstones.
+4. Time a warm start: decode, load_state, then since-listeners that
+   catch up on the changes.
+5. Check that the warm view equals a fresh full start.
+
+It reports time to ready and documents read for both starts. The
+stand-in has no network, so on it the document count is the figure that
+carries over; against Firestore, time to ready is dominated by streaming
+those documents. --firestore skips steps 3 and 5 and writes nothing.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import random
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# The benchmark drives its own views; keep them from re-attaching mid-run
+os.environ.setdefault("ACTIVE_VIEW_REBASE_SECONDS", "0")
+
+from active_view import ActiveDeliveryView  # noqa: E402
+from delta_sync import TOMBSTONE_COLLECTION  # noqa: E402
+from fleet_snapshot import decode, encode  # noqa: E402
+from firestore_standin import MemoryFirestore  # noqa: E402
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP  # noqa: E402
+
+
+def _point():
+    return {"lat": 43.65 + random.gauss(0, 0.05), "lng": -79.38 + random.gauss(0, 0.05)}
+
+
+def populate(store, couriers, active, finished):
+    couriers_ids = [f"courier{i}" for i in range(couriers)]
+    for start in range(0, couriers, 500):
+        batch = store.batch()
+        for uid in couriers_ids[start:start + 500]:
+            batch.set(store.collection("courier_locations").document(uid),
+                      {**_point(), "timestamp": SERVER_TIMESTAMP})
+        batch.commit()
+    for start in range(0, active + finished, 500):
+        batch = store.batch()
+        for n in range(start, min(start + 500, active + finished)):
+            status = random.choice(["pending", "accepted", "in_progress"]) if n < active else "completed"
+            batch.set(store.collection("deliveries").document(f"d{n}"), {
+                "pickupLocation": _point(), "dropoffLocation": _point(),
+                "pickupAddress": "1 Front St", "dropoffAddress": "2 King St",
+                "status": status, "createdBy": f"business{n % 300}",
+                "assignedCourier": None if status == "pending" else random.choice(couriers_ids),
+                "fee": 7.5, "timestampCreated": SERVER_TIMESTAMP, "timestampUpdated": SERVER_TIMESTAMP,
+            })
+        batch.commit()
+    return couriers_ids
+
+
+def apply_changes(store, n, couriers_ids, active):
+    for i in range(n):
+        kind = random.random()
+        if kind < 0.6:
+            store.collection("courier_locations").document(random.choice(couriers_ids)).set(
+                {**_point(), "timestamp": SERVER_TIMESTAMP})
+        elif kind < 0.75:
+            store.collection("deliveries").document(f"new{i}").set({
+                "pickupLocation": _point(), "dropoffLocation": _point(), "status": "pending",
+                "createdBy": "business1", "assignedCourier": None, "fee": 7.5,
+                "timestampCreated": SERVER_TIMESTAMP, "timestampUpdated": SERVER_TIMESTAMP,
+            })
+        elif kind < 0.95:
+            ref = store.collection("deliveries").document(f"d{random.randrange(active)}")
+            if ref.get().exists:
+                ref.update({"status": "completed", "timestampUpdated": SERVER_TIMESTAMP})
+        else:
+            delivery_id = f"d{random.randrange(active)}"
+            batch = store.batch()
+            batch.delete(store.collection("deliveries").document(delivery_id))
+            batch.set(store.collection(TOMBSTONE_COLLECTION).document(delivery_id),
+                      {"timestampDeleted": SERVER_TIMESTAMP})
+            batch.commit()
+
+
+def _reads(db):
+    return getattr(db, "counters", {}).get("reads")
+
+
+def timed_start(db, view, timeout=600.0):
+    """Start `view` and wait until ready: (seconds, initial events, stand-in documents read)."""
+    reads = _reads(db)
+    started = time.perf_counter()
+    view.start(db)
+    while not view.ready:
+        if time.perf_counter() - started > timeout:
+            raise TimeoutError("view not ready")
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    after = _reads(db)
+    return elapsed, view.startup["catch_up_events"], (after - reads) if reads is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--couriers", type=int, default=2000)
+    parser.add_argument("--active", type=int, default=10000, help="pending/accepted/in_progress deliveries")
+    parser.add_argument("--finished", type=int, default=50000, help="completed deliveries (not in the view)")
+    parser.add_argument("--changes", type=int, default=1000, help="writes between snapshot and warm start")
+    parser.add_argument("--firestore", action="store_true", help="read-only run against the real project")
+    args = parser.parse_args()
+
+    if args.firestore:
+        from firebase_init import get_db
+        db = get_db()
+    else:
+        db = MemoryFirestore()
+        random.seed(7)
+        couriers_ids = populate(db, args.couriers, args.active, args.finished)
+
+    full = ActiveDeliveryView()
+    full_s, full_events, full_reads = timed_start(db, full)
+
+    t = time.perf_counter()
+    blob = encode(full.export_state())
+    encode_ms = (time.perf_counter() - t) * 1000
+    full.stop()
+
+    if not args.firestore:
+        time.sleep(0.002)   # changes get later timestamps than the snapshot's read times
+        apply_changes(db, args.changes, couriers_ids, args.active)
+
+    warm = ActiveDeliveryView()
+    t = time.perf_counter()
+    state = decode(blob)
+    warm.load_state(state["deliveries"], state["couriers"], state["since"])
+    load_s = time.perf_counter() - t
+    catch_s, warm_events, warm_reads = timed_start(db, warm)
+
+    result = {
+        "store": "firestore" if args.firestore else "standin",
+        "view": {"deliveries": len(full._deliveries), "couriers": len(full._couriers)},
+        "snapshot": {"bytes": len(blob), "encode_ms": round(encode_ms, 1)},
+        "full_start": {"seconds_to_ready": round(full_s, 3), "initial_events": full_events,
+                       "documents_read": full_reads},
+        "warm_start": {"seconds_to_ready": round(load_s + catch_s, 3),
+                       "snapshot_load_seconds": round(load_s, 3),
+                       "catch_up_seconds": round(catch_s, 3),
+                       "initial_events": warm_events, "documents_read": warm_reads},
+    }
+    if not args.firestore:
+        check = ActiveDeliveryView()
+        timed_start(db, check)
+        result["warm_equals_full"] = (check._deliveries == warm._deliveries
+                                      and check._couriers == warm._couriers
+                                      and check._by_courier == warm._by_courier)
+        check.stop()
+    warm.stop()
+    print(json.dumps(result, indent=2, default=lambda o: o.isoformat() if isinstance(o, dt.datetime) else str(o)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# bench/bench_serving.py
+"""
+Compare the threaded Flask + standalone WS server setup with the ASGI mode.
+
+Start one setup, then point this script at it:
+
+    # current setup
+    python app.py
+    python bench/bench_serving.py --http http://127.0.0.1:5001 --ws ws://127.0.0.1:6789
+
+    # ASGI mode
+    uvicorn asgi:application --port 5001 --loop uvloop
+    python bench/bench_serving.py --http http://127.0.0.1:5001 --ws ws://127.0.0.1:5001/ws
+
+Reports per-request latency percentiles for each --path at the given
+concurrency, and how many WebSocket connections could be opened and
+registered (and how long a broadcast took to reach all of them).
+Authenticated paths need --token; write routes take --method/--json,
+e.g. --method PUT --path /updateDelivery/<id> --json '{"status": "in_progress"}'.
+Run before and after a change to compare per-route latency.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import aiohttp
+import websockets
+
+
+def _percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        "p50_ms": round(pick(0.50) * 1000, 2),
+        "p95_ms": round(pick(0.95) * 1000, 2),
+        "p99_ms": round(pick(0.99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 2),
+    }
+
+
+async def bench_http(base_url, path, token, requests, concurrency, method="GET", body=None):
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(None)
+
+    async def worker(session):
+        nonlocal errors
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                async with session.request(method, base_url + path,
+                                           headers=headers, json=body) as resp:
+                    await resp.read()
+                    if resp.status >= 500:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "method": method,
+        "path": path,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        **_percentiles(latencies),
+    }
+
+
+async def bench_ws(ws_url, http_url, connections, batch):
+    """Open `connections` sockets (in batches), register each, then time one broadcast."""
+    sockets, failed = [], 0
+    start = time.perf_counter()
+    for offset in range(0, connections, batch):
+        async def connect(i):
+            ws = await websockets.connect(ws_url, open_timeout=30, ping_interval=None)
+            await ws.send(json.dumps({"type": "register", "uid": f"bench-{i}"}))
+            return ws
+        results = await asyncio.gather(
+            *(connect(i) for i in range(offset, min(offset + batch, connections))),
+            return_exceptions=True,
+        )
+        for r in results:
+            if isinstance(r, Exception):
+                failed += 1
+            else:
+                sockets.append(r)
+    connect_seconds = time.perf_counter() - start
+
+    # Fan-out latency: time from the broadcast request to the last socket receiving it
+    fanout = None
+    if sockets:
+        async def first_message(ws):
+            await ws.recv()
+            return time.perf_counter()
+        waiters = [asyncio.create_task(first_message(ws)) for ws in sockets]
+        sent_at = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            await session.post(http_url + "/internal/ws/broadcast",
+                               json={"message": {"event": "bench"}})
+        done, pending = await asyncio.wait(waiters, timeout=30)
+        for t in pending:
+            t.cancel()
+        arrivals = [t.result() - sent_at for t in done if not t.exception()]
+        fanout = {"received": len(arrivals), **_percentiles(arrivals)}
+
+    for ws in sockets:
+        await ws.close()
+
+    return {
+        "requested": connections,
+        "open": len(sockets),
+        "failed": failed,
+        "connect_seconds": round(connect_seconds, 2),
+        "broadcast": fanout,
+    }
+
+
+async def main(args):
+    report = {"http": [], "ws": None}
+    for path in args.path:
+        report["http"].append(
+            await bench_http(args.http, path, args.token, args.requests, args.concurrency,
+                             args.method, args.json)
+        )
+    if args.ws and args.connections:
+        report["ws"] = await bench_ws(args.ws, args.http, args.connections, args.batch)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--http", default="http://127.0.0.1:5001")
+    parser.add_argument("--ws", default=None, help="WebSocket URL (omit to skip)")
+    parser.add_argument("--path", action="append", default=None,
+                        help="path to time (repeatable, default /health)")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--json", type=json.loads, default=None,
+                        help='request body, e.g. \'{"status": "in_progress"}\'')
+    parser.add_argument("--token", default=None, help="Firebase ID token for protected paths")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=200, help="sockets opened concurrently")
+    args = parser.parse_args()
+    args.path = args.path or ["/health"]
+    asyncio.run(main(args))
@@ -0,0 +1,101 @@
+# bench/bench_startup.py
+"""
+Measure API cold start and worker memory.
+
+    python bench/bench_startup.py import          # time `import app` in fresh interpreters
+    python bench/bench_startup.py gunicorn        # boot gunicorn, time until /health answers
+
+`import` reports wall time and peak RSS of importing the app module with
+the given environment (e.g. ENABLE_SWAGGER=0 to compare). `gunicorn`
+starts `gunicorn -c gunicorn.conf.py app:app` on a spare port, reports the
+time until /health returns 200 and the RSS of the master and each worker,
+then shuts it down gracefully.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_IMPORT_PROBE = """
+import resource, time
+t = time.perf_counter()
+import app
+elapsed = time.perf_counter() - t
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def _rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return None
+
+
+def bench_import(runs):
+    times, rss = [], []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", _IMPORT_PROBE],
+            cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+        ).stdout.split()
+        times.append(float(out[-2]))
+        rss.append(int(out[-1]))
+    return {
+        "runs": runs,
+        "import_ms_median": round(statistics.median(times) * 1000, 1),
+        "import_ms_min": round(min(times) * 1000, 1),
+        "peak_rss_kb_median": int(statistics.median(rss)),
+    }
+
+
+def bench_gunicorn(port, timeout):
+    env = dict(os.environ, GUNICORN_BIND=f"127.0.0.1:{port}", GUNICORN_ACCESSLOG="")
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        ["gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    ready = None
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as r:
+                    if r.status == 200:
+                        ready = time.perf_counter() - start
+                        break
+            except OSError:
+                time.sleep(0.05)
+        children = subprocess.run(
+            ["pgrep", "-P", str(proc.pid)], capture_output=True, text=True
+        ).stdout.split()
+        return {
+            "ready_seconds": round(ready, 3) if ready is not None else None,
+            "master_rss_kb": _rss_kb(proc.pid),
+            "worker_rss_kb": [_rss_kb(int(pid)) for pid in children],
+        }
+    finally:
+        proc.terminate()   # SIGTERM: graceful shutdown
+        proc.wait(timeout=60)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("what", choices=["import", "gunicorn"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+    if args.what == "import":
+        result = bench_import(args.runs)
+    else:
+        result = bench_gunicorn(args.port, args.timeout)
+    print(json.dumps(result, indent=2))
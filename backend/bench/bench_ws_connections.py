@@ -0,0 +1,165 @@
+# bench/bench_ws_connections.py
+"""
+Hold tens of thousands of idle WebSocket connections and measure what they cost.
+
+    # server (standalone WS server next to the REST API)
+    ulimit -n 200000
+    WS_MAX_CONNECTIONS=120000 python app.py
+    # load (same or another host)
+    ulimit -n 200000
+    python bench/bench_ws_connections.py --connections 50000 --procs 8 \\
+        --source-ips 127.0.0.2,127.0.0.3
+
+    # ASGI mode
+    python bench/bench_ws_connections.py --ws ws://127.0.0.1:5001/ws ...
+
+Opens --connections sockets spread over --procs client processes, registers
+each one under its own uid and keeps it idle. It reads the server's RSS from
+/internal/metrics (sending ADMIN_TOKEN from the environment) before and
+after, which gives memory per connection, and
+then sends --broadcasts probes through /internal/ws/broadcast. Every client
+timestamps the probe it receives, so fan-out latency percentiles cover the
+time to reach every socket. Run with --no-compression to compare against
+permessage-deflate.
+
+Limits to raise first, on both ends:
+  - open files: `ulimit -n` (the server raises its soft limit to the hard one)
+  - ephemeral ports: one client IP reaches ~28k sockets to a single server
+    port. Either widen net.ipv4.ip_local_port_range or pass several
+    loopback --source-ips (on Linux all of 127.0.0.0/8 is local).
+  - net.core.somaxconn for the accept backlog (WS_BACKLOG)
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import statistics
+import time
+
+import requests
+import websockets
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def _client(url, uid, local_addr, latencies, opened):
+    kwargs = {"local_addr": (local_addr, 0)} if local_addr else {}
+    try:
+        ws = await websockets.connect(url, open_timeout=60, ping_interval=None, **kwargs)
+    except Exception:
+        return
+    opened.append(ws)
+    await ws.send(json.dumps({"type": "register", "uid": uid}))
+    try:
+        async for raw in ws:
+            msg = json.loads(raw)
+            if msg.get("event") == "load_probe":
+                latencies.setdefault(msg["n"], []).append(time.time() - msg["sent_at"])
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def _worker_main(proc, count, args, ready, done, results):
+    url = args.ws
+    if args.no_compression:
+        url += ("&" if "?" in url else "?") + "compression=0"
+    source_ips = args.source_ips.split(",") if args.source_ips else [None]
+    latencies, opened, tasks = {}, [], []
+    for start in range(0, count, args.batch):
+        for i in range(start, min(start + args.batch, count)):
+            uid = f"load-{proc}-{i}"
+            tasks.append(asyncio.ensure_future(
+                _client(url, uid, source_ips[i % len(source_ips)], latencies, opened)))
+        # Let each batch finish its handshakes before starting the next
+        while len(opened) < min(start + args.batch, count) and not all(t.done() for t in tasks):
+            await asyncio.sleep(0.05)
+    ready.put(len(opened))
+    while not done.is_set():
+        await asyncio.sleep(0.2)
+    results.put(latencies)
+    for ws in opened:
+        await ws.close()
+
+
+def _worker(proc, count, args, ready, done, results):
+    asyncio.run(_worker_main(proc, count, args, ready, done, results))
+
+
+def _ws_metrics(http):
+    # /internal/metrics needs the server's ADMIN_TOKEN
+    headers = {"X-Admin-Token": os.environ.get("ADMIN_TOKEN", "")}
+    return requests.get(f"{http}/internal/metrics", headers=headers, timeout=10).json().get("ws", {})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--http", default="http://127.0.0.1:5001")
+    parser.add_argument("--ws", default="ws://127.0.0.1:6789")
+    parser.add_argument("--connections", type=int, default=10_000)
+    parser.add_argument("--procs", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=500, help="handshakes in flight per process")
+    parser.add_argument("--source-ips", default=None, help="comma-separated local addresses to spread over")
+    parser.add_argument("--no-compression", action="store_true")
+    parser.add_argument("--broadcasts", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between broadcasts")
+    args = parser.parse_args()
+
+    before = _ws_metrics(args.http)
+    ready, results, done = mp.Queue(), mp.Queue(), mp.Event()
+    per_proc = [args.connections // args.procs + (1 if p < args.connections % args.procs else 0)
+                for p in range(args.procs)]
+    t0 = time.perf_counter()
+    procs = [mp.Process(target=_worker, args=(p, n, args, ready, done, results), daemon=True)
+             for p, n in enumerate(per_proc)]
+    for p in procs:
+        p.start()
+    opened = sum(ready.get() for _ in procs)
+    connect_s = time.perf_counter() - t0
+    time.sleep(max(args.interval, 2.0))   # let registrations land
+    after = _ws_metrics(args.http)
+
+    growth = (after.get("rss_bytes") or 0) - (before.get("rss_bytes") or 0)
+    added = (after.get("connections") or 0) - (before.get("connections") or 0)
+    print(f"opened {opened}/{args.connections} sockets in {connect_s:.1f}s "
+          f"({'no compression' if args.no_compression else 'deflate offered'})")
+    print(f"server: {after.get('connections')} connections, {after.get('users')} users, "
+          f"rss {after.get('rss_bytes', 0) / 2**20:.0f} MiB")
+    if added > 0:
+        print(f"memory per connection: {growth / added / 1024:.1f} KiB "
+              f"(rss +{growth / 2**20:.0f} MiB for {added} sockets)")
+
+    for n in range(args.broadcasts):
+        requests.post(f"{args.http}/internal/ws/broadcast", timeout=30, json={
+            "message": {"event": "load_probe", "n": n, "sent_at": time.time()}})
+        time.sleep(args.interval)
+    done.set()
+
+    latencies = {}
+    for _ in procs:
+        for n, values in results.get().items():
+            latencies.setdefault(n, []).extend(values)
+    for p in procs:
+        p.join(timeout=30)
+
+    print(f"{'probe':>5} {'reached':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for n in range(args.broadcasts):
+        values = latencies.get(n, [])
+        if not values:
+            print(f"{n:>5} {0:>8}")
+            continue
+        print(f"{n:>5} {len(values):>8} {_percentile(values, 50) * 1000:>8.1f} "
+              f"{_percentile(values, 99) * 1000:>8.1f} {max(values) * 1000:>8.1f}")
+    all_values = [v for values in latencies.values() for v in values]
+    if all_values:
+        print(f"all probes: median {statistics.median(all_values) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+# bench/firestore_standin.py
+"""
+In-memory stand-in for the Firestore client, for replays and benchmarks.
+
+    from firebase_init import use_db
+    use_db(MemoryFirestore())      # every `from firebase_init import db` now reads it
+
+It covers the calls the dispatch path makes:
+- collection/document references, get/set(merge)/update/delete
+- batches, which commit atomically, with write_option(last_update_time=)
+  preconditions on update/delete
+- get_all
+- queries with where (==, !=, <, <=, >, >=, in, not-in,
+  array-contains), order_by and limit
+- on_snapshot on collections and queries
+- SERVER_TIMESTAMP, DELETE_FIELD, Increment and ArrayUnion/ArrayRemove
+  field values
+
+Listeners are called synchronously after each commit, in commit order,
+with (docs, changes, read_time). Only the first call carries the full
+result in `docs`. Later calls pass the changed documents, which is all
+the listeners in this repo read. Transactions, aggregation queries,
+cursors and select() are not implemented.
+"""
+import copy
+import datetime as dt
+import threading
+import uuid
+from types import SimpleNamespace
+
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore_v1 import DELETE_FIELD, SERVER_TIMESTAMP
+from google.cloud.firestore_v1.transforms import ArrayRemove, ArrayUnion, Increment
+
+_ADDED, _MODIFIED, _REMOVED = (SimpleNamespace(name=n) for n in ("ADDED", "MODIFIED", "REMOVED"))
+
+_OPS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a is not None and a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+    "not-in": lambda a, b: a is not None and a not in b,
+    "array-contains": lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+def _get_path(data: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+def _resolve(old, value, now):
+    """Apply a field transform (or copy a plain value) against the stored value."""
+    if value is SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, Increment):
+        return (old if isinstance(old, (int, float)) else 0) + value.value
+    if isinstance(value, ArrayUnion):
+        base = list(old) if isinstance(old, list) else []
+        return base + [v for v in value.values if v not in base]
+    if isinstance(value, ArrayRemove):
+        return [v for v in (old if isinstance(old, list) else []) if v not in value.values]
+    if isinstance(value, dict):
+        return {k: _resolve(None, v, now) for k, v in value.items() if v is not DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _merge(target: dict, data: dict, now) -> None:
+    for key, value in data.items():
+        if value is DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value, now)
+        else:
+            target[key] = _resolve(target.get(key), value, now)
+
+
+def _update_paths(target: dict, data: dict, now) -> None:
+    """update(): keys are field paths ("counts.pending"), values replace whole fields."""
+    for path, value in data.items():
+        *parents, leaf = path.split(".")
+        node = target
+        for part in parents:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        if value is DELETE_FIELD:
+            node.pop(leaf, None)
+        else:
+            node[leaf] = _resolve(node.get(leaf), value, now)
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return _get_path(self._data or {}, field_path)
+
+
+class Watch:
+    def __init__(self, store, query, callback):
+        self._store, self.query, self.callback = store, query, callback
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+        self._store._unwatch(self)
+
+
+class Query:
+    def __init__(self, store, collection, filters=(), orders=(), limit_=None):
+        self._store = store
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit_
+
+    def _copy(self, **changes):
+        args = {"filters": self._filters, "orders": self._orders, "limit_": self._limit, **changes}
+        return Query(self._store, self._collection, **args)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in _OPS:
+            raise NotImplementedError(f"where op {op_string!r}")
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction == "DESCENDING"),))
+
+    def limit(self, count):
+        return self._copy(limit_=count)
+
+    def matches(self, collection, data) -> bool:
+        return collection == self._collection and data is not None and all(
+            _OPS[op](_get_path(data, field), value) for field, op, value in self._filters)
+
+    def stream(self, transaction=None):
+        return iter(self.get())
+
+    def get(self, transaction=None):
+        with self._store._lock:
+            docs = self._store._docs.get(self._collection, {})
+            hits = [(doc_id, data) for doc_id, data in docs.items() if self.matches(self._collection, data)]
+            snaps = [self._store._snapshot(self._collection, doc_id, data) for doc_id, data in hits]
+        for field, descending in reversed(self._orders):
+            if field == "__name__":
+                snaps.sort(key=lambda s: s.id, reverse=descending)
+            else:
+                snaps.sort(key=lambda s: (s._data.get(field) is not None, s._data.get(field)),
+                           reverse=descending)
+        return snaps[:self._limit] if self._limit is not None else snaps
+
+    def on_snapshot(self, callback):
+        return self._store._watch(self, callback)
+
+
+class CollectionReference(Query):
+    def __init__(self, store, name):
+        super().__init__(store, name)
+        self.id = name
+
+    def document(self, document_id=None):
+        return DocumentReference(self._store, self._collection, document_id or uuid.uuid4().hex[:20])
+
+
+class DocumentReference:
+    def __init__(self, store, collection, document_id):
+        self._store = store
+        self._collection = collection
+        self.id = document_id
+        self.path = f"{collection}/{document_id}"
+
+    def get(self, field_paths=None, transaction=None):
+        with self._store._lock:
+            data = self._store._docs.get(self._collection, {}).get(self.id)
+            return self._store._snapshot(self._collection, self.id, data)
+
+    def set(self, document_data, merge=False):
+        batch = self._store.batch()
+        batch.set(self, document_data, merge=merge)
+        batch.commit()
+
+    def update(self, field_updates, option=None):
+        batch = self._store.batch()
+        batch.update(self, field_updates, option=option)
+        batch.commit()
+
+    def delete(self, option=None):
+        batch = self._store.batch()
+        batch.delete(self, option=option)
+        batch.commit()
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class WriteBatch:
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("set", reference, document_data, merge, None))
+        return self
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(("update", reference, field_updates, False, option))
+        return self
+
+    def delete(self, reference, option=None):
+        self._writes.append(("delete", reference, None, False, option))
+        return self
+
+    def commit(self):
+        return self._store._commit(self._writes)
+
+
+class MemoryFirestore:
+    """The Client surface used by the dispatch path, backed by dicts."""
+
+    def __init__(self):
+        self._docs = {}          # collection -> {doc id: data}
+        self._times = {}         # (collection, doc id) -> update time
+        self._watches = []
+        # One reentrant lock covers a commit and its listener calls, so
+        # listeners see commits in order and may read the store
+        self._lock = threading.RLock()
+        self.counters = {"commits": 0, "writes": 0, "reads": 0}
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def document(self, path):
+        collection, document_id = path.split("/", 1)
+        return DocumentReference(self, collection, document_id)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    @staticmethod
+    def write_option(last_update_time=None):
+        return SimpleNamespace(last_update_time=last_update_time)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        for ref in references:
+            yield ref.get()
+
+    def _snapshot(self, collection, doc_id, data):
+        self.counters["reads"] += 1
+        return DocumentSnapshot(DocumentReference(self, collection, doc_id),
+                                data, self._times.get((collection, doc_id)))
+
+    def _commit(self, writes):
+        with self._lock:
+            now = dt.datetime.now(dt.timezone.utc)
+            for kind, ref, data, merge, option in writes:
+                if option is not None and self._times.get((ref._collection, ref.id)) != option.last_update_time:
+                    raise FailedPrecondition(f"{ref.path} was updated since it was read")
+            touched = {}
+            for kind, ref, data, merge, option in writes:
+                docs = self._docs.setdefault(ref._collection, {})
+                key = (ref._collection, ref.id)
+                if key not in touched:
+                    old = docs.get(ref.id)
+                    touched[key] = copy.deepcopy(old) if old is not None else None
+                if kind == "delete":
+                    docs.pop(ref.id, None)
+                elif kind == "update":
+                    if ref.id not in docs:
+                        raise KeyError(f"No document to update: {ref.path}")
+                    _update_paths(docs[ref.id], data, now)
+                elif merge and ref.id in docs:
+                    _merge(docs[ref.id], data, now)
+                else:
+                    docs[ref.id] = _resolve(None, data, now)
+                self._times[key] = now
+            self.counters["commits"] += 1
+            self.counters["writes"] += len(writes)
+            self._notify(touched, now)
+            return [SimpleNamespace(update_time=now) for _ in writes]
+
+    def _notify(self, touched, read_time):
+        for watch in list(self._watches):
+            changes = []
+            for (collection, doc_id), before in touched.items():
+                after = self._docs.get(collection, {}).get(doc_id)
+                was, now_in = watch.query.matches(collection, before), watch.query.matches(collection, after)
+                if not was and not now_in:
+                    continue
+                kind = _REMOVED if was and not now_in else _MODIFIED if was else _ADDED
+                snap = self._snapshot(collection, doc_id, after if now_in else before)
+                changes.append(SimpleNamespace(type=kind, document=snap))
+            if changes:
+                watch.callback([c.document for c in changes], changes, read_time)
+
+    def _watch(self, query, callback):
+        with self._lock:
+            watch = Watch(self, query, callback)
+            self._watches.append(watch)
+            docs = query.get()
+            callback(docs, [SimpleNamespace(type=_ADDED, document=d) for d in docs],
+                     dt.datetime.now(dt.timezone.utc))
+            return watch
+
+    def _unwatch(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
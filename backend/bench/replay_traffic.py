@@ -0,0 +1,281 @@
+# bench/replay_traffic.py
+"""
+Replay captured dispatch traffic through the matcher against an in-memory store.
+
+    # capture in production (see traffic_capture.py)
+    TRAFFIC_CAPTURE_DIR=/var/capture TRAFFIC_CAPTURE_KEY=... gunicorn -c gunicorn.conf.py app:app
+    # replay a day at 20x, 8 matcher threads (like 8 Celery worker slots)
+    python bench/replay_traffic.py /var/capture --speed 20 --workers 8 --json before.json
+
+The files are merged in time order and fed at --speed times the captured
+rate. Use --speed 0 to feed as fast as the matcher keeps up.
+
+- Location fixes update courier_locations. By default only the fixes that
+  location_filter stored are replayed; --all-fixes replays every one.
+- A new delivery is written as pending and match_and_assign_courier is
+  queued for it.
+- Status updates are applied to the delivery. A completed delivery
+  queues a rematch of everything still pending, as /updateDelivery does.
+
+Storage is bench/firestore_standin.py, installed with
+firebase_init.use_db(), so the task code runs unchanged. The active view
+runs on the stand-in's listeners, as in a worker (ACTIVE_VIEW=0 tests the
+direct-query path). The Redis pending index and WS notifications are not
+part of the replay. Distances come from DISTANCE_PROVIDER; point it at
+bench/routing_standin.py to include routing latency.
+
+Reported:
+- latency: wall time from queueing a delivery to its assignment commit
+- throughput: events fed and matches run per wall second
+- quality: km from the assigned courier to the pickup, assigned share,
+  time to assignment in captured seconds, and couriers used
+
+Compare matcher changes by replaying the same capture on both versions.
+"""
+import argparse
+import glob
+import heapq
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from firestore_standin import MemoryFirestore  # noqa: E402
+from geo import haversine_km  # noqa: E402
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def _summary(values, scale=1.0, digits=1):
+    if not values:
+        return None
+    return {
+        "p50": round(_percentile(values, 50) * scale, digits),
+        "p95": round(_percentile(values, 95) * scale, digits),
+        "p99": round(_percentile(values, 99) * scale, digits),
+        "max": round(max(values) * scale, digits),
+    }
+
+
+def _read_capture(path):
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if isinstance(record, list):   # skip the header object
+                yield record
+
+
+def load_events(paths):
+    """All events of the given files/directories, merged by time (each file is already ordered)."""
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, "capture-*.jsonl")))
+                     if os.path.isdir(path) else [path])
+    return heapq.merge(*(_read_capture(f) for f in files), key=lambda r: r[0])
+
+
+class Replay:
+    def __init__(self, store, tasks, workers: int, speed: float, all_fixes: bool):
+        self.store = store
+        self.tasks = tasks
+        self.speed = speed
+        self.all_fixes = all_fixes
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="matcher")
+        self.lock = threading.Lock()
+        self.positions = {}          # courier -> (lat, lng)
+        self.pickups = {}            # delivery -> (lat, lng)
+        self.created = {}            # delivery -> (wall time queued, capture time)
+        self.assigned = {}           # delivery -> courier
+        self.latency, self.match_seconds, self.pickup_km, self.wait_capture = [], [], [], []
+        self.feeder_lag = []
+        self.counts = {"loc": 0, "new": 0, "status": 0, "skipped_status": 0, "matches": 0, "errors": 0}
+
+    # -- matcher side -----------------------------------------------------
+
+    def _match(self, delivery_id, capture_t, submitted):
+        start = time.perf_counter()
+        # The task's undecorated function: Task.__call__ keeps a request stack
+        # that isn't safe to share between threads
+        result = self.tasks.match_and_assign_courier.run(delivery_id)
+        end = time.perf_counter()
+        courier = result.get("assignedCourier") if isinstance(result, dict) else None
+        with self.lock:
+            self.counts["matches"] += 1
+            self.match_seconds.append(end - start)
+            if isinstance(result, dict) and "error" in result:
+                self.counts["errors"] += 1
+            if courier and delivery_id not in self.assigned:
+                self.assigned[delivery_id] = courier
+                queued, created_t = self.created[delivery_id]
+                self.latency.append(end - queued)
+                # Captured time until the queueing event, plus queue and run time scaled back
+                self.wait_capture.append(max(capture_t - created_t, 0.0) + (end - submitted) * self.speed)
+                if courier in self.positions:
+                    self.pickup_km.append(haversine_km(*self.positions[courier], *self.pickups[delivery_id]))
+
+    def _queue_match(self, delivery_id, capture_t):
+        future = self.pool.submit(self._match, delivery_id, capture_t, time.perf_counter())
+        future.add_done_callback(self._match_done)
+
+    def _match_done(self, future) -> None:
+        error = future.exception()
+        if error is None:
+            return
+        with self.lock:
+            self.counts["matches"] += 1
+            self.counts["errors"] += 1
+            if self.counts["errors"] <= 5:
+                print(f"match failed: {error!r}")
+
+    # -- feeding ----------------------------------------------------------
+
+    def apply(self, event) -> None:
+        t, kind = event[0], event[1]
+        if kind == "loc":
+            _, _, courier, lat, lng, accepted = event
+            self.counts["loc"] += 1
+            if accepted or self.all_fixes:
+                with self.lock:
+                    self.positions[courier] = (lat, lng)
+                self.store.collection("courier_locations").document(courier).set(
+                    {"lat": lat, "lng": lng, "timestamp": self.tasks.firestore.SERVER_TIMESTAMP})
+        elif kind == "new":
+            _, _, business, delivery_id, plat, plng, dlat, dlng, fee = event
+            self.counts["new"] += 1
+            self.pickups[delivery_id] = (plat, plng)
+            self.store.collection("deliveries").document(delivery_id).set({
+                "pickupLocation": {"lat": plat, "lng": plng},
+                "dropoffLocation": {"lat": dlat, "lng": dlng},
+                "status": "pending",
+                "createdBy": business,
+                "assignedCourier": None,
+                "fee": fee,
+                "timestampCreated": self.tasks.firestore.SERVER_TIMESTAMP,
+                "timestampUpdated": self.tasks.firestore.SERVER_TIMESTAMP,
+            })
+            self.created[delivery_id] = (time.perf_counter(), t)
+            self._queue_match(delivery_id, t)
+        elif kind == "status":
+            _, _, _courier, delivery_id, status = event
+            self.counts["status"] += 1
+            ref = self.store.collection("deliveries").document(delivery_id)
+            current = (ref.get().to_dict() or {}).get("status")
+            # The replayed matcher may not have assigned this delivery (yet)
+            if current is None or (current == "pending" and status != "cancelled"):
+                self.counts["skipped_status"] += 1
+                return
+            ref.update({"status": status, "timestampUpdated": self.tasks.firestore.SERVER_TIMESTAMP})
+            if status == "completed":
+                pending = self.store.collection("deliveries").where("status", "==", "pending").stream()
+                for snap in pending:
+                    self._queue_match(snap.id, t)
+
+    def run(self, events) -> float:
+        wall0 = capture0 = None
+        for event in events:
+            if wall0 is None:
+                wall0, capture0 = time.perf_counter(), event[0]
+            if self.speed:
+                due = wall0 + (event[0] - capture0) / self.speed
+                ahead = due - time.perf_counter()
+                if ahead > 0:
+                    time.sleep(ahead)
+                else:
+                    self.feeder_lag.append(-ahead)
+            self.apply(event)
+        self.pool.shutdown(wait=True)
+        return time.perf_counter() - (wall0 or time.perf_counter())
+
+
+def report(replay: Replay, wall: float, capture_span: float) -> dict:
+    pending = sum(1 for _ in replay.store.collection("deliveries").where("status", "==", "pending").stream())
+    new = replay.counts["new"]
+    km = replay.pickup_km
+    return {
+        "events": {k: replay.counts[k] for k in ("loc", "new", "status")},
+        "speed": replay.speed,
+        "capture_seconds": round(capture_span, 1),
+        "wall_seconds": round(wall, 2),
+        "throughput": {
+            "events_per_second": round(sum(replay.counts[k] for k in ("loc", "new", "status")) / wall, 1)
+            if wall else None,
+            "matches_per_second": round(replay.counts["matches"] / wall, 1) if wall else None,
+        },
+        "latency_ms": {
+            "assignment": _summary(replay.latency, 1000),
+            "match_run": _summary(replay.match_seconds, 1000, 2),
+            "feeder_lag": _summary(replay.feeder_lag, 1000),
+        },
+        "quality": {
+            "deliveries": new,
+            "assigned": len(replay.assigned),
+            "assigned_share": round(len(replay.assigned) / new, 3) if new else None,
+            "pending_at_end": pending,
+            "pickup_km": {"mean": round(statistics.fmean(km), 3), **_summary(km, 1, 3)} if km else None,
+            "time_to_assign_capture_seconds": _summary(replay.wait_capture),
+            "couriers_used": len(set(replay.assigned.values())),
+            "couriers_seen": len(replay.positions),
+        },
+        "matches": replay.counts["matches"],
+        "match_errors": replay.counts["errors"],
+        "status_skipped": replay.counts["skipped_status"],
+        "store": replay.store.counters,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+", help="capture files or directories")
+    parser.add_argument("--speed", type=float, default=10.0,
+                        help="multiple of the captured rate (1-100); 0 = no waiting")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent matcher runs")
+    parser.add_argument("--all-fixes", action="store_true",
+                        help="replay every location fix, not only the stored ones")
+    parser.add_argument("--limit", type=int, help="stop after this many events")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    store = MemoryFirestore()
+    from firebase_init import use_db
+    use_db(store)
+    from tasks import delivery_tasks
+    from active_view import active_view, start_active_view
+    # Side channels the replay leaves out (Redis index, HTTP notify)
+    delivery_tasks._unindex = lambda delivery_id: None
+    delivery_tasks._ws_notify = lambda uid, message: None
+    start_active_view(store)
+
+    events = list(load_events(args.captures))
+    if args.limit is not None:
+        events = events[:args.limit]
+    if not events:
+        sys.exit("no events in the given captures")
+    capture_span = events[-1][0] - events[0][0]
+    print(f"replaying {len(events)} events ({capture_span / 60:.1f} captured minutes) "
+          f"at {args.speed or 'max'}x with {args.workers} matcher threads")
+
+    replay = Replay(store, delivery_tasks, args.workers, args.speed, args.all_fixes)
+    wall = replay.run(events)
+    result = report(replay, wall, capture_span)
+    result["active_view"] = {k: active_view.stats()[k] for k in ("ready", "hits", "fallbacks", "events")}
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
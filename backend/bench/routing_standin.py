@@ -0,0 +1,86 @@
+# bench/routing_standin.py
+"""
+Local stand-in for an OSRM-compatible routing engine (the /table service).
+
+    python bench/routing_standin.py --port 5005 --latency-ms 40
+    DISTANCE_PROVIDER=routing ROUTING_URL=http://127.0.0.1:5005 python app.py
+
+Answers GET /table/v1/<profile>/<lng,lat;...>?sources=..&destinations=..
+with haversine distances times a detour factor, after an artificial
+per-request latency. --fail-rate makes some requests return 503 and
+--latency-ms above ROUTING_TIMEOUT_SECONDS exercises the timeout
+fallback. The API shape matches OSRM, so the same provider runs against
+a real engine by pointing ROUTING_URL at it.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geo import haversine_km_array  # noqa: E402
+
+
+def _indices(raw, n):
+    if not raw or raw == "all":
+        return list(range(n))
+    return [int(i) for i in raw.split(";")]
+
+
+def make_handler(latency_ms: float, detour: float, fail_rate: float):
+    class TableHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            url = urlsplit(self.path)   # not urlparse: it splits ";" off the path
+            parts = url.path.strip("/").split("/")
+            if len(parts) != 4 or parts[0] != "table":
+                return self._reply(404, {"code": "InvalidUrl"})
+            if random.random() < fail_rate:
+                return self._reply(503, {"code": "Unavailable"})
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            try:
+                coords = np.array([[float(v) for v in c.split(",")] for c in parts[3].split(";")])
+                sources = _indices(query.get("sources"), len(coords))
+                destinations = _indices(query.get("destinations"), len(coords))
+            except ValueError:
+                return self._reply(400, {"code": "InvalidQuery"})
+            src, dst = coords[sources], coords[destinations]   # (lng, lat)
+            km = haversine_km_array(src[:, 1, None], src[:, 0, None], dst[None, :, 1], dst[None, :, 0])
+            self._reply(200, {"code": "Ok", "distances": (km * 1000 * detour).round(1).tolist()})
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return TableHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=5005)
+    parser.add_argument("--latency-ms", type=float, default=30.0)
+    parser.add_argument("--detour", type=float, default=1.3, help="road km per straight-line km")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(("0.0.0.0", args.port),
+                                 make_handler(args.latency_ms, args.detour, args.fail_rate))
+    print(f"routing stand-in on :{args.port} ({args.latency_ms} ms, x{args.detour})")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 # celery_app.py
 
+import os
+
 from celery import Celery
+from celery.signals import worker_ready
 
 # Redis broker URL (default Redis on localhost, DB 0)
 REDIS_URL = "redis://localhost:6379/0"
@@ -17,5 +20,37 @@ celery.conf.update(
     task_serializer='json',
     accept_content=['json'],
     result_expires=3600,
-    timezone='UTC'
+    timezone='UTC',
+    beat_schedule={
+        # Rebuild the Redis pending-delivery index in case Redis lost data
+        'reconcile-pending-index': {
+            'task': 'delivery_tasks.reconcile_pending_index',
+            'schedule': float(os.environ.get('PENDING_RECONCILE_SECONDS', 300)),
+        },
+        # Tombstones behind /syncDeliveries, kept SYNC_TOMBSTONE_RETENTION_DAYS
+        'purge-delivery-tombstones': {
+            'task': 'delivery_tasks.purge_delivery_tombstones',
+            'schedule': 24 * 3600.0,
+        },
+        # Finished deliveries older than ARCHIVE_AFTER_DAYS -> deliveries_archive
+        'archive-finished-deliveries': {
+            'task': 'delivery_tasks.archive_finished_deliveries',
+            'schedule': float(os.environ.get('ARCHIVE_INTERVAL_SECONDS', 6 * 3600)),
+        },
+        # Fleet view snapshot that new workers warm-start from (fleet_snapshot.py)
+        'snapshot-fleet-state': {
+            'task': 'delivery_tasks.snapshot_fleet_state',
+            'schedule': float(os.environ.get('FLEET_SNAPSHOT_SECONDS', 60)),
+        },
+        # Incremental Parquet export behind the fleet KPIs (analytics.py)
+        'export-analytics': {
+            'task': 'delivery_tasks.export_analytics',
+            'schedule': float(os.environ.get('ANALYTICS_EXPORT_SECONDS', 3600)),
+        },
+    },
 )
+
+
+@worker_ready.connect
+def _reconcile_on_startup(sender=None, **kwargs):
+    sender.app.send_task('delivery_tasks.reconcile_pending_index')
@@ -0,0 +1,109 @@
+# change_feed.py
+
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Versions remembered per delivery/user before the least recently changed is dropped.
+CHANGE_FEED_MAX_KEYS = 100_000
+
+
+def delivery_ids_in(message: dict) -> set:
+    """Delivery ids an outgoing WS event refers to (all event shapes we send)."""
+    ids = set()
+    if message.get("delivery_id"):
+        ids.add(message["delivery_id"])
+    if isinstance(message.get("delivery"), dict) and message["delivery"].get("id"):
+        ids.add(message["delivery"]["id"])
+    for item in message.get("deliveries") or []:
+        if isinstance(item, dict) and item.get("id"):
+            ids.add(item["id"])
+    for item in message.get("assignments") or []:
+        if isinstance(item, dict) and item.get("delivery_id"):
+            ids.add(item["delivery_id"])
+    return ids
+
+
+class ChangeFeed:
+    """
+    Version counters for deliveries and users, with async waiters.
+
+    Fed by the same events WebSocketManager.send_to_user delivers, so a
+    long-polling client sees exactly what a socket client would. Versions
+    come from one process-wide counter: a client passes back the version
+    it last saw and is woken by the first change past it. Waiters are
+    futures on the serving event loop, so they hold no thread.
+    """
+
+    def __init__(self, max_keys: int = CHANGE_FEED_MAX_KEYS):
+        self.max_keys = max_keys
+        self.version = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._latest: "OrderedDict[tuple, tuple]" = OrderedDict()   # key -> (version, event)
+        self._waiters: dict = {}                                     # key -> set of futures
+        self._lock = threading.Lock()
+
+    def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+
+    def publish(self, uid: str, message: dict) -> None:
+        """Record a change for `uid` and every delivery it mentions; safe from any thread."""
+        keys = [("user", uid)] + [("delivery", d) for d in delivery_ids_in(message)]
+        with self._lock:
+            self.version += 1
+            version = self.version
+            for key in keys:
+                self._latest[key] = (version, message)
+                self._latest.move_to_end(key)
+            while len(self._latest) > self.max_keys:
+                self._latest.popitem(last=False)
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wake, keys, version, message)
+
+    def _wake(self, keys, version, message) -> None:
+        for key in keys:
+            for future in self._waiters.pop(key, ()):
+                if not future.done():
+                    future.set_result((version, message))
+
+    def latest(self, key: tuple, since: int) -> Optional[tuple]:
+        """(version, event) if `key` changed after `since`, else None."""
+        if since > self.version:
+            # Client's version is from before a restart: anything may have changed
+            return (self.version, None)
+        entry = self._latest.get(key)
+        if entry and entry[0] > since:
+            return entry
+        return None
+
+    async def wait(self, key: tuple, since: int, timeout: float) -> Optional[tuple]:
+        """
+        Return (version, event) as soon as `key` changes after `since`,
+        or None after `timeout` seconds. Must run on the attached loop.
+        """
+        ready = self.latest(key, since)
+        if ready:
+            return ready
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, set()).add(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    self._waiters.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "keys": len(self._latest),
+            "waiters": sum(len(w) for w in list(self._waiters.values())),
+        }
+
+
+change_feed = ChangeFeed()
@@ -0,0 +1,45 @@
+# concurrency.py
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared pool for blocking Firestore/Redis calls issued side by side.
+# Sized for I/O wait, not CPU.
+IO_POOL_THREADS = int(os.environ.get("IO_POOL_THREADS", 32))
+
+_pool = ThreadPoolExecutor(max_workers=IO_POOL_THREADS, thread_name_prefix="io")
+
+
+def gather(*calls):
+    """
+    Run independent zero-argument callables concurrently and return their
+    results in order. The first exception is re-raised after all calls
+    have finished, so no call is left running behind the caller's back.
+    """
+    if len(calls) == 1:
+        return [calls[0]()]
+    futures = [_pool.submit(call) for call in calls]
+    results, error = [], None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(None)
+            error = error or e
+    if error:
+        raise error
+    return results
+
+
+def get_all(db, refs, field_paths=None):
+    """
+    Read several documents in one round trip.
+    Returns {doc_id: snapshot} (missing documents have snapshot.exists False).
+    `field_paths` limits the fields read from each document.
+    """
+    refs = list(refs)
+    if not refs:
+        return {}
+    if field_paths is not None:
+        return {snap.id: snap for snap in db.get_all(refs, field_paths=field_paths)}
+    return {snap.id: snap for snap in db.get_all(refs)}
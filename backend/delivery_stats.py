@@ -0,0 +1,176 @@
+# delivery_stats.py
+"""
+Per-user delivery totals, kept current by the delivery write paths.
+
+delivery_stats/{uid} covers the deliveries a business created, or a
+courier was assigned:
+
+    counts.<status>    deliveries currently in that status
+    fees.<status>      sum of their fees
+    deliverySeconds    pickup -> delivered time, summed over completed
+    timedDeliveries    deliveries that went through in_progress
+    rebuiltAt          set by rebuild(); absent until the first rebuild
+
+Every path that creates, assigns, changes the status of or deletes a
+delivery adds the matching Increments to the same batch as the delivery
+write, so counters and deliveries commit together. A document without
+rebuiltAt only holds changes since the counters were introduced; read()
+rebuilds it from aggregation queries first. Archived deliveries (see
+archive.py) still count.
+
+Each write touches the stats document of both parties. Firestore
+sustains about one write per second per document, which is well above
+what a single business or courier generates (bulk creates are one
+increment per batch).
+"""
+import datetime as dt
+
+from google.cloud.firestore_v1 import Increment
+
+STATS_COLLECTION = "delivery_stats"
+STATUSES = ("pending", "accepted", "in_progress", "completed", "cancelled")
+# role -> delivery field naming that party
+PARTY_FIELDS = {"business": "createdBy", "courier": "assignedCourier"}
+
+
+def _bump(batch, db, uid, counts=None, fees=None, seconds=0.0, timed=0):
+    """Queue increments on delivery_stats/{uid}; counts/fees map status -> delta."""
+    if not uid:
+        return
+    update = {}
+    if counts:
+        update["counts"] = {s: Increment(n) for s, n in counts.items() if n}
+    if fees:
+        update["fees"] = {s: Increment(round(v, 2)) for s, v in fees.items() if v}
+    if timed:
+        update["deliverySeconds"] = Increment(round(seconds, 1))
+        update["timedDeliveries"] = Increment(timed)
+    if update:
+        batch.set(db.collection(STATS_COLLECTION).document(uid), update, merge=True)
+
+
+def _fee(delivery: dict) -> float:
+    return float(delivery.get("fee") or 0)
+
+
+def record_created(batch, db, uid: str, fees) -> None:
+    """New pending deliveries for business `uid` (one increment for a whole bulk create)."""
+    fees = [float(f or 0) for f in fees]
+    _bump(batch, db, uid, counts={"pending": len(fees)}, fees={"pending": sum(fees)})
+
+
+def record_assigned(batch, db, delivery: dict, courier_uid: str) -> None:
+    """A pending delivery was given to `courier_uid` (status becomes accepted)."""
+    fee = _fee(delivery)
+    old = delivery.get("status") or "pending"
+    _bump(batch, db, delivery.get("createdBy"),
+          counts={old: -1, "accepted": 1}, fees={old: -fee, "accepted": fee})
+    _bump(batch, db, courier_uid, counts={"accepted": 1}, fees={"accepted": fee})
+
+
+def record_status_change(batch, db, delivery: dict, new_status: str,
+                         delivery_seconds=None) -> None:
+    """`delivery` (as read before the write) moves to `new_status`."""
+    old = delivery.get("status") or "pending"
+    if old == new_status:
+        return
+    fee = _fee(delivery)
+    timed = 1 if delivery_seconds is not None else 0
+    for uid in {delivery.get("createdBy"), delivery.get("assignedCourier")}:
+        _bump(batch, db, uid, counts={old: -1, new_status: 1},
+              fees={old: -fee, new_status: fee}, seconds=delivery_seconds or 0.0, timed=timed)
+
+
+def record_deleted(batch, db, delivery: dict) -> None:
+    status = delivery.get("status") or "pending"
+    seconds = delivery.get("deliverySeconds")
+    timed = -1 if status == "completed" and seconds is not None else 0
+    for uid in {delivery.get("createdBy"), delivery.get("assignedCourier")}:
+        _bump(batch, db, uid, counts={status: -1}, fees={status: -_fee(delivery)},
+              seconds=-(seconds or 0.0), timed=timed)
+
+
+def delivery_seconds(picked_up, delivered=None):
+    """Seconds from pickup to delivery, or None if the pickup time is unknown."""
+    if not hasattr(picked_up, "timestamp"):
+        return None
+    delivered = delivered or dt.datetime.now(dt.timezone.utc)
+    return max((delivered - picked_up).total_seconds(), 0.0)
+
+
+def _aggregate(query, sums=(), avgs=()) -> dict:
+    """One aggregation round trip: count, plus sum_<field> / avg_<field> for each field."""
+    query = query.count(alias="count")
+    for field in sums:
+        query = query.sum(field, alias=f"sum_{field}")
+    for field in avgs:
+        query = query.avg(field, alias=f"avg_{field}")
+    return {r.alias: r.value for row in query.get() for r in row}
+
+
+def _collection_totals(db, collection: str, role: str, uid: str) -> dict:
+    from concurrency import gather
+
+    party = db.collection(collection).where(PARTY_FIELDS[role], "==", uid)
+    per_status = dict(zip(STATUSES, gather(*(
+        lambda s=s: _aggregate(party.where("status", "==", s), sums=("fee",))
+        for s in STATUSES
+    ))))
+    timed = _aggregate(party.where("status", "==", "completed"),
+                       sums=("deliverySeconds",), avgs=("deliverySeconds",))
+    seconds, avg = timed.get("sum_deliverySeconds") or 0, timed.get("avg_deliverySeconds")
+    return {
+        "counts": {s: int(r.get("count") or 0) for s, r in per_status.items()},
+        "fees": {s: float(r.get("sum_fee") or 0) for s, r in per_status.items()},
+        "deliverySeconds": float(seconds),
+        # avg skips deliveries without the field, so sum / avg counts the ones that have it
+        "timedDeliveries": int(round(seconds / avg)) if avg else 0,
+    }
+
+
+def rebuild(db, uid: str, role: str) -> dict:
+    """Recompute delivery_stats/{uid} from live and archived deliveries (aggregation queries only)."""
+    from archive import ARCHIVE_COLLECTION
+
+    live, archived = (_collection_totals(db, c, role, uid) for c in ("deliveries", ARCHIVE_COLLECTION))
+    doc = {
+        "counts": {s: live["counts"][s] + archived["counts"][s] for s in STATUSES},
+        "fees": {s: round(live["fees"][s] + archived["fees"][s], 2) for s in STATUSES},
+        "deliverySeconds": live["deliverySeconds"] + archived["deliverySeconds"],
+        "timedDeliveries": live["timedDeliveries"] + archived["timedDeliveries"],
+        "rebuiltAt": dt.datetime.now(dt.timezone.utc),
+    }
+    db.collection(STATS_COLLECTION).document(uid).set(doc)
+    return doc
+
+
+def read(db, uid: str, role: str) -> dict:
+    """The user's stats as served by /stats (rebuilding first if never rebuilt)."""
+    snap = db.collection(STATS_COLLECTION).document(uid).get()
+    doc = snap.to_dict() if snap.exists else None
+    if not doc or not doc.get("rebuiltAt"):
+        doc = rebuild(db, uid, role)
+    return summarize(doc, role)
+
+
+def summarize(doc: dict, role: str) -> dict:
+    counts = {s: max(int((doc.get("counts") or {}).get(s) or 0), 0) for s in STATUSES}
+    fees = {s: float((doc.get("fees") or {}).get(s) or 0) for s in STATUSES}
+    # Cancelled deliveries aren't paid, so they stay out of the fee totals
+    billable = sum(n for s, n in counts.items() if s != "cancelled")
+    billed = sum(v for s, v in fees.items() if s != "cancelled")
+    timed = int(doc.get("timedDeliveries") or 0)
+    rebuilt_at = doc.get("rebuiltAt")
+    return {
+        "role": role,
+        "counts": counts,
+        "total": sum(counts.values()),
+        "fees": {
+            "total": round(billed, 2),
+            "average": round(billed / billable, 2) if billable else None,
+            # A courier's earnings
+            "completed": round(fees["completed"], 2),
+        },
+        "averageDeliverySeconds": round(doc.get("deliverySeconds", 0) / timed) if timed > 0 else None,
+        "rebuiltAt": rebuilt_at.isoformat() if hasattr(rebuilt_at, "isoformat") else rebuilt_at,
+    }
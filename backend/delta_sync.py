@@ -0,0 +1,63 @@
+# delta_sync.py
+"""
+Sync tokens and tombstones for GET /syncDeliveries.
+
+A token is an opaque, URL-safe encoding of a Firestore read time. Every
+query of one sync runs at that same read time, so a write is either
+visible to the sync that issued the token or has a later timestampUpdated
+and is picked up by the next one. Nothing is missed or double-counted
+across the separate queries.
+
+/deleteDelivery leaves a tombstone in TOMBSTONE_COLLECTION. Tombstones
+older than SYNC_TOMBSTONE_RETENTION_DAYS are purged. A token older than
+that can't be served incrementally, so it gets a full resync.
+"""
+import base64
+import datetime as dt
+import os
+
+from google.cloud import firestore
+
+TOMBSTONE_COLLECTION = "deleted_deliveries"
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.environ.get("SYNC_TOMBSTONE_RETENTION_DAYS", 30))
+# Read slightly in the past so the read time is never ahead of Firestore's clock
+SYNC_READ_LAG_SECONDS = float(os.environ.get("SYNC_READ_LAG_SECONDS", 1.0))
+
+_TOKEN_PREFIX = "v1:"
+
+
+def encode_token(read_time: dt.datetime) -> str:
+    micros = int(read_time.timestamp() * 1_000_000)
+    raw = f"{_TOKEN_PREFIX}{micros}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_token(token: str) -> dt.datetime:
+    """Read time a token stands for; raises ValueError on a malformed token."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+    except Exception:
+        raise ValueError("malformed sync token")
+    if not raw.startswith(_TOKEN_PREFIX):
+        raise ValueError("unknown sync token version")
+    micros = int(raw[len(_TOKEN_PREFIX):])
+    return dt.datetime.fromtimestamp(micros / 1_000_000, tz=dt.timezone.utc)
+
+
+def sync_read_time() -> dt.datetime:
+    return dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=SYNC_READ_LAG_SECONDS)
+
+
+def token_expired(since: dt.datetime) -> bool:
+    """True if tombstones since `since` may already have been purged."""
+    cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=SYNC_TOMBSTONE_RETENTION_DAYS)
+    return since < cutoff
+
+
+def tombstone(delivery: dict) -> dict:
+    """Tombstone document for a deleted delivery (kept queryable by either party)."""
+    return {
+        "createdBy": delivery.get("createdBy"),
+        "assignedCourier": delivery.get("assignedCourier"),
+        "timestampDeleted": firestore.SERVER_TIMESTAMP,
+    }
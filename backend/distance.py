@@ -0,0 +1,264 @@
+# distance.py
+"""
+Distance providers for pricing and courier matching.
+
+    DISTANCE_PROVIDER=haversine   straight-line km (default, no I/O)
+    DISTANCE_PROVIDER=routing     road km from an OSRM-compatible /table
+                                  service at ROUTING_URL
+
+The routing provider batches many-to-many lookups into /table requests,
+caches results per (origin cell, destination cell) using geohashes, and
+falls back to haversine for any pair it can't get within
+ROUTING_TIMEOUT_SECONDS (only the pairs of a failed request; the other
+requests of the same lookup are still used). pairwise() requests only
+the uncached pairs. After a failure it skips the engine for
+ROUTING_BACKOFF_SECONDS, so a dead engine doesn't add its timeout to
+every request.
+
+For local development, bench/routing_standin.py serves the same API.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+import numpy as np
+import requests
+
+from concurrency import gather
+from geo import geohash, haversine_km_array
+
+DISTANCE_PROVIDER = os.environ.get("DISTANCE_PROVIDER", "haversine")
+ROUTING_URL = os.environ.get("ROUTING_URL", "http://127.0.0.1:5005")
+ROUTING_PROFILE = os.environ.get("ROUTING_PROFILE", "driving")
+ROUTING_TIMEOUT_SECONDS = float(os.environ.get("ROUTING_TIMEOUT_SECONDS", 0.5))
+ROUTING_BACKOFF_SECONDS = float(os.environ.get("ROUTING_BACKOFF_SECONDS", 30))
+# Coordinates per /table request (OSRM's default --max-table-size is 100)
+ROUTING_MAX_TABLE_SIZE = int(os.environ.get("ROUTING_MAX_TABLE_SIZE", 100))
+DISTANCE_CACHE_SIZE = int(os.environ.get("DISTANCE_CACHE_SIZE", 200_000))
+DISTANCE_CACHE_TTL_SECONDS = float(os.environ.get("DISTANCE_CACHE_TTL_SECONDS", 15 * 60))
+# Geohash length used to quantize cache keys (7 ~ 150 m cells)
+DISTANCE_GEOHASH_PRECISION = int(os.environ.get("DISTANCE_GEOHASH_PRECISION", 7))
+
+
+def _latlng(points: Sequence[dict]) -> np.ndarray:
+    return np.array([[float(p["lat"]), float(p["lng"])] for p in points],
+                    dtype=np.float64).reshape(-1, 2)
+
+
+class HaversineProvider:
+    """Straight-line distances; every other provider falls back to this."""
+
+    name = "haversine"
+
+    def matrix(self, origins: Sequence[dict], destinations: Sequence[dict]) -> np.ndarray:
+        """km from every origin (rows) to every destination (columns)."""
+        o, d = _latlng(origins), _latlng(destinations)
+        return haversine_km_array(o[:, 0, None], o[:, 1, None], d[None, :, 0], d[None, :, 1])
+
+    def pairwise(self, origins: Sequence[dict], destinations: Sequence[dict]) -> np.ndarray:
+        """km from origins[i] to destinations[i]."""
+        o, d = _latlng(origins), _latlng(destinations)
+        return haversine_km_array(o[:, 0], o[:, 1], d[:, 0], d[:, 1])
+
+    def stats(self) -> dict:
+        return {"provider": self.name}
+
+
+class DistanceCache:
+    """LRU of km by (origin cell, destination cell) with a TTL per entry."""
+
+    def __init__(self, max_entries: int = DISTANCE_CACHE_SIZE,
+                 ttl: float = DISTANCE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[tuple, tuple]" = OrderedDict()   # key -> (expires, km)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[float]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, km: float) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, km)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class RoutingProvider(HaversineProvider):
+    """Road distances from an OSRM-compatible table service, cached and with fallback."""
+
+    name = "routing"
+
+    def __init__(self, base_url: str = ROUTING_URL, profile: str = ROUTING_PROFILE,
+                 timeout: float = ROUTING_TIMEOUT_SECONDS, cache: Optional[DistanceCache] = None,
+                 precision: int = DISTANCE_GEOHASH_PRECISION):
+        self.base_url = base_url.rstrip("/")
+        self.profile = profile
+        self.timeout = timeout
+        self.cache = cache or DistanceCache()
+        self.precision = precision
+        self._session = requests.Session()
+        self._skip_until = 0.0
+        self.counters = {"requests": 0, "failures": 0, "fallback_pairs": 0}
+
+    def _cells(self, points: np.ndarray) -> List[str]:
+        return [geohash(lat, lng, self.precision) for lat, lng in points]
+
+    def _table(self, sources: np.ndarray, destinations: np.ndarray) -> np.ndarray:
+        """One /table call; km matrix with NaN where the engine has no route."""
+        coords = np.vstack([sources, destinations])
+        path = ";".join(f"{lng:.6f},{lat:.6f}" for lat, lng in coords)
+        n = len(sources)
+        params = {
+            "sources": ";".join(str(i) for i in range(n)),
+            "destinations": ";".join(str(i) for i in range(n, len(coords))),
+            "annotations": "distance",
+        }
+        self.counters["requests"] += 1
+        resp = self._session.get(f"{self.base_url}/table/v1/{self.profile}/{path}",
+                                 params=params, timeout=self.timeout)
+        resp.raise_for_status()
+        body = resp.json()
+        if body.get("code") != "Ok":
+            raise RuntimeError(f"routing engine: {body.get('code')} {body.get('message', '')}")
+        metres = np.array(body["distances"], dtype=np.float64)   # null -> nan
+        return metres / 1000.0
+
+    def _table_or_error(self, o: np.ndarray, d: np.ndarray):
+        try:
+            return self._table(o, d), None
+        except Exception as e:
+            return None, e
+
+    def _fetch(self, o: np.ndarray, d: np.ndarray, rows, cols, out: np.ndarray):
+        """
+        Fill out[rows x cols] from the engine: chunks that fit one table
+        request, sent side by side. A chunk that fails stays NaN (the
+        caller falls back for those cells only); returns the first error.
+        """
+        half = max(ROUTING_MAX_TABLE_SIZE // 2, 1)
+        blocks = []
+        for r0 in range(0, len(rows), half):
+            r = rows[r0:r0 + half]
+            width = ROUTING_MAX_TABLE_SIZE - len(r)
+            for c0 in range(0, len(cols), width):
+                blocks.append((r, cols[c0:c0 + width]))
+        results = gather(*(lambda r=r, c=c: self._table_or_error(o[r], d[c]) for r, c in blocks))
+        error = None
+        for (r, c), (km, e) in zip(blocks, results):
+            if e is None:
+                out[np.ix_(r, c)] = km
+            else:
+                error = error or e
+        return error
+
+    def _engine_failed(self, e: Exception) -> None:
+        self.counters["failures"] += 1
+        self._skip_until = time.time() + ROUTING_BACKOFF_SECONDS
+        print(f"[distance] routing engine unavailable for {ROUTING_BACKOFF_SECONDS:.0f}s, "
+              f"using haversine: {type(e).__name__}")
+
+    def matrix(self, origins: Sequence[dict], destinations: Sequence[dict]) -> np.ndarray:
+        o, d = _latlng(origins), _latlng(destinations)
+        o_cells, d_cells = self._cells(o), self._cells(d)
+        km = np.full((len(o), len(d)), np.nan)
+        for i, oc in enumerate(o_cells):
+            for j, dc in enumerate(d_cells):
+                cached = self.cache.get((oc, dc))
+                if cached is not None:
+                    km[i, j] = cached
+
+        missing = np.isnan(km)
+        if missing.any() and time.time() >= self._skip_until:
+            # Ask only for the rows/columns that have a miss
+            rows = np.flatnonzero(missing.any(axis=1))
+            cols = np.flatnonzero(missing.any(axis=0))
+            fetched = np.full_like(km, np.nan)
+            e = self._fetch(o, d, rows, cols, fetched)
+            if e is not None:
+                self._engine_failed(e)
+            fill = missing & ~np.isnan(fetched)
+            km[fill] = fetched[fill]
+            for i, j in zip(*np.nonzero(fill)):
+                self.cache.put((o_cells[i], d_cells[j]), float(km[i, j]))
+
+        missing = np.isnan(km)
+        if missing.any():
+            self.counters["fallback_pairs"] += int(missing.sum())
+            straight = haversine_km_array(o[:, 0, None], o[:, 1, None], d[None, :, 0], d[None, :, 1])
+            km[missing] = straight[missing]
+        return km
+
+    def pairwise(self, origins: Sequence[dict], destinations: Sequence[dict]) -> np.ndarray:
+        o, d = _latlng(origins), _latlng(destinations)
+        keys = list(zip(self._cells(o), self._cells(d)))
+        km = np.full(len(o), np.nan)
+        for i, key in enumerate(keys):
+            cached = self.cache.get(key)
+            if cached is not None:
+                km[i] = cached
+
+        missing = np.flatnonzero(np.isnan(km))
+        if len(missing) and time.time() >= self._skip_until:
+            # Only the uncached pairs, in square blocks whose diagonal holds
+            # them: one table request per block instead of one route request
+            # per pair (the off-diagonal cells are not used)
+            half = max(ROUTING_MAX_TABLE_SIZE // 2, 1)
+            blocks = [missing[i:i + half] for i in range(0, len(missing), half)]
+            results = gather(*(lambda b=b: self._table_or_error(o[b], d[b]) for b in blocks))
+            error = None
+            for b, (sub, e) in zip(blocks, results):
+                if e is not None:
+                    error = error or e
+                    continue
+                km[b] = np.diag(sub)
+                for i in b:
+                    if not np.isnan(km[i]):
+                        self.cache.put(keys[i], float(km[i]))
+            if error is not None:
+                self._engine_failed(error)
+
+        missing = np.isnan(km)
+        if missing.any():
+            self.counters["fallback_pairs"] += int(missing.sum())
+            km[missing] = haversine_km_array(o[missing, 0], o[missing, 1], d[missing, 0], d[missing, 1])
+        return km
+
+    def stats(self) -> dict:
+        return {
+            "provider": self.name,
+            "cache_entries": len(self.cache),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "engine_down": time.time() < self._skip_until,
+            **self.counters,
+        }
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_distance_provider():
+    """Process-wide provider chosen by DISTANCE_PROVIDER."""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = RoutingProvider() if DISTANCE_PROVIDER == "routing" else HaversineProvider()
+    return _provider
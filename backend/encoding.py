@@ -0,0 +1,116 @@
+# encoding.py
+"""
+Response and WebSocket frame encodings for mobile clients.
+
+REST: JSON responses are re-encoded as MessagePack when the client sends
+`Accept: application/msgpack`, and compressed with brotli or gzip (per
+`Accept-Encoding`) once the body is at least COMPRESS_MIN_BYTES.
+
+WebSocket: a client that offers the `msgpack` subprotocol gets binary
+MessagePack frames; everyone else gets JSON text frames. Frame
+compression is left to the servers' permessage-deflate.
+"""
+import gzip
+import json
+import os
+from typing import Optional
+
+import msgpack
+
+try:
+    import brotli
+except ImportError:   # optional (pip install brotli); gzip only without it
+    brotli = None
+
+# Bodies smaller than this go out uncompressed (headers + CPU outweigh the win).
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 5))
+
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack")
+WS_SUBPROTOCOLS = ("msgpack", "json")
+
+
+def pack(obj) -> bytes:
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def unpack(data: bytes):
+    return msgpack.unpackb(data, raw=False)
+
+
+def compress(body: bytes, coding: str) -> bytes:
+    if coding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def wants_msgpack(accept) -> bool:
+    """
+    `accept` is a werkzeug MIMEAccept. MessagePack only when named
+    explicitly (a bare */* keeps JSON) and not ranked below JSON.
+    """
+    q = max((q for value, q in accept if value in MSGPACK_MIMETYPES), default=0)
+    return q > 0 and q >= accept["application/json"]
+
+
+def content_coding(accept_encoding) -> Optional[str]:
+    """Best supported coding from a werkzeug Accept-Encoding header, or None."""
+    offered = ("br", "gzip") if brotli is not None else ("gzip",)
+    return accept_encoding.best_match(offered)
+
+
+def encode_response(response, request):
+    """
+    Flask after_request hook. Only touches successful, buffered JSON
+    bodies; everything else (304s, streams, HTML docs) passes through.
+    """
+    if (response.direct_passthrough or response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.headers.get("Content-Encoding")):
+        return response
+
+    changed = False
+    if response.mimetype == "application/json":
+        response.vary.add("Accept")
+        if wants_msgpack(request.accept_mimetypes):
+            response.set_data(pack(response.get_json()))
+            response.mimetype = "application/msgpack"
+            changed = True
+    elif response.mimetype not in MSGPACK_MIMETYPES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if response.content_length and response.content_length >= COMPRESS_MIN_BYTES:
+        coding = content_coding(request.accept_encodings)
+        if coding:
+            response.set_data(compress(response.get_data(), coding))
+            response.headers["Content-Encoding"] = coding
+            changed = True
+
+    if changed and response.get_etag()[0]:
+        # Same resource version, different bytes: the tag becomes weak
+        # (conditional GETs compare weakly, see etags.not_modified)
+        response.set_etag(response.get_etag()[0], weak=True)
+    return response
+
+
+def select_subprotocol(offered) -> Optional[str]:
+    """First subprotocol the client offers that we speak; None means JSON."""
+    return next((p for p in offered or () if p in WS_SUBPROTOCOLS), None)
+
+
+def frame_format(websocket) -> str:
+    """Frame encoding negotiated for a socket ('msgpack' or 'json')."""
+    return "msgpack" if getattr(websocket, "subprotocol", None) == "msgpack" else "json"
+
+
+def encode_frame(message: dict, fmt: str):
+    return pack(message) if fmt == "msgpack" else json.dumps(message)
+
+
+def decode_frame(raw):
+    """Incoming frame: binary frames are MessagePack, text frames JSON."""
+    if isinstance(raw, (bytes, bytearray)):
+        return unpack(raw)
+    return json.loads(raw)
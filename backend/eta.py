@@ -0,0 +1,233 @@
+# eta.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from geo import haversine_km
+
+# Used until the courier has enough history to measure a speed.
+ETA_DEFAULT_SPEED_KMH = float(os.environ.get("ETA_DEFAULT_SPEED_KMH", 25.0))
+# Floor so a courier waiting at a light doesn't get an hours-long ETA.
+ETA_MIN_SPEED_KMH = float(os.environ.get("ETA_MIN_SPEED_KMH", 8.0))
+ETA_SPEED_WINDOW_SECONDS = float(os.environ.get("ETA_SPEED_WINDOW_SECONDS", 300))
+# Only push over WS when the ETA moved by more than this.
+ETA_PUSH_THRESHOLD_SECONDS = float(os.environ.get("ETA_PUSH_THRESHOLD_SECONDS", 60))
+# How long a courier's list of active deliveries is trusted before re-reading it.
+ETA_TARGETS_TTL_SECONDS = float(os.environ.get("ETA_TARGETS_TTL_SECONDS", 60))
+# An ETA not refreshed for this long (courier went quiet, delivery finished
+# elsewhere) is dropped, and at most ETA_MAX_ENTRIES are kept.
+ETA_TTL_SECONDS = float(os.environ.get("ETA_TTL_SECONDS", 1800))
+ETA_MAX_ENTRIES = int(os.environ.get("ETA_MAX_ENTRIES", 100_000))
+# Keep ETAs in Redis, so whichever API worker serves /getDelivery sees the
+# one computed on the worker that took the courier's fix. 0 = per process only.
+ETA_REDIS = os.environ.get("ETA_REDIS", "1") == "1"
+ETA_REDIS_BACKOFF_SECONDS = float(os.environ.get("ETA_REDIS_BACKOFF_SECONDS", 30))
+
+ACTIVE_STATUSES = ("accepted", "in_progress")
+# Leg an ETA is timed to, by delivery status
+LEGS = {"accepted": "pickup", "in_progress": "dropoff"}
+
+# KEYS: the delivery's hash. ARGV: target, distanceKm, seconds, computedAt,
+# push threshold (s), expiry (ms). Stores the ETA and returns 1 if it moved
+# enough since the last push to be pushed again (and records that push).
+_STORE_LUA = """
+redis.call('HSET', KEYS[1], 'target', ARGV[1], 'distanceKm', ARGV[2],
+           'seconds', ARGV[3], 'computedAt', ARGV[4])
+local pushed = redis.call('HMGET', KEYS[1], 'pushedTarget', 'pushedSeconds')
+local push = 1
+if pushed[1] == ARGV[1] and math.abs(tonumber(pushed[2]) - tonumber(ARGV[3])) <= tonumber(ARGV[5]) then
+  push = 0
+else
+  redis.call('HSET', KEYS[1], 'pushedTarget', ARGV[1], 'pushedSeconds', ARGV[3])
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[6])
+return push
+"""
+
+
+class EtaCache:
+    """
+    ETAs for accepted/in_progress deliveries, recomputed on each courier fix.
+    'accepted' deliveries are timed to the pickup point, 'in_progress'
+    ones to the dropoff.
+
+    The ETAs and what was last pushed live in Redis (eta:<delivery_id>,
+    expiring after ETA_TTL_SECONDS), so every API worker serves and
+    dedupes the same values. If Redis is unreachable, each worker falls
+    back to its own memory for ETA_REDIS_BACKOFF_SECONDS.
+    """
+
+    def __init__(self, redis_client=None, shared: bool = ETA_REDIS):
+        self.shared = shared
+        self._redis = redis_client
+        self._store_script = None
+        self._redis_down_until = 0.0
+        self._targets: Dict[str, tuple] = {}   # courier uid -> (fetched_at, {delivery_id: info})
+        # Both in order of last computation, oldest first
+        self._etas: "OrderedDict[str, dict]" = OrderedDict()     # delivery_id -> eta
+        self._pushed: Dict[str, tuple] = {}    # delivery_id -> (target, seconds) last pushed
+        self._lock = threading.Lock()
+        self.counters = {"redis_fallbacks": 0}
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            from redis_client import get_fast_redis
+            self._redis = get_fast_redis()
+        return self._redis
+
+    def _use_redis(self) -> bool:
+        return self.shared and time.time() >= self._redis_down_until
+
+    def _redis_failed(self, e: Exception) -> None:
+        self.counters["redis_fallbacks"] += 1
+        self._redis_down_until = time.time() + ETA_REDIS_BACKOFF_SECONDS
+        print(f"[eta] Redis unavailable, per-process ETAs for {ETA_REDIS_BACKOFF_SECONDS:.0f}s: {e}")
+
+    def _active_deliveries(self, db, courier_uid: str) -> dict:
+        now = time.time()
+        cached = self._targets.get(courier_uid)
+        if cached and now - cached[0] < ETA_TARGETS_TTL_SECONDS:
+            return cached[1]
+
+        targets = {}
+        query = (
+            db.collection("deliveries")
+            .where("assignedCourier", "==", courier_uid)
+            .where("status", "in", list(ACTIVE_STATUSES))
+        )
+        for doc in query.stream():
+            data = doc.to_dict() or {}
+            targets[doc.id] = {
+                "status": data.get("status"),
+                "pickup": data.get("pickupLocation") or {},
+                "dropoff": data.get("dropoffLocation") or {},
+                "createdBy": data.get("createdBy"),
+            }
+        with self._lock:
+            self._targets[courier_uid] = (now, targets)
+        return targets
+
+    def has_active(self, db, courier_uid: str) -> bool:
+        """Whether the courier has an accepted/in_progress delivery (cached read)."""
+        return bool(self._active_deliveries(db, courier_uid))
+
+    def invalidate_courier(self, courier_uid: str) -> None:
+        """Forget a courier's cached delivery list (status changed)."""
+        with self._lock:
+            self._targets.pop(courier_uid, None)
+
+    def forget(self, delivery_id: str) -> None:
+        with self._lock:
+            self._etas.pop(delivery_id, None)
+            self._pushed.pop(delivery_id, None)
+        if self._use_redis():
+            try:
+                self.redis.delete(f"eta:{delivery_id}")
+            except Exception as e:
+                self._redis_failed(e)
+
+    def get(self, delivery_id: str, status: Optional[str] = None) -> Optional[dict]:
+        """
+        The delivery's current ETA, or None. With `status`, an ETA timed to
+        the other leg (computed before the status changed) is ignored.
+        """
+        eta = None
+        if self._use_redis():
+            try:
+                stored = self.redis.hgetall(f"eta:{delivery_id}")
+            except Exception as e:
+                self._redis_failed(e)
+            else:
+                if "computedAt" not in stored:
+                    return None
+                eta = {"target": stored["target"], "distanceKm": float(stored["distanceKm"]),
+                       "seconds": int(stored["seconds"]), "computedAt": float(stored["computedAt"])}
+        if eta is None:
+            eta = self._etas.get(delivery_id)
+        if eta is None or time.time() - eta["computedAt"] >= ETA_TTL_SECONDS:
+            return None
+        if status is not None and eta["target"] != LEGS.get(status):
+            return None
+        return eta
+
+    def _evict(self, now: float) -> None:
+        """Drop expired and surplus ETAs from the old end (caller holds the lock)."""
+        while self._etas:
+            delivery_id, eta = next(iter(self._etas.items()))
+            if len(self._etas) <= ETA_MAX_ENTRIES and now - eta["computedAt"] < ETA_TTL_SECONDS:
+                break
+            del self._etas[delivery_id]
+            self._pushed.pop(delivery_id, None)
+
+    def on_fix(self, db, courier_uid: str, lat: float, lng: float,
+               speed_kmh: Optional[float] = None) -> List[dict]:
+        """
+        Recompute ETAs for the courier's active deliveries.
+        Returns the entries that moved by more than the push threshold
+        since they were last returned, each with 'delivery_id' and
+        'createdBy' so the caller can notify.
+        """
+        if speed_kmh is None:
+            speed_kmh = ETA_DEFAULT_SPEED_KMH
+        speed_kmh = max(speed_kmh, ETA_MIN_SPEED_KMH)
+        now = time.time()
+
+        changed = []
+        for delivery_id, info in self._active_deliveries(db, courier_uid).items():
+            leg = LEGS.get(info["status"], "dropoff")
+            target = info[leg]
+            if target.get("lat") is None or target.get("lng") is None:
+                continue
+
+            dist_km = haversine_km(lat, lng, float(target["lat"]), float(target["lng"]))
+            eta = {
+                "target": leg,
+                "distanceKm": round(dist_km, 3),
+                "seconds": int(dist_km / speed_kmh * 3600),
+                "computedAt": now,
+            }
+            push = self._store_redis(delivery_id, eta) if self._use_redis() else None
+            if push is None:
+                push = self._store_local(delivery_id, eta, now)
+            if push:
+                changed.append({"delivery_id": delivery_id, "createdBy": info["createdBy"], **eta})
+        return changed
+
+    def _store_redis(self, delivery_id: str, eta: dict) -> Optional[bool]:
+        """Store `eta`; whether to push it, or None if Redis failed."""
+        try:
+            if self._store_script is None:
+                self._store_script = self.redis.register_script(_STORE_LUA)
+            push = self._store_script(
+                keys=[f"eta:{delivery_id}"],
+                args=[eta["target"], repr(eta["distanceKm"]), eta["seconds"], repr(eta["computedAt"]),
+                      ETA_PUSH_THRESHOLD_SECONDS, int(ETA_TTL_SECONDS * 1000)])
+        except Exception as e:
+            self._redis_failed(e)
+            return None
+        return bool(int(push))
+
+    def _store_local(self, delivery_id: str, eta: dict, now: float) -> bool:
+        with self._lock:
+            self._etas[delivery_id] = eta
+            self._etas.move_to_end(delivery_id)
+            self._evict(now)
+            pushed = self._pushed.get(delivery_id)
+            if (
+                pushed is not None
+                and pushed[0] == eta["target"]
+                and abs(pushed[1] - eta["seconds"]) <= ETA_PUSH_THRESHOLD_SECONDS
+            ):
+                return False
+            self._pushed[delivery_id] = (eta["target"], eta["seconds"])
+            return True
+
+    def stats(self) -> dict:
+        return {**self.counters, "shared": self.shared, "local_entries": len(self._etas)}
+
+
+eta_cache = EtaCache()
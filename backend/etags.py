@@ -0,0 +1,45 @@
+# etags.py
+
+import hashlib
+
+from flask import request
+
+
+def _version(data: dict) -> str:
+    """Per-document version: an explicit counter if present, else timestampUpdated."""
+    if data.get('version') is not None:
+        return f"v{data['version']}"
+    ts = data.get('timestampUpdated')
+    return ts.isoformat() if hasattr(ts, 'isoformat') else str(ts)
+
+
+def _quote(*parts) -> str:
+    digest = hashlib.blake2b('|'.join(str(p) for p in parts).encode(), digest_size=12)
+    return digest.hexdigest()
+
+
+def delivery_etag(delivery_id: str, data: dict, extra=None) -> str:
+    """Strong ETag for one delivery; `extra` covers derived fields (e.g. the ETA)."""
+    return _quote(delivery_id, _version(data), extra)
+
+
+def list_etag(docs, extra=None) -> str:
+    """
+    ETag for a list of (doc_id, data). Keyed on the newest update in the
+    set plus the ids themselves, so removals and reassignments (which
+    don't bump any remaining document) still change it.
+    """
+    versions = sorted((_version(data), doc_id) for doc_id, data in docs)
+    newest = versions[-1][0] if versions else ''
+    ids = hashlib.blake2b(
+        ','.join(doc_id for _, doc_id in versions).encode(), digest_size=12
+    ).hexdigest()
+    return _quote(newest, len(versions), ids, extra)
+
+
+def not_modified(etag: str) -> bool:
+    """
+    True if the client's If-None-Match already names this ETag. Weak
+    comparison: compressed/MessagePack bodies carry the weak form.
+    """
+    return request.if_none_match.contains_weak(etag)
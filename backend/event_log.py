@@ -0,0 +1,162 @@
+# event_log.py
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import List, Optional
+
+# memory: per-process log (lost on restart -> clients resync)
+# redis:  shared log that survives socket-server restarts
+EVENT_LOG_BACKEND = os.environ.get("EVENT_LOG_BACKEND", "memory")
+# Events kept per user, and how long they stay replayable.
+EVENT_LOG_PER_USER = int(os.environ.get("EVENT_LOG_PER_USER", 200))
+EVENT_LOG_TTL_SECONDS = float(os.environ.get("EVENT_LOG_TTL_SECONDS", 3600))
+# Users with a log in memory (least recently written dropped first).
+EVENT_LOG_MAX_USERS = int(os.environ.get("EVENT_LOG_MAX_USERS", 100_000))
+
+
+class MemoryEventLog:
+    """
+    Per-user, sequence-numbered log of the events sent to that user.
+
+    Every per-user WS event gets the next `seq` for its user. A client that
+    reconnects registers with the last seq it applied and is sent only the
+    events after it. If those are no longer all here (log trimmed, expired,
+    or lost in a restart) the answer is None and the client must refetch
+    instead. Seqs start from the wall clock in milliseconds, so a log
+    recreated after a restart or eviction never reuses an old seq.
+    """
+
+    def __init__(self, per_user: int = EVENT_LOG_PER_USER, ttl: float = EVENT_LOG_TTL_SECONDS,
+                 max_users: int = EVENT_LOG_MAX_USERS):
+        self.per_user = per_user
+        self.ttl = ttl
+        self.max_users = max_users
+        self._logs: "OrderedDict[str, tuple]" = OrderedDict()   # uid -> (last_seq, deque[(ts, message)])
+        self._floor = 0   # highest seq of any evicted log
+        self._lock = threading.Lock()
+
+    def append(self, uid: str, message: dict) -> dict:
+        """Return `message` with its seq, after recording it."""
+        with self._lock:
+            seq, events = self._logs.pop(uid, (None, None))
+            if seq is None:
+                # A new (or evicted) log continues above anything handed out
+                # before, so an old last_seq can never look complete
+                seq = max(_seq_base(), self._floor)
+                events = deque(maxlen=self.per_user)
+            seq += 1
+            message = {**message, "seq": seq}
+            events.append((time.time(), message))
+            self._logs[uid] = (seq, events)
+            while len(self._logs) > self.max_users:
+                _, (evicted_seq, _) = self._logs.popitem(last=False)
+                self._floor = max(self._floor, evicted_seq)
+        return message
+
+    def position(self, uid: str) -> int:
+        """Seq of the user's latest event; starts an empty log if there is none."""
+        with self._lock:
+            entry = self._logs.get(uid)
+            if entry is None:
+                entry = self._logs[uid] = (max(_seq_base(), self._floor), deque(maxlen=self.per_user))
+            return entry[0]
+
+    def since(self, uid: str, last_seq: int) -> Optional[List[dict]]:
+        """Events after `last_seq`, or None if some of them can't be replayed."""
+        with self._lock:
+            seq, events = self._logs.get(uid, (0, ()))
+            cutoff = time.time() - self.ttl
+            missed = [m for ts, m in events if m["seq"] > last_seq and ts >= cutoff]
+        return _complete(missed, last_seq, seq)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "users": len(self._logs),
+            "events": sum(len(e) for _, e in list(self._logs.values())),
+        }
+
+
+def _seq_base() -> int:
+    """Starting point for a user's seq numbers: wall-clock milliseconds."""
+    return int(time.time() * 1000)
+
+
+def _complete(missed: List[dict], last_seq: int, seq: int) -> Optional[List[dict]]:
+    if last_seq > seq:
+        return None                       # client is ahead of us: our log was reset
+    if len(missed) != seq - last_seq:
+        return None                       # trimmed or expired: gap too large
+    return missed
+
+
+# KEYS: seq key, list key. ARGV: message JSON, per-user cap, ttl seconds, seq base.
+# Entries are "<seq>:<json>" (the JSON isn't round-tripped through cjson,
+# which mangles empty arrays and floats). Returns the new seq; one round
+# trip, and seq order always matches list order.
+_APPEND_LUA = """
+redis.call('SET', KEYS[1], ARGV[4], 'NX')
+local seq = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('RPUSH', KEYS[2], seq .. ':' .. ARGV[1])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return seq
+"""
+
+
+class RedisEventLog:
+    """Same contract as MemoryEventLog, kept in Redis (ws:events:<uid> lists)."""
+
+    def __init__(self, redis_client=None, per_user: int = EVENT_LOG_PER_USER,
+                 ttl: float = EVENT_LOG_TTL_SECONDS):
+        self._redis = redis_client
+        self.per_user = per_user
+        self.ttl = int(ttl)
+        self._append = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            from redis_client import get_redis
+            self._redis = get_redis()
+        return self._redis
+
+    def _keys(self, uid: str):
+        return f"ws:events:{uid}:seq", f"ws:events:{uid}"
+
+    def append(self, uid: str, message: dict) -> dict:
+        if self._append is None:
+            self._append = self.redis.register_script(_APPEND_LUA)
+        seq = self._append(keys=list(self._keys(uid)),
+                           args=[json.dumps(message), self.per_user, self.ttl, _seq_base()])
+        return {**message, "seq": int(seq)}
+
+    def position(self, uid: str) -> int:
+        seq_key = self._keys(uid)[0]
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(seq_key, _seq_base(), nx=True, ex=self.ttl)
+        pipe.get(seq_key)
+        return int(pipe.execute()[1])
+
+    def since(self, uid: str, last_seq: int) -> Optional[List[dict]]:
+        pipe = self.redis.pipeline(transaction=True)
+        seq_key, list_key = self._keys(uid)
+        pipe.get(seq_key)
+        pipe.lrange(list_key, 0, -1)
+        seq, raw = pipe.execute()
+        missed = []
+        for entry in raw:
+            entry_seq, _, body = entry.partition(":")
+            if int(entry_seq) > last_seq:
+                missed.append({**json.loads(body), "seq": int(entry_seq)})
+        return _complete(missed, last_seq, int(seq or 0))
+
+    def stats(self) -> dict:
+        return {"backend": "redis"}
+
+
+event_log = RedisEventLog() if EVENT_LOG_BACKEND == "redis" else MemoryEventLog()
@@ -0,0 +1,118 @@
+# expand.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from concurrency import get_all
+
+# How long a fetched profile is reused for expansions, and how many are kept.
+EXPAND_CACHE_TTL_SECONDS = float(os.environ.get("EXPAND_CACHE_TTL_SECONDS", 30))
+EXPAND_CACHE_MAX_ENTRIES = int(os.environ.get("EXPAND_CACHE_MAX_ENTRIES", 50_000))
+
+# expand name -> (delivery field holding the uid, users/{uid} fields inlined)
+EXPANSIONS = {
+    "courier": ("assignedCourier", ("displayName", "phone", "vehicleType", "licensePlate")),
+    "business": ("createdBy", ("displayName", "phone", "businessName", "businessPhone", "businessAddress")),
+}
+
+_ALL_FIELDS = sorted({f for _, fields in EXPANSIONS.values() for f in fields})
+
+
+def parse_expand(raw: Optional[str]) -> List[str]:
+    """`expand=courier,business` -> ["courier", "business"]. Raises ValueError on unknown names."""
+    names = [n.strip() for n in (raw or "").split(",") if n.strip()]
+    unknown = [n for n in names if n not in EXPANSIONS]
+    if unknown:
+        raise ValueError(f"Unknown expand: {', '.join(unknown)} "
+                         f"(allowed: {', '.join(EXPANSIONS)})")
+    return list(dict.fromkeys(names))
+
+
+class RelatedExpander:
+    """
+    Inlines the courier / business profile behind each delivery.
+
+    All uids referenced by a page are collected first, and the ones not
+    in the cache are read with a single get_all, projected to the fields
+    any expansion shows (so private profile fields are never loaded).
+    Profiles are cached for EXPAND_CACHE_TTL_SECONDS; a profile update in
+    this process drops its entry right away, other processes see it once
+    the TTL runs out.
+    """
+
+    def __init__(self, db=None, ttl: float = EXPAND_CACHE_TTL_SECONDS,
+                 max_entries: int = EXPAND_CACHE_MAX_ENTRIES):
+        self._db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._profiles: "OrderedDict[str, tuple]" = OrderedDict()   # uid -> (fetched_at, fields or None)
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "batches": 0}
+
+    @property
+    def db(self):
+        if self._db is None:
+            from firebase_init import db
+            self._db = db
+        return self._db
+
+    def profiles(self, uids) -> Dict[str, Optional[dict]]:
+        """Projected users/{uid} fields per uid (None for a missing profile)."""
+        now = time.time()
+        result, missing = {}, []
+        with self._lock:
+            for uid in set(uids):
+                cached = self._profiles.get(uid)
+                if cached and now - cached[0] < self.ttl:
+                    result[uid] = cached[1]
+                    self.counters["hits"] += 1
+                else:
+                    missing.append(uid)
+            self.counters["misses"] += len(missing)
+        if missing:
+            self.counters["batches"] += 1
+            snaps = get_all(self.db, [self.db.collection("users").document(u) for u in missing],
+                            field_paths=_ALL_FIELDS)
+            with self._lock:
+                for uid in missing:
+                    snap = snaps.get(uid)
+                    fields = (snap.to_dict() or {}) if snap is not None and snap.exists else None
+                    result[uid] = fields
+                    self._profiles[uid] = (now, fields)
+                    self._profiles.move_to_end(uid)
+                while len(self._profiles) > self.max_entries:
+                    self._profiles.popitem(last=False)
+        return result
+
+    def expand(self, deliveries: List[dict], names: List[str]) -> List[dict]:
+        """
+        Add one key per expansion to each delivery dict (in place): the
+        projected profile, or None when the delivery has no such party
+        (e.g. no courier yet) or the profile doesn't exist.
+        """
+        if not names or not deliveries:
+            return deliveries
+        uids = {d.get(EXPANSIONS[n][0]) for d in deliveries for n in names}
+        uids.discard(None)
+        profiles = self.profiles(u for u in uids if isinstance(u, str) and u)
+        for delivery in deliveries:
+            for name in names:
+                id_field, fields = EXPANSIONS[name]
+                uid = delivery.get(id_field)
+                profile = profiles.get(uid)
+                delivery[name] = None if profile is None else {
+                    "uid": uid, **{f: profile.get(f) for f in fields}}
+        return deliveries
+
+    def invalidate(self, uid: str) -> None:
+        with self._lock:
+            self._profiles.pop(uid, None)
+
+    def stats(self) -> dict:
+        return {"cached_profiles": len(self._profiles), **self.counters}
+
+
+related_expander = RelatedExpander()
@@ -1,7 +1,74 @@
+import os
+import threading
+
 import firebase_admin
-from firebase_admin import credentials, firestore ,auth
+from firebase_admin import credentials, auth
+from google.cloud import firestore as gcf
+
+# Credentials and clients are created on first use rather than at import,
+# so a preloading server (gunicorn --preload) never opens a gRPC channel
+# in the master: each worker builds its own client after fork.
+FIREBASE_CREDENTIALS = os.environ.get('FIREBASE_CREDENTIALS', 'firebase__admin.json')
+
+_lock = threading.RLock()
+_cred = None
+_clients = {}   # pid -> firestore client
+
+def get_credentials():
+    global _cred
+    if _cred is None:
+        with _lock:
+            if _cred is None:
+                _cred = credentials.Certificate(FIREBASE_CREDENTIALS)
+                if not firebase_admin._apps:
+                    firebase_admin.initialize_app(_cred)
+    return _cred
+
+def get_db():
+    """Firestore client for the current process."""
+    pid = os.getpid()
+    client = _clients.get(pid)
+    if client is None:
+        with _lock:
+            client = _clients.get(pid)
+            if client is None:
+                # Not firestore.client(): that caches one client on the app,
+                # which would hand workers the master's (forked) channel.
+                cred = get_credentials()
+                client = _clients[pid] = gcf.Client(
+                    project=cred.project_id, credentials=cred.get_credential()
+                )
+    return client
+
+def use_db(client):
+    """Serve `client` from get_db() (and so `db`) in this process, e.g. a local stand-in for replays."""
+    with _lock:
+        _clients[os.getpid()] = client
+
+
+class _Lazy:
+    """Module-level stand-in that resolves to the real object on first attribute access."""
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+def _auth_module():
+    get_credentials()   # verify_id_token needs the default app
+    return auth
+
+db = _Lazy(get_db)
+firebase_auth = _Lazy(_auth_module)
+
+_async_db = None
 
-cred = credentials.Certificate('firebase__admin.json')
-firebase_admin.initialize_app(cred)
-db = firestore.client()
-firebase_auth = auth
\ No newline at end of file
+def get_async_db():
+    """Firestore AsyncClient for the ASGI routes (created on first use)."""
+    global _async_db
+    if _async_db is None:
+        cred = get_credentials()
+        _async_db = gcf.AsyncClient(project=cred.project_id, credentials=cred.get_credential())
+    return _async_db
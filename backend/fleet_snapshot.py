@@ -0,0 +1,134 @@
+# fleet_snapshot.py
+"""
+Snapshots of the matcher's fleet state (the active view), for warm starts.
+
+Without a snapshot, every API or Celery worker process fills its view by
+streaming all active deliveries and every courier location. A snapshot
+holds the view's contents and the read times it was current at. A new
+process loads it (active_view.start_active_view calls load_into) and its
+listeners then only read what changed since those read times. See
+active_view.ActiveDeliveryView.
+
+Format: the header is a 9-byte magic, the format version and the creation
+time (struct ">9sHd"). The body is zlib-compressed MessagePack, with
+timestamps as msgpack Timestamps. The body also records ACTIVE_STATUSES.
+A snapshot written with another version or another status set is
+ignored, as is one older than FLEET_SNAPSHOT_MAX_AGE_SECONDS. In those
+cases the process falls back to a full start.
+
+FLEET_SNAPSHOT picks the store:
+    redis          key FLEET_SNAPSHOT_KEY on the cache Redis (default)
+    file:<path>    a local file, replaced atomically
+    off            no snapshots
+The Celery beat task delivery_tasks.snapshot_fleet_state writes one
+every FLEET_SNAPSHOT_SECONDS, from whichever worker runs it.
+"""
+import datetime as dt
+import os
+import struct
+import time
+import zlib
+from typing import Optional
+
+import msgpack
+
+from active_view import ACTIVE_STATUSES
+
+FLEET_SNAPSHOT = os.environ.get("FLEET_SNAPSHOT", "redis")
+FLEET_SNAPSHOT_KEY = os.environ.get("FLEET_SNAPSHOT_KEY", "fleet:snapshot")
+FLEET_SNAPSHOT_SECONDS = float(os.environ.get("FLEET_SNAPSHOT_SECONDS", 60))
+# An older snapshot means a long catch-up; a full start is cheaper by then
+FLEET_SNAPSHOT_MAX_AGE_SECONDS = float(os.environ.get("FLEET_SNAPSHOT_MAX_AGE_SECONDS", 6 * 3600))
+
+SNAPSHOT_VERSION = 1
+_MAGIC = b"FLEETSNAP"
+_HEADER = struct.Struct(">9sHd")
+
+
+def _default(obj):
+    # Firestore returns DatetimeWithNanoseconds, which msgpack won't take as a datetime
+    if isinstance(obj, dt.datetime):
+        return msgpack.Timestamp.from_datetime(obj)
+    # Anything else would come back as a different type after a warm start
+    raise TypeError(f"can't snapshot a {type(obj).__name__}")
+
+
+def encode(state: dict, created: Optional[float] = None) -> bytes:
+    """`state` as returned by ActiveDeliveryView.export_state()."""
+    body = msgpack.packb({**state, "statuses": list(ACTIVE_STATUSES)},
+                         use_bin_type=True, default=_default)
+    return _HEADER.pack(_MAGIC, SNAPSHOT_VERSION, created or time.time()) + zlib.compress(body, 6)
+
+
+def decode(blob: bytes) -> dict:
+    """Snapshot dict with its `created` time; ValueError if it isn't a usable snapshot."""
+    if len(blob) < _HEADER.size:
+        raise ValueError("truncated snapshot")
+    magic, version, created = _HEADER.unpack_from(blob)
+    if magic != _MAGIC:
+        raise ValueError("not a fleet snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"snapshot version {version}, expected {SNAPSHOT_VERSION}")
+    state = msgpack.unpackb(zlib.decompress(blob[_HEADER.size:]), raw=False, timestamp=3)
+    if tuple(state.pop("statuses", ())) != ACTIVE_STATUSES:
+        raise ValueError("snapshot was taken with different ACTIVE_STATUSES")
+    state["created"] = created
+    return state
+
+
+def _read() -> Optional[bytes]:
+    if FLEET_SNAPSHOT.startswith("file:"):
+        try:
+            with open(FLEET_SNAPSHOT[5:], "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    from redis_client import get_binary_redis
+    return get_binary_redis().get(FLEET_SNAPSHOT_KEY)
+
+
+def _write(blob: bytes) -> None:
+    if FLEET_SNAPSHOT.startswith("file:"):
+        path = FLEET_SNAPSHOT[5:]
+        with open(path + ".tmp", "wb") as f:
+            f.write(blob)
+        os.replace(path + ".tmp", path)
+        return
+    from redis_client import get_binary_redis
+    get_binary_redis().set(FLEET_SNAPSHOT_KEY, blob, ex=int(FLEET_SNAPSHOT_MAX_AGE_SECONDS))
+
+
+def save(view) -> Optional[int]:
+    """Write a snapshot of `view`; its size in bytes, or None if the view isn't ready."""
+    if FLEET_SNAPSHOT == "off":
+        return None
+    state = view.export_state()
+    if state is None:
+        return None
+    blob = encode(state)
+    _write(blob)
+    return len(blob)
+
+
+def load_into(view) -> bool:
+    """Fill `view` from the stored snapshot if there is a usable one."""
+    if FLEET_SNAPSHOT == "off":
+        return False
+    started = time.perf_counter()
+    blob = _read()
+    if not blob:
+        return False
+    try:
+        state = decode(blob)
+    except (ValueError, zlib.error, msgpack.UnpackException) as e:
+        print(f"[fleet snapshot] ignored: {e}")
+        return False
+    age = time.time() - state["created"]
+    if age > FLEET_SNAPSHOT_MAX_AGE_SECONDS:
+        print(f"[fleet snapshot] ignored: {age:.0f}s old")
+        return False
+    view.load_state(state["deliveries"], state["couriers"], state["since"])
+    print(f"[fleet snapshot] loaded {len(state['deliveries'])} deliveries, "
+          f"{len(state['couriers'])} couriers ({len(blob)} bytes, {age:.0f}s old) "
+          f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return True
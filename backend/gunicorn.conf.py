@@ -0,0 +1,64 @@
+# gunicorn.conf.py
+"""
+Production entry point for the REST API:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Settings come from the environment:
+
+    GUNICORN_MODE      sync | gthread (default) | gevent (needs `pip install gevent`)
+    GUNICORN_WORKERS   worker processes (default 2 * CPUs + 1)
+    GUNICORN_THREADS   threads per worker in gthread mode (default 8)
+    GUNICORN_BIND      default 0.0.0.0:5001
+
+The app is preloaded in the master so workers fork with the code already
+imported; Firestore clients are created per worker after fork (see
+firebase_init.get_db). `kill -HUP <master>` reloads workers gracefully.
+
+WebSockets are not served by these workers. Run the socket process on its
+own (`uvicorn asgi:application --port 5002`, one process) and start
+gunicorn with WS_FORWARD_URL=http://<that host>:5002 so sends from any
+worker reach it.
+"""
+import multiprocessing
+import os
+
+_mode = os.environ.get("GUNICORN_MODE", "gthread")
+
+if _mode == "gevent":
+    # Must happen before the app (and grpc) are preloaded
+    from gevent import monkey
+    monkey.patch_all()
+    import grpc.experimental.gevent
+    grpc.experimental.gevent.init_gevent()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5001")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = {"sync": "sync", "gthread": "gthread", "gevent": "gevent"}[_mode]
+threads = int(os.environ.get("GUNICORN_THREADS", 8)) if _mode == "gthread" else 1
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))  # gevent only
+# admission.py sizes its load shedding from this; the app is imported after this file
+os.environ.setdefault("ADMISSION_MAX_INFLIGHT", str(worker_connections if _mode == "gevent" else threads))
+
+preload_app = True
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+# Recycle workers now and then so slow leaks can't accumulate
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 5000))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get("GUNICORN_ACCESSLOG", "-") or None
+
+
+def post_fork(server, worker):
+    # Warm the per-process Firestore client before the first request arrives
+    from firebase_init import get_db
+    from active_view import start_active_view
+    try:
+        get_db()
+    except Exception as e:
+        # Not fatal here: the client is created lazily on first use anyway
+        worker.log.warning("Firestore client warm-up failed: %s", e)
+        return
+    start_active_view(get_db())
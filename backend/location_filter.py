@@ -0,0 +1,194 @@
+# location_filter.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from geo import haversine_km
+
+# A fix is written to Firestore only once the courier moved at least this far
+# from the last written fix (metres), and not more often than the min interval.
+# After the heartbeat interval a fix is written regardless, so "last seen" stays fresh.
+LOCATION_ACTIVE_MIN_MOVE_M = float(os.environ.get("LOCATION_ACTIVE_MIN_MOVE_M", 25))
+LOCATION_ACTIVE_MIN_INTERVAL_S = float(os.environ.get("LOCATION_ACTIVE_MIN_INTERVAL_S", 2))
+LOCATION_ACTIVE_HEARTBEAT_S = float(os.environ.get("LOCATION_ACTIVE_HEARTBEAT_S", 30))
+LOCATION_IDLE_MIN_MOVE_M = float(os.environ.get("LOCATION_IDLE_MIN_MOVE_M", 150))
+LOCATION_IDLE_MIN_INTERVAL_S = float(os.environ.get("LOCATION_IDLE_MIN_INTERVAL_S", 15))
+LOCATION_IDLE_HEARTBEAT_S = float(os.environ.get("LOCATION_IDLE_HEARTBEAT_S", 300))
+
+# Update interval recommended to the client (seconds).
+LOCATION_ACTIVE_INTERVAL_MIN_S = float(os.environ.get("LOCATION_ACTIVE_INTERVAL_MIN_S", 3))
+LOCATION_ACTIVE_INTERVAL_MAX_S = float(os.environ.get("LOCATION_ACTIVE_INTERVAL_MAX_S", 15))
+LOCATION_IDLE_INTERVAL_S = float(os.environ.get("LOCATION_IDLE_INTERVAL_S", 30))
+LOCATION_PARKED_INTERVAL_S = float(os.environ.get("LOCATION_PARKED_INTERVAL_S", 120))
+
+# Couriers whose last written fix we remember (least recently seen dropped first).
+LOCATION_FILTER_MAX_COURIERS = int(os.environ.get("LOCATION_FILTER_MAX_COURIERS", 200_000))
+# Keep the last written fix per courier in Redis, so every API worker judges
+# a courier's fixes against the same reference. 0 = per process only.
+LOCATION_FILTER_REDIS = os.environ.get("LOCATION_FILTER_REDIS", "1") == "1"
+LOCATION_FILTER_REDIS_BACKOFF_SECONDS = float(os.environ.get("LOCATION_FILTER_REDIS_BACKOFF_SECONDS", 30))
+
+_VERDICTS = ("accepted", "dropped_stationary", "dropped_too_soon")
+
+# KEYS: the courier's hash. ARGV: lat, lng, now, active (0/1), min move (m),
+# min interval, heartbeat (s), expiry (ms). Returns {verdict index, metres
+# moved or "" for a first fix}; on accept the fix becomes the reference.
+_OFFER_LUA = """
+local lat, lng, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local last = redis.call('HMGET', KEYS[1], 'lat', 'lng', 'ts', 'active')
+local verdict, moved = 0, ''
+if last[1] and last[4] == ARGV[4] then
+  local p1, p2 = math.rad(tonumber(last[1])), math.rad(lat)
+  local dp, dl = p2 - p1, math.rad(lng - tonumber(last[2]))
+  local a = math.sin(dp / 2) ^ 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ^ 2
+  local m = 2 * 6371000.0 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+  local elapsed = now - tonumber(last[3])
+  moved = tostring(m)
+  if elapsed >= tonumber(ARGV[7]) then verdict = 0
+  elseif m < tonumber(ARGV[5]) then verdict = 1
+  elseif elapsed < tonumber(ARGV[6]) then verdict = 2 end
+end
+if verdict == 0 then
+  redis.call('HSET', KEYS[1], 'lat', ARGV[1], 'lng', ARGV[2], 'ts', ARGV[3], 'active', ARGV[4])
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[8])
+return {verdict, moved}
+"""
+
+
+class LocationFilter:
+    """
+    Decides which courier fixes are worth a Firestore write and how often
+    the client should send the next one.
+
+    Couriers with an accepted/in_progress delivery are tracked closely
+    (small distance threshold, short interval scaled to their speed);
+    idle couriers only need a coarse position for matching. Dropped fixes
+    still go to the in-memory history, so speed and routes stay exact.
+
+    The last written fix per courier lives in Redis (one Lua call per
+    fix), so all API workers share it. If Redis is unreachable, each
+    worker falls back to its own memory for
+    LOCATION_FILTER_REDIS_BACKOFF_SECONDS, which only costs some extra
+    writes.
+    """
+
+    def __init__(self, max_couriers: int = LOCATION_FILTER_MAX_COURIERS, redis_client=None,
+                 shared: bool = LOCATION_FILTER_REDIS):
+        self.max_couriers = max_couriers
+        self.shared = shared
+        self._redis = redis_client
+        self._offer_script = None
+        self._redis_down_until = 0.0
+        self._last: "OrderedDict[str, tuple]" = OrderedDict()   # uid -> (lat, lng, ts, active)
+        self._lock = threading.Lock()
+        self.counters = {"accepted": 0, "dropped_stationary": 0, "dropped_too_soon": 0,
+                         "redis_fallbacks": 0}
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            from redis_client import get_fast_redis
+            self._redis = get_fast_redis()
+        return self._redis
+
+    def recommended_interval(self, active: bool, moving: bool,
+                             speed_kmh: Optional[float] = None) -> float:
+        if not active:
+            return LOCATION_IDLE_INTERVAL_S if moving else LOCATION_PARKED_INTERVAL_S
+        if not moving or not speed_kmh:
+            return LOCATION_ACTIVE_INTERVAL_MAX_S
+        # Roughly one fix per LOCATION_ACTIVE_MIN_MOVE_M travelled
+        seconds = LOCATION_ACTIVE_MIN_MOVE_M / (speed_kmh / 3.6)
+        return round(min(max(seconds, LOCATION_ACTIVE_INTERVAL_MIN_S), LOCATION_ACTIVE_INTERVAL_MAX_S), 1)
+
+    def offer(self, uid: str, lat: float, lng: float, active: bool,
+              speed_kmh: Optional[float] = None, now: Optional[float] = None):
+        """
+        Returns (accept, next_interval_seconds). On accept the fix becomes
+        the courier's reference point; the caller writes it.
+        """
+        now = time.time() if now is None else now
+        if active:
+            min_move, min_interval, heartbeat = (
+                LOCATION_ACTIVE_MIN_MOVE_M, LOCATION_ACTIVE_MIN_INTERVAL_S, LOCATION_ACTIVE_HEARTBEAT_S)
+        else:
+            min_move, min_interval, heartbeat = (
+                LOCATION_IDLE_MIN_MOVE_M, LOCATION_IDLE_MIN_INTERVAL_S, LOCATION_IDLE_HEARTBEAT_S)
+
+        thresholds = (min_move, min_interval, heartbeat)
+        judged = self._offer_redis(uid, lat, lng, active, now, thresholds) if self.shared else None
+        if judged is None:
+            judged = self._offer_local(uid, lat, lng, active, now, thresholds)
+        verdict, moved_m = judged
+        accept = verdict == "accepted"
+        with self._lock:
+            self.counters[verdict] += 1
+
+        moving = moved_m is None or moved_m >= min_move or bool(speed_kmh and speed_kmh > 1)
+        return accept, self.recommended_interval(active, moving, speed_kmh)
+
+    def _offer_redis(self, uid, lat, lng, active, now, thresholds):
+        """(verdict, metres moved or None), or None while Redis is unavailable."""
+        if time.time() < self._redis_down_until:
+            return None
+        min_move, min_interval, heartbeat = thresholds
+        # Past the longest heartbeat any fix is accepted, so the key can go
+        expire_ms = int(max(LOCATION_ACTIVE_HEARTBEAT_S, LOCATION_IDLE_HEARTBEAT_S) * 1000) + 1000
+        try:
+            if self._offer_script is None:
+                self._offer_script = self.redis.register_script(_OFFER_LUA)
+            verdict, moved = self._offer_script(
+                keys=[f"locfilter:{uid}"],
+                args=[repr(float(lat)), repr(float(lng)), repr(now), int(active),
+                      min_move, min_interval, heartbeat, expire_ms])
+        except Exception as e:
+            self.counters["redis_fallbacks"] += 1
+            self._redis_down_until = time.time() + LOCATION_FILTER_REDIS_BACKOFF_SECONDS
+            print(f"[location filter] Redis unavailable, per-process state for "
+                  f"{LOCATION_FILTER_REDIS_BACKOFF_SECONDS:.0f}s: {e}")
+            return None
+        return _VERDICTS[int(verdict)], float(moved) if moved else None
+
+    def _offer_local(self, uid, lat, lng, active, now, thresholds):
+        min_move, min_interval, heartbeat = thresholds
+        with self._lock:
+            last = self._last.get(uid)
+            if last is None or last[3] != active:
+                # First fix we see, or the courier just got/finished a delivery
+                verdict, moved_m = "accepted", None
+            else:
+                moved_m = haversine_km(last[0], last[1], lat, lng) * 1000
+                elapsed = now - last[2]
+                if elapsed >= heartbeat:
+                    verdict = "accepted"
+                elif moved_m < min_move:
+                    verdict = "dropped_stationary"
+                elif elapsed < min_interval:
+                    verdict = "dropped_too_soon"
+                else:
+                    verdict = "accepted"
+
+            if verdict == "accepted":
+                self._last[uid] = (lat, lng, now, active)
+            if uid in self._last:
+                self._last.move_to_end(uid)
+            while len(self._last) > self.max_couriers:
+                self._last.popitem(last=False)
+        return verdict, moved_m
+
+    def stats(self) -> dict:
+        dropped = self.counters["dropped_stationary"] + self.counters["dropped_too_soon"]
+        total = self.counters["accepted"] + dropped
+        return {
+            **self.counters,
+            "shared": self.shared,
+            "local_couriers": len(self._last),
+            "write_reduction": round(dropped / total, 4) if total else 0.0,
+        }
+
+
+location_filter = LocationFilter()
@@ -0,0 +1,248 @@
+# location_history.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from geo import haversine_km_array, bearing_deg_array
+
+# Fixes kept per courier, and the total memory the buffers may use.
+HISTORY_FIXES_PER_COURIER = int(os.environ.get("HISTORY_FIXES_PER_COURIER", 120))
+HISTORY_MEMORY_BUDGET_BYTES = int(os.environ.get("HISTORY_MEMORY_BUDGET_BYTES", 32 * 1024 * 1024))
+# Couriers with no fix for this long are dropped.
+HISTORY_IDLE_SECONDS = float(os.environ.get("HISTORY_IDLE_SECONDS", 30 * 60))
+# Points kept when a delivery's route is stored on completion.
+ROUTE_PERSIST_MAX_POINTS = int(os.environ.get("ROUTE_PERSIST_MAX_POINTS", 50))
+# Keep each courier's fixes in a Redis list, so the track (and the speed and
+# route computed from it) covers the fixes every API worker received.
+# 0 = per process only.
+HISTORY_REDIS = os.environ.get("HISTORY_REDIS", "1") == "1"
+HISTORY_REDIS_BACKOFF_SECONDS = float(os.environ.get("HISTORY_REDIS_BACKOFF_SECONDS", 30))
+
+
+class CourierTrack:
+    """Fixed-size ring buffer of (lat, lng, timestamp) fixes for one courier."""
+
+    __slots__ = ("lat", "lng", "ts", "head", "size", "last_seen")
+
+    def __init__(self, capacity: int):
+        self.lat = np.zeros(capacity, dtype=np.float64)
+        self.lng = np.zeros(capacity, dtype=np.float64)
+        self.ts = np.zeros(capacity, dtype=np.float64)
+        self.head = 0   # next slot to write
+        self.size = 0
+        self.last_seen = 0.0
+
+    @property
+    def capacity(self) -> int:
+        return self.ts.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.lat.nbytes + self.lng.nbytes + self.ts.nbytes
+
+    def append(self, lat: float, lng: float, ts: float) -> None:
+        self.lat[self.head] = lat
+        self.lng[self.head] = lng
+        self.ts[self.head] = ts
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.last_seen = ts
+
+    def load(self, fixes: list) -> None:
+        """Replace the contents with `fixes` [(lat, lng, ts)], kept in time order."""
+        fixes = sorted(fixes, key=lambda f: f[2])[-self.capacity:]
+        n = len(fixes)
+        if n:
+            self.lat[:n], self.lng[:n], self.ts[:n] = zip(*fixes)
+            self.last_seen = fixes[-1][2]
+        self.head = n % self.capacity
+        self.size = n
+
+    def arrays(self, since: Optional[float] = None):
+        """(lat, lng, ts) arrays in chronological order, optionally from `since` on."""
+        if self.size < self.capacity:
+            order = np.arange(self.size)
+        else:
+            order = (np.arange(self.capacity) + self.head) % self.capacity
+        lat, lng, ts = self.lat[order], self.lng[order], self.ts[order]
+        if since is not None:
+            keep = ts >= since
+            lat, lng, ts = lat[keep], lng[keep], ts[keep]
+        return lat, lng, ts
+
+    def average_speed_kmh(self, window_seconds: Optional[float] = None) -> Optional[float]:
+        """Path length over elapsed time for the last `window_seconds` (None if unknown)."""
+        since = None if window_seconds is None else self.last_seen - window_seconds
+        lat, lng, ts = self.arrays(since)
+        if ts.shape[0] < 2:
+            return None
+        elapsed = ts[-1] - ts[0]
+        if elapsed <= 0:
+            return None
+        dist_km = haversine_km_array(lat[:-1], lng[:-1], lat[1:], lng[1:]).sum()
+        return float(dist_km / elapsed * 3600.0)
+
+    def heading_deg(self, window_seconds: Optional[float] = None) -> Optional[float]:
+        """Distance-weighted circular mean of segment bearings (None if stationary)."""
+        since = None if window_seconds is None else self.last_seen - window_seconds
+        lat, lng, ts = self.arrays(since)
+        if ts.shape[0] < 2:
+            return None
+        seg_km = haversine_km_array(lat[:-1], lng[:-1], lat[1:], lng[1:])
+        if seg_km.sum() <= 0:
+            return None
+        bearings = np.radians(bearing_deg_array(lat[:-1], lng[:-1], lat[1:], lng[1:]))
+        x = (np.cos(bearings) * seg_km).sum()
+        y = (np.sin(bearings) * seg_km).sum()
+        return float(np.degrees(np.arctan2(y, x)) % 360.0)
+
+    def downsample(self, max_points: int, since: Optional[float] = None) -> list:
+        """At most `max_points` evenly spaced fixes (first and last always kept)."""
+        lat, lng, ts = self.arrays(since)
+        n = ts.shape[0]
+        if n > max_points:
+            idx = np.unique(np.linspace(0, n - 1, max_points).round().astype(np.int64))
+            lat, lng, ts = lat[idx], lng[idx], ts[idx]
+        return [
+            {"lat": float(a), "lng": float(b), "t": float(c)}
+            for a, b, c in zip(lat, lng, ts)
+        ]
+
+
+class LocationHistory:
+    """
+    Per-courier trajectories held in memory.
+    The number of tracks is capped so the buffers never exceed the memory
+    budget; the least recently updated courier is evicted first, and
+    couriers idle for longer than `idle_seconds` are dropped on the way.
+
+    The fixes themselves live in a Redis list per courier (history:<uid>,
+    capped at `fixes_per_courier`, expiring after `idle_seconds`), since a
+    courier's fixes are spread over all API workers. record() appends and
+    reads the list back in one round trip, so the local buffer mirrors it;
+    route() reads it fresh. If Redis is unreachable, each worker keeps
+    only its own fixes for HISTORY_REDIS_BACKOFF_SECONDS.
+    """
+
+    def __init__(
+        self,
+        fixes_per_courier: int = HISTORY_FIXES_PER_COURIER,
+        memory_budget_bytes: int = HISTORY_MEMORY_BUDGET_BYTES,
+        idle_seconds: float = HISTORY_IDLE_SECONDS,
+        redis_client=None,
+        shared: bool = HISTORY_REDIS,
+    ):
+        self.fixes_per_courier = fixes_per_courier
+        self.idle_seconds = idle_seconds
+        bytes_per_track = 3 * 8 * fixes_per_courier
+        self.max_couriers = max(1, memory_budget_bytes // bytes_per_track)
+        self.shared = shared
+        self._redis = redis_client
+        self._redis_down_until = 0.0
+        self._tracks: "OrderedDict[str, CourierTrack]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"redis_fallbacks": 0}
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            from redis_client import get_fast_redis
+            self._redis = get_fast_redis()
+        return self._redis
+
+    def _shared_fixes(self, uid: str, fix: Optional[tuple] = None) -> Optional[list]:
+        """The courier's fixes in Redis, after appending `fix`; None while Redis is unavailable."""
+        if not self.shared or time.time() < self._redis_down_until:
+            return None
+        key = f"history:{uid}"
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            if fix is not None:
+                pipe.rpush(key, ",".join(repr(float(v)) for v in fix))
+                pipe.ltrim(key, -self.fixes_per_courier, -1)
+                pipe.pexpire(key, int(self.idle_seconds * 1000))
+            pipe.lrange(key, 0, -1)
+            raw = pipe.execute()[-1]
+        except Exception as e:
+            self.counters["redis_fallbacks"] += 1
+            self._redis_down_until = time.time() + HISTORY_REDIS_BACKOFF_SECONDS
+            print(f"[history] Redis unavailable, per-process tracks for "
+                  f"{HISTORY_REDIS_BACKOFF_SECONDS:.0f}s: {e}")
+            return None
+        return [tuple(float(v) for v in item.split(",")) for item in raw]
+
+    def record(self, uid: str, lat: float, lng: float, ts: Optional[float] = None) -> CourierTrack:
+        if ts is None:
+            ts = time.time()
+        fixes = self._shared_fixes(uid, (lat, lng, ts))
+        with self._lock:
+            track = self._tracks.get(uid)
+            if track is None:
+                self._evict(ts)
+                track = CourierTrack(self.fixes_per_courier)
+                self._tracks[uid] = track
+            else:
+                self._tracks.move_to_end(uid)
+            if fixes:
+                track.load(fixes)
+            else:
+                track.append(lat, lng, ts)
+            return track
+
+    def _evict(self, now: float) -> None:
+        # Oldest entries sit at the front of the OrderedDict
+        while self._tracks:
+            uid, track = next(iter(self._tracks.items()))
+            idle = now - track.last_seen > self.idle_seconds
+            if not idle and len(self._tracks) < self.max_couriers:
+                break
+            del self._tracks[uid]
+
+    def evict_idle(self, now: Optional[float] = None) -> None:
+        with self._lock:
+            self._evict(time.time() if now is None else now)
+
+    def track(self, uid: str) -> Optional[CourierTrack]:
+        return self._tracks.get(uid)
+
+    def average_speed_kmh(self, uid: str, window_seconds: Optional[float] = None) -> Optional[float]:
+        # Under the writers' lock: record() moves head/size while we read the ring
+        with self._lock:
+            track = self._tracks.get(uid)
+            return track.average_speed_kmh(window_seconds) if track else None
+
+    def heading_deg(self, uid: str, window_seconds: Optional[float] = None) -> Optional[float]:
+        with self._lock:
+            track = self._tracks.get(uid)
+            return track.heading_deg(window_seconds) if track else None
+
+    def route(self, uid: str, since: Optional[float] = None,
+              max_points: int = ROUTE_PERSIST_MAX_POINTS) -> list:
+        """Downsampled copy of the courier's trajectory ([] if unknown)."""
+        fixes = self._shared_fixes(uid)
+        if fixes is not None:
+            track = CourierTrack(self.fixes_per_courier)
+            track.load(fixes)
+            return track.downsample(max_points, since) if track.size else []
+        with self._lock:
+            track = self._tracks.get(uid)
+            if track is None:
+                return []
+            return track.downsample(max_points, since)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "shared": self.shared,
+            "couriers": len(self._tracks),
+            "max_couriers": self.max_couriers,
+            "bytes": sum(t.nbytes for t in list(self._tracks.values())),
+        }
+
+
+location_history = LocationHistory()
@@ -1,5 +1,11 @@
 # notification_utils.py
 
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
 from firebase_admin import messaging
 
 def send_push_to_token(token: str, title: str, body: str, data: dict = None):
@@ -20,3 +26,251 @@ def send_push_to_token(token: str, title: str, body: str, data: dict = None):
     # This will return a message ID string or raise an exception if invalid.
     response = messaging.send(message)
     return response
+
+
+# Set PUSH_FALLBACK=0 to never push (e.g. local development without FCM).
+PUSH_FALLBACK_ENABLED = os.environ.get("PUSH_FALLBACK", "1") == "1"
+# Events waiting for the worker; beyond this new events are dropped (and counted).
+PUSH_QUEUE_MAX = int(os.environ.get("PUSH_QUEUE_MAX", 10_000))
+# The worker sends once it has this many events or after PUSH_FLUSH_SECONDS.
+PUSH_BATCH_SIZE = int(os.environ.get("PUSH_BATCH_SIZE", 200))
+PUSH_FLUSH_SECONDS = float(os.environ.get("PUSH_FLUSH_SECONDS", 1.0))
+PUSH_TOKEN_TTL_SECONDS = float(os.environ.get("PUSH_TOKEN_TTL_SECONDS", 600))
+PUSH_NO_TOKEN_TTL_SECONDS = float(os.environ.get("PUSH_NO_TOKEN_TTL_SECONDS", 60))
+FCM_MAX_MESSAGES_PER_CALL = 500   # send_each limit
+# Sends FCM rejects for a passing reason (quota, outage) are tried again,
+# up to PUSH_MAX_ATTEMPTS in all, after PUSH_RETRY_SECONDS, doubling each time.
+PUSH_MAX_ATTEMPTS = int(os.environ.get("PUSH_MAX_ATTEMPTS", 3))
+PUSH_RETRY_SECONDS = float(os.environ.get("PUSH_RETRY_SECONDS", 0.5))
+
+# Field on users/{uid} holding the user's FCM registration tokens.
+DEVICE_TOKENS_FIELD = "fcmTokens"
+
+# WS events worth waking a phone for, and how they read as notifications.
+PUSH_EVENTS = {
+    "delivery_assigned": lambda m: ("New delivery", "You have a new delivery to pick up."),
+    "deliveries_assigned": lambda m: (
+        "Couriers assigned", f"{len(m.get('assignments') or [])} of your deliveries were assigned."),
+    "delivery_status_updated": lambda m: (
+        "Delivery update", f"Your delivery is now {str(m.get('status', '')).replace('_', ' ')}."),
+    "delivery_status_update": lambda m: (
+        "Delivery update", "A courier was assigned to your delivery."),
+}
+
+# Send errors that mean the token will never work again.
+_INVALID_TOKEN_ERRORS = ("UnregisteredError", "SenderIdMismatchError")
+# Send errors worth another attempt (QuotaExceededError is a ResourceExhaustedError).
+_TRANSIENT_ERRORS = ("ResourceExhaustedError", "UnavailableError", "InternalError", "DeadlineExceededError")
+
+
+def _error_names(exc) -> set:
+    return {cls.__name__ for cls in type(exc).__mro__}
+
+
+def _is_invalid_token(exc) -> bool:
+    if _error_names(exc) & set(_INVALID_TOKEN_ERRORS):
+        return True
+    # INVALID_ARGUMENT also covers a malformed payload; only a bad token is the token's fault
+    return type(exc).__name__ == "InvalidArgumentError" and "registration token" in str(exc).lower()
+
+
+def _is_transient(exc) -> bool:
+    return bool(_error_names(exc) & set(_TRANSIENT_ERRORS))
+
+
+class PushDispatcher:
+    """
+    FCM fallback for users with no open WebSocket.
+
+    Registered as a WebSocketManager listener: every assignment/status
+    event for a user who isn't connected is queued, and a background
+    thread sends the queue in batches with messaging.send_each (one call
+    per up to 500 messages instead of one per device). Device tokens are
+    read from users/{uid}.fcmTokens with get_all and cached per user;
+    tokens FCM reports as unregistered or invalid are dropped from the
+    cache and the profile. Quota and availability errors are retried with
+    backoff, up to PUSH_MAX_ATTEMPTS.
+
+    `messaging_api` and `db` are injectable (a local fake of the
+    firebase_admin.messaging module works as long as it provides
+    Message, Notification and send_each).
+    """
+
+    def __init__(self, messaging_api=None, db=None):
+        self.messaging = messaging_api or messaging
+        self._db = db
+        self.is_online = lambda uid: False
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=PUSH_QUEUE_MAX)
+        self._tokens: Dict[str, tuple] = {}   # uid -> (fetched_at, [tokens])
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.counters = {"queued": 0, "dropped": 0, "sent": 0, "failed": 0,
+                         "pruned": 0, "no_token": 0, "batches": 0, "retried": 0}
+
+    @property
+    def db(self):
+        if self._db is None:
+            from firebase_init import db
+            self._db = db
+        return self._db
+
+    def watch(self, manager) -> None:
+        """Push the events `manager` couldn't deliver over a socket."""
+        self.is_online = manager.is_connected
+        manager.add_listener(self.on_event)
+
+    # -- producer side (any thread) ---------------------------------------
+
+    def on_event(self, uid: str, message: dict) -> None:
+        if not PUSH_FALLBACK_ENABLED or message.get("event") not in PUSH_EVENTS:
+            return
+        if self.is_online(uid):
+            return
+        try:
+            self._queue.put_nowait((uid, message))
+            self.counters["queued"] += 1
+        except queue.Full:
+            self.counters["dropped"] += 1
+            return
+        self._ensure_worker()
+
+    def _ensure_worker(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="push-dispatcher", daemon=True)
+                self._thread.start()
+
+    # -- worker ----------------------------------------------------------
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + PUSH_FLUSH_SECONDS
+            while len(batch) < PUSH_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.flush(batch)
+            except Exception as e:
+                self.counters["failed"] += len(batch)
+                print(f"[push] batch of {len(batch)} failed: {e}")
+
+    def tokens_for(self, uids) -> Dict[str, List[str]]:
+        """Device tokens per user, from the cache or one get_all for the rest."""
+        from concurrency import get_all
+
+        now = time.time()
+        result, missing = {}, []
+        for uid in set(uids):
+            cached = self._tokens.get(uid)
+            # "No devices" is re-checked sooner: the token may be registered
+            # through another API process
+            ttl = PUSH_TOKEN_TTL_SECONDS if cached and cached[1] else PUSH_NO_TOKEN_TTL_SECONDS
+            if cached and now - cached[0] < ttl:
+                result[uid] = cached[1]
+            else:
+                missing.append(uid)
+        if missing:
+            snaps = get_all(self.db, [self.db.collection("users").document(u) for u in missing])
+            for uid in missing:
+                snap = snaps.get(uid)
+                data = (snap.to_dict() or {}) if snap is not None and snap.exists else {}
+                tokens = [t for t in data.get(DEVICE_TOKENS_FIELD) or [] if isinstance(t, str)]
+                self._tokens[uid] = (now, tokens)
+                result[uid] = tokens
+        return result
+
+    def forget_tokens(self, uid: str) -> None:
+        self._tokens.pop(uid, None)
+
+    def _message(self, token: str, message: dict):
+        title, body = PUSH_EVENTS[message["event"]](message)
+        # FCM data values must be strings; nested payloads stay on the WS/API side
+        data = {k: str(v) for k, v in message.items()
+                if v is not None and isinstance(v, (str, int, float, bool))}
+        return self.messaging.Message(
+            notification=self.messaging.Notification(title=title, body=body),
+            token=token,
+            data=data,
+        )
+
+    def flush(self, events: List[tuple]) -> None:
+        """Send one batch of (uid, message) events."""
+        tokens = self.tokens_for(uid for uid, _ in events)
+        outgoing = []   # (uid, token, Message)
+        for uid, message in events:
+            if not tokens.get(uid):
+                self.counters["no_token"] += 1
+                continue
+            for token in tokens[uid]:
+                outgoing.append((uid, token, self._message(token, message)))
+
+        invalid = {}   # uid -> tokens to prune
+        for attempt in range(1, PUSH_MAX_ATTEMPTS + 1):
+            if attempt > 1:
+                time.sleep(PUSH_RETRY_SECONDS * 2 ** (attempt - 2))
+            outgoing = self._send(outgoing, invalid, last=attempt == PUSH_MAX_ATTEMPTS)
+            if not outgoing:
+                break
+            self.counters["retried"] += len(outgoing)
+        for uid, bad in invalid.items():
+            self.prune(uid, bad)
+
+    def _send(self, outgoing: List[tuple], invalid: Dict[str, set], last: bool) -> List[tuple]:
+        """One send_each pass over `outgoing`; returns what is worth retrying."""
+        retry = []
+        for start in range(0, len(outgoing), FCM_MAX_MESSAGES_PER_CALL):
+            chunk = outgoing[start:start + FCM_MAX_MESSAGES_PER_CALL]
+            try:
+                response = self.messaging.send_each([m for _, _, m in chunk])
+            except Exception as e:
+                if not last and _is_transient(e):
+                    retry.extend(chunk)
+                    continue
+                self.counters["failed"] += len(chunk)
+                print(f"[push] send of {len(chunk)} messages failed: {e}")
+                continue
+            self.counters["batches"] += 1
+            for item, result in zip(chunk, response.responses):
+                if result.success:
+                    self.counters["sent"] += 1
+                elif not last and _is_transient(result.exception):
+                    retry.append(item)
+                else:
+                    self.counters["failed"] += 1
+                    if _is_invalid_token(result.exception):
+                        invalid.setdefault(item[0], set()).add(item[1])
+        return retry
+
+    def prune(self, uid: str, bad_tokens) -> None:
+        """Drop tokens FCM rejected for good, from the cache and users/{uid}."""
+        from google.cloud import firestore
+
+        bad_tokens = list(bad_tokens)
+        cached = self._tokens.get(uid)
+        if cached:
+            self._tokens[uid] = (cached[0], [t for t in cached[1] if t not in bad_tokens])
+        try:
+            self.db.collection("users").document(uid).update(
+                {DEVICE_TOKENS_FIELD: firestore.ArrayRemove(bad_tokens)})
+            self.counters["pruned"] += len(bad_tokens)
+        except Exception as e:
+            print(f"[push] pruning tokens for {uid} failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": PUSH_FALLBACK_ENABLED,
+            "pending": self._queue.qsize(),
+            "cached_users": len(self._tokens),
+            **self.counters,
+        }
+
+
+push_dispatcher = PushDispatcher()
@@ -0,0 +1,95 @@
+# pending_index.py
+
+import time
+from typing import List, Optional
+
+from redis_client import get_redis
+
+# Sorted set: delivery_id -> creation time (epoch seconds), oldest first.
+PENDING_BY_TIME_KEY = "deliveries:pending:by_time"
+
+
+class PendingDeliveryIndex:
+    """
+    Redis index of unassigned ('pending') deliveries.
+
+    Firestore stays the source of truth; this index only saves us the
+    `where('status', '==', 'pending')` scan. The matcher picks couriers
+    per delivery, so only the creation order is kept; `reconcile`
+    rebuilds it from Firestore after a Redis loss.
+    """
+
+    def __init__(self, redis_client=None):
+        self._redis = redis_client
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis()
+        return self._redis
+
+    def add(self, delivery_id: str, created_at: Optional[float] = None) -> None:
+        """Index a newly created (or re-opened) pending delivery."""
+        if created_at is None:
+            created_at = time.time()
+        self.redis.zadd(PENDING_BY_TIME_KEY, {delivery_id: created_at})
+
+    def add_many(self, delivery_ids, created_at: Optional[float] = None) -> None:
+        """Index several deliveries at once, in one command."""
+        if created_at is None:
+            created_at = time.time()
+        mapping = {delivery_id: created_at for delivery_id in delivery_ids}
+        if mapping:
+            self.redis.zadd(PENDING_BY_TIME_KEY, mapping)
+
+    def remove(self, delivery_id: str) -> bool:
+        """
+        Drop a delivery from the index (assigned, cancelled or deleted).
+        Returns True if it was still indexed, so callers racing to claim
+        the same delivery can tell who got there first.
+        """
+        return bool(self.redis.zrem(PENDING_BY_TIME_KEY, delivery_id))
+
+    def contains(self, delivery_id: str) -> bool:
+        return self.redis.zscore(PENDING_BY_TIME_KEY, delivery_id) is not None
+
+    def oldest(self, limit: Optional[int] = None) -> List[str]:
+        """Pending delivery ids, oldest first."""
+        end = -1 if limit is None else limit - 1
+        return list(self.redis.zrange(PENDING_BY_TIME_KEY, 0, end))
+
+    def count(self) -> int:
+        return self.redis.zcard(PENDING_BY_TIME_KEY)
+
+    def reconcile(self, db) -> dict:
+        """
+        Rebuild the index from Firestore.
+        Adds pending deliveries that are missing and drops ids that are no
+        longer pending. Returns {'added': n, 'removed': n, 'total': n}.
+
+        The index is read before Firestore, so a delivery indexed while
+        the scan runs is not in that read and can't be dropped as stale.
+        One claimed during the scan may be added back; the matcher skips
+        it (it re-reads the status) and the next pass drops it.
+        """
+        indexed = set(self.redis.zrange(PENDING_BY_TIME_KEY, 0, -1))
+
+        pending = {}
+        for doc in db.collection("deliveries").where("status", "==", "pending").stream():
+            created = (doc.to_dict() or {}).get("timestampCreated")
+            pending[doc.id] = created.timestamp() if hasattr(created, "timestamp") else time.time()
+
+        stale = indexed - set(pending)
+        missing = set(pending) - indexed
+
+        pipe = self.redis.pipeline(transaction=True)
+        if stale:
+            pipe.zrem(PENDING_BY_TIME_KEY, *stale)
+        if missing:
+            pipe.zadd(PENDING_BY_TIME_KEY, {delivery_id: pending[delivery_id] for delivery_id in missing})
+        pipe.execute()
+
+        return {"added": len(missing), "removed": len(stale), "total": len(pending)}
+
+
+pending_index = PendingDeliveryIndex()
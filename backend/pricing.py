@@ -0,0 +1,28 @@
+# pricing.py
+
+import numpy as np
+
+from distance import get_distance_provider
+
+FEE_BASE = 5.0      # flat part of every delivery fee
+FEE_PER_KM = 2.0    # per km between pickup and dropoff (DISTANCE_PROVIDER decides which km)
+
+
+def delivery_fee(pickup: dict, dropoff: dict) -> float:
+    dist_km = float(get_distance_provider().pairwise([pickup], [dropoff])[0])
+    return round(FEE_PER_KM * dist_km + FEE_BASE, 2)
+
+
+def quote_fees(pickups: list, dropoffs: list):
+    """
+    Price many pickup/dropoff pairs in one vectorized pass.
+    Returns (distances_km, fees) as numpy arrays aligned with the input.
+
+    Quotes are not stored: /createDeliveries prices again. With the
+    routing provider both agree while the distance cache holds the pair
+    (DISTANCE_CACHE_TTL_SECONDS), but can differ once it expired or if
+    one of the two calls fell back to straight-line km.
+    """
+    dist_km = get_distance_provider().pairwise(pickups, dropoffs)
+    fees = np.round(FEE_PER_KM * dist_km + FEE_BASE, 2)
+    return dist_km, fees
@@ -0,0 +1,267 @@
+# profiling.py
+"""
+On-demand profiling for API requests and Celery tasks.
+
+A fraction of requests/tasks (PROFILE_SAMPLE_RATE) is profiled, labelled
+with the route (`route:get_deliveries`) or task name
+(`task:delivery_tasks.match_and_assign_courier`). Two profilers:
+
+    sample    a background thread snapshots the stacks of the threads
+              running a profiled request every PROFILE_INTERVAL_MS and
+              counts them. Written as collapsed stacks, one
+              `label;outer;...;inner count` line each, to
+              PROFILE_DIR/collapsed-<pid>.txt. Feed it to flamegraph.pl
+              or speedscope.
+    cprofile  cProfile around each profiled request, merged per label
+              into PROFILE_DIR/<label>-<pid>.pstats
+              (`python -m pstats`, snakeviz). Only one cProfile runs
+              per process at a time (on 3.12+ it holds the global
+              sys.monitoring slot); requests picked while one is running
+              are sampled only, and counted as `cprofile_skipped`.
+
+PROFILE_MODE selects one or `both`. Files are rewritten every
+PROFILE_FLUSH_SECONDS with the totals since the process started.
+
+Turn it on with the environment (PROFILE_SAMPLE_RATE=0.05) or at runtime
+with POST /internal/profile. That call needs the ADMIN_TOKEN header
+(see auth.require_admin_token). It stores the setting in Redis with an expiry, and every API and
+worker process picks it up within PROFILE_POLL_SECONDS. When profiling
+is off, a request costs one clock read and a comparison. The Redis poll
+happens at most once per PROFILE_POLL_SECONDS per process.
+
+The sampler reads thread stacks, so it sees nothing under gevent
+workers. cProfile works in every mode.
+"""
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_MODE = os.environ.get("PROFILE_MODE", "sample")      # sample | cprofile | both
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.path.dirname(__file__), "profiles"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_FLUSH_SECONDS = float(os.environ.get("PROFILE_FLUSH_SECONDS", 30))
+PROFILE_POLL_SECONDS = float(os.environ.get("PROFILE_POLL_SECONDS", 5))
+# Runtime switches turn themselves off after this long unless given `seconds`
+PROFILE_MAX_SECONDS = int(os.environ.get("PROFILE_MAX_SECONDS", 600))
+PROFILE_MAX_DEPTH = 96
+
+MODES = ("sample", "cprofile", "both")
+_CONFIG_KEY = "profiling:config"
+_REDIS_RETRY_SECONDS = 60
+
+
+class Profiler:
+    def __init__(self, rate: float = PROFILE_SAMPLE_RATE, mode: str = PROFILE_MODE,
+                 out_dir: str = PROFILE_DIR, redis_client=None):
+        if mode not in MODES:
+            raise ValueError(f"PROFILE_MODE must be one of {', '.join(MODES)}")
+        self._defaults = (rate, mode)
+        self.rate, self.mode = rate, mode
+        self.out_dir = out_dir
+        self._redis = redis_client
+        self._next_poll = 0.0
+        self._lock = threading.Lock()
+        self._active = {}                     # thread id -> label (sampled runs only)
+        self._stacks = Counter()              # collapsed stack -> samples
+        self._pstats = {}                     # label -> pstats.Stats
+        self._cprofile_slot = threading.Lock()  # held while a cProfile run is enabled
+        self._frame_names = {}                # code object -> "func (file:line)"
+        self._sampler = None
+        self._wake = threading.Event()
+        self._last_flush = time.monotonic()
+        self.counters = {"profiled": 0, "samples": 0, "flushes": 0, "cprofile_skipped": 0}
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            from redis_client import get_redis
+            self._redis = get_redis()
+        return self._redis
+
+    # -- switching on and off ---------------------------------------------
+
+    def configure(self, rate: float, mode: str = None, seconds: int = PROFILE_MAX_SECONDS) -> dict:
+        """Set rate/mode for every process (through Redis) for `seconds`."""
+        mode = mode or self.mode
+        if mode not in MODES or not 0 <= rate <= 1:
+            raise ValueError(f"rate must be in [0, 1] and mode one of {', '.join(MODES)}")
+        self.redis.set(_CONFIG_KEY, json.dumps({"rate": rate, "mode": mode}), ex=max(int(seconds), 1))
+        self._apply(rate, mode)
+        return {"rate": rate, "mode": mode, "seconds": int(seconds)}
+
+    def _apply(self, rate: float, mode: str) -> None:
+        if (rate, mode) != (self.rate, self.mode):
+            print(f"[profiling] pid {os.getpid()}: rate {rate}, mode {mode}")
+        self.rate, self.mode = rate, mode
+
+    def _poll(self, now: float) -> None:
+        self._next_poll = now + PROFILE_POLL_SECONDS
+        try:
+            raw = self.redis.get(_CONFIG_KEY)
+        except Exception:
+            self._next_poll = now + _REDIS_RETRY_SECONDS
+            return
+        config = json.loads(raw) if raw else None
+        if config and config.get("mode") in MODES:
+            self._apply(float(config.get("rate") or 0), config["mode"])
+        else:
+            self._apply(*self._defaults)
+
+    # -- per request / task -----------------------------------------------
+
+    def begin(self, label: str):
+        """Maybe start profiling the current thread; returns a token for end(), or None."""
+        now = time.monotonic()
+        if now >= self._next_poll:
+            self._poll(now)
+        if not self.rate or random.random() >= self.rate:
+            return None
+        self.counters["profiled"] += 1
+        profile = None
+        if self.mode in ("cprofile", "both"):
+            profile = self._start_cprofile()
+        if self.mode in ("sample", "both"):
+            with self._lock:
+                self._active[threading.get_ident()] = label
+            self._ensure_sampler()
+            self._wake.set()
+        return label, profile
+
+    def _start_cprofile(self):
+        if not self._cprofile_slot.acquire(blocking=False):
+            self.counters["cprofile_skipped"] += 1
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # "Another profiling tool is already active" (a debugger, coverage, ...)
+            self._cprofile_slot.release()
+            self.counters["cprofile_skipped"] += 1
+            print(f"[profile] cProfile unavailable: {e}")
+            return None
+        return profile
+
+    def end(self, token) -> None:
+        if token is None:
+            return
+        label, profile = token
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+        if profile is not None:
+            profile.disable()
+            self._cprofile_slot.release()
+            with self._lock:
+                stats = self._pstats.get(label)
+                if stats is None:
+                    self._pstats[label] = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+        if self._sampler is None and time.monotonic() - self._last_flush >= PROFILE_FLUSH_SECONDS:
+            self.flush()
+
+    # -- stack sampler ----------------------------------------------------
+
+    def _ensure_sampler(self) -> None:
+        if self._sampler is not None:
+            return
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._sampler.start()
+
+    def _frame_name(self, code) -> str:
+        name = self._frame_names.get(code)
+        if name is None:
+            name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._frame_names[code] = name
+        return name
+
+    def _sample_once(self) -> None:
+        with self._lock:
+            active = dict(self._active)
+        if not active:
+            return
+        frames = sys._current_frames()
+        for tid, label in active.items():
+            frame, stack = frames.get(tid), []
+            while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                stack.append(self._frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                stack.append(label)
+                self._stacks[";".join(reversed(stack))] += 1
+                self.counters["samples"] += 1
+
+    def _sample_loop(self) -> None:
+        interval = PROFILE_INTERVAL_MS / 1000.0
+        while True:
+            if self._active:
+                time.sleep(interval)
+            else:
+                # Idle until a profiled run starts (or it's time to flush)
+                self._wake.wait(PROFILE_FLUSH_SECONDS)
+                self._wake.clear()
+            try:
+                self._sample_once()
+                if time.monotonic() - self._last_flush >= PROFILE_FLUSH_SECONDS:
+                    self.flush()
+            except Exception as e:
+                print(f"[profiling] sampler error: {e}")
+
+    # -- output -----------------------------------------------------------
+
+    def flush(self) -> None:
+        """Rewrite this process' profile files with everything collected so far."""
+        self._last_flush = time.monotonic()
+        if not self._stacks and not self._pstats:
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        pid = os.getpid()
+        if self._stacks:
+            lines = [f"{stack} {n}\n" for stack, n in self._stacks.copy().most_common()]
+            path = os.path.join(self.out_dir, f"collapsed-{pid}.txt")
+            with open(path + ".tmp", "w") as f:
+                f.writelines(lines)
+            os.replace(path + ".tmp", path)
+        with self._lock:
+            for label, stats in self._pstats.items():
+                safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", label)
+                stats.dump_stats(os.path.join(self.out_dir, f"{safe}-{pid}.pstats"))
+        self.counters["flushes"] += 1
+
+    def init_app(self, app) -> None:
+        """Profile sampled Flask requests under `route:<endpoint>`."""
+        from flask import g, request
+
+        @app.before_request
+        def _begin_profile():
+            if request.endpoint:
+                g.profile_token = self.begin(f"route:{request.endpoint}")
+
+        @app.teardown_request
+        def _end_profile(exc=None):
+            self.end(g.pop("profile_token", None))
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "mode": self.mode,
+            "out_dir": self.out_dir,
+            "stacks": len(self._stacks),
+            "pstats_labels": sorted(self._pstats),
+            **self.counters,
+        }
+
+
+profiler = Profiler()
+atexit.register(profiler.flush)
@@ -0,0 +1,46 @@
+# redis_client.py
+
+import os
+
+import redis
+
+from celery_app import REDIS_URL
+
+# Same Redis instance as the Celery broker unless overridden.
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", REDIS_URL)
+# Connect/read timeout for get_fast_redis()
+FAST_REDIS_TIMEOUT_MS = float(os.environ.get("FAST_REDIS_TIMEOUT_MS", 100))
+
+_client = None
+_binary_client = None
+_fast_client = None
+
+
+def get_redis() -> redis.Redis:
+    """Return a process-wide Redis client (created on first use)."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(CACHE_REDIS_URL, decode_responses=True)
+    return _client
+
+
+def get_binary_redis() -> redis.Redis:
+    """Like get_redis(), but values come back as bytes (for binary payloads)."""
+    global _binary_client
+    if _binary_client is None:
+        _binary_client = redis.Redis.from_url(CACHE_REDIS_URL)
+    return _binary_client
+
+
+def get_fast_redis() -> redis.Redis:
+    """
+    Like get_redis(), but gives up after FAST_REDIS_TIMEOUT_MS. For calls
+    on the request path that have a local fallback, so a stalled Redis
+    costs a request milliseconds instead of a thread.
+    """
+    global _fast_client
+    if _fast_client is None:
+        timeout = FAST_REDIS_TIMEOUT_MS / 1000.0
+        _fast_client = redis.Redis.from_url(CACHE_REDIS_URL, decode_responses=True,
+                                            socket_timeout=timeout, socket_connect_timeout=timeout)
+    return _fast_client
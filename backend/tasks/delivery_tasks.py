@@ -1,12 +1,24 @@
 # backend/tasks/delivery_tasks.py
 
 from celery_app import celery
+from celery.signals import task_postrun, task_prerun, worker_process_init
+import datetime as dt
 import math
 import os
 import time
 import requests
+import numpy as np
 from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition
 from firebase_init import db  # firebase app initialized elsewhere
+from distance import get_distance_provider
+from concurrency import gather
+from active_view import active_view, start_active_view
+from pending_index import pending_index
+from delta_sync import SYNC_TOMBSTONE_RETENTION_DAYS, TOMBSTONE_COLLECTION
+import delivery_stats
+from profiling import profiler
+from archive import ARCHIVE_AFTER_DAYS, archive_finished
 
 # Configure where to send internal WS notifications.
 # If Celery runs in a separate container, DO NOT use 127.0.0.1 here.
@@ -36,24 +48,150 @@ def _ws_notify(uid: str, message: dict) -> None:
         return
     try:
         r = requests.post(
-            "http://127.0.0.1:5001/internal/ws/notify",
+            WS_NOTIFY_URL,
             json={"uid": uid, "message": message},
             timeout=3.0,
         )
-        print(f"[WS notify] -> {"http://127.0.0.1:5001/internal/ws/notify"} uid={uid} ev={message.get('event')} "
+        print(f"[WS notify] -> {WS_NOTIFY_URL} uid={uid} ev={message.get('event')} "
               f"delivery_id={message.get('delivery_id')} status={r.status_code}")
         r.raise_for_status()
     except Exception as e:
         print(f"[WS notify] failed for uid={uid}: {e}")
 
 
+@worker_process_init.connect
+def _start_active_view(**kwargs):
+    # Each worker process (after the prefork) keeps its own fleet view
+    start_active_view(db)
+
+
+# task id -> profiler token, for the sampled share of tasks (see profiling.py)
+_profile_tokens = {}
+
+
+@task_prerun.connect
+def _begin_task_profile(task_id=None, task=None, **kwargs):
+    token = profiler.begin(f"task:{task.name}")
+    if token is not None:
+        _profile_tokens[task_id] = token
+
+
+@task_postrun.connect
+def _end_task_profile(task_id=None, **kwargs):
+    profiler.end(_profile_tokens.pop(task_id, None))
+
+
+def _active_count(courier_uid: str) -> int:
+    """The courier's accepted/in_progress deliveries, read from Firestore."""
+    active_cursor = (
+        db.collection("deliveries")
+        .where("assignedCourier", "==", courier_uid)
+        .where("status", "in", ["accepted", "in_progress"])
+        .stream()
+    )
+    # Count without materializing full list
+    return sum(1 for _ in active_cursor)
+
+
+def _unindex(delivery_id: str) -> None:
+    """Best-effort removal from the Redis pending index."""
+    try:
+        pending_index.remove(delivery_id)
+    except Exception as e:
+        print(f"[pending index] remove failed for {delivery_id}: {e}")
+
+
+@celery.task(name="delivery_tasks.reconcile_pending_index")
+def reconcile_pending_index():
+    """Rebuild the Redis pending index from Firestore (startup + periodic)."""
+    try:
+        result = pending_index.reconcile(db)
+        print(f"[pending index] reconciled: {result}")
+        return result
+    except Exception as e:
+        print(f"[pending index] reconcile failed: {e}")
+        return {"error": str(e)}
+
+
+@celery.task(name="delivery_tasks.purge_delivery_tombstones")
+def purge_delivery_tombstones():
+    """Drop /syncDeliveries tombstones past the retention window."""
+    cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=SYNC_TOMBSTONE_RETENTION_DAYS)
+    purged = 0
+    try:
+        while True:
+            old = list(
+                db.collection(TOMBSTONE_COLLECTION)
+                .where("timestampDeleted", "<", cutoff)
+                .limit(500)
+                .stream()
+            )
+            if not old:
+                break
+            batch = db.batch()
+            for snap in old:
+                batch.delete(snap.reference)
+            batch.commit()
+            purged += len(old)
+        print(f"[sync] purged {purged} tombstones older than {cutoff.isoformat()}")
+        return {"purged": purged}
+    except Exception as e:
+        print(f"[sync] tombstone purge failed after {purged}: {e}")
+        return {"purged": purged, "error": str(e)}
+
+
+@celery.task(name="delivery_tasks.archive_finished_deliveries")
+def archive_finished_deliveries(older_than_days: int = ARCHIVE_AFTER_DAYS):
+    """Move finished deliveries past the age limit to the archive collection."""
+    try:
+        moved = archive_finished(db, older_than_days)
+        print(f"[archive] moved {moved} deliveries finished more than {older_than_days} days ago")
+        return {"archived": moved}
+    except Exception as e:
+        print(f"[archive] failed: {e}")
+        return {"error": str(e)}
+
+
+@celery.task(name="delivery_tasks.export_analytics")
+def export_analytics():
+    """Copy deliveries changed since the last run to the Parquet analytics store."""
+    try:
+        from analytics import export
+        result = export(db)
+        print(f"[analytics] exported {result}")
+        return result
+    except Exception as e:
+        print(f"[analytics] export failed: {e}")
+        return {"error": str(e)}
+
+
+@celery.task(name="delivery_tasks.snapshot_fleet_state")
+def snapshot_fleet_state():
+    """Store this worker's fleet view so new processes can warm-start from it."""
+    try:
+        from fleet_snapshot import save
+        size = save(active_view)
+        if size is None:
+            return {"skipped": "view not ready"}
+        return {"bytes": size}
+    except Exception as e:
+        print(f"[fleet snapshot] save failed: {e}")
+        return {"error": str(e)}
+
+
+# Times the matcher re-decides a delivery that changed under it
+MATCH_MAX_ATTEMPTS = 3
+
+
 @celery.task(name="delivery_tasks.match_and_assign_courier")
-def match_and_assign_courier(delivery_id: str):
+def match_and_assign_courier(delivery_id: str, attempt: int = 1):
     """
     Find the nearest available courier for the given delivery_id and assign it.
     Then notify:
       - the assigned courier with 'delivery_assigned'
       - the business with 'delivery_status_updated' (status: 'accepted')
+    The assignment only commits if the delivery is unchanged since it was
+    read; otherwise the match runs again on the new state.
     """
     try:
         delivery_ref = db.collection("deliveries").document(delivery_id)
@@ -62,6 +200,11 @@ def match_and_assign_courier(delivery_id: str):
             return {"error": "Delivery not found"}
 
         data = delivery_doc.to_dict() or {}
+        if data.get("status", "pending") != "pending":
+            # Already assigned/cancelled by an earlier run: make sure the index agrees
+            _unindex(delivery_id)
+            return {"assignedCourier": data.get("assignedCourier")}
+
         pickup = data.get("pickupLocation") or {}
         lat1 = pickup.get("lat")
         lng1 = pickup.get("lng")
@@ -72,43 +215,67 @@ def match_and_assign_courier(delivery_id: str):
         best_dist = None
         best_courier = None
 
-        for loc_doc in db.collection("courier_locations").stream():
-            courier_uid = loc_doc.id
-            loc = loc_doc.to_dict() or {}
+        # Courier positions and loads from the in-process view when it's ready
+        locations = active_view.courier_locations()
+        use_view = locations is not None
+        if not use_view:
+            locations = {d.id: d.to_dict() or {} for d in db.collection("courier_locations").stream()}
+
+        candidates = []
+        for courier_uid, loc in locations.items():
             lat2 = loc.get("lat")
             lng2 = loc.get("lng")
             if lat2 is None or lng2 is None:
                 continue
-
-            # Capacity check: accepted or in_progress
-            active_cursor = (
-                db.collection("deliveries")
-                .where("assignedCourier", "==", courier_uid)
-                .where("status", "in", ["accepted", "in_progress"])
-                .stream()
-            )
-            # Count without materializing full list
-            active_count = sum(1 for _ in active_cursor)
-            if active_count >=2:
-                continue
-
-            dist = haversine_distance(float(lat1), float(lng1), float(lat2), float(lng2))
-            if best_dist is None or dist < best_dist:
-                best_dist = dist
-                best_courier = courier_uid
+            candidates.append((courier_uid, lat2, lng2))
+
+        if use_view:
+            counts = [active_view.courier_load(c[0]) for c in candidates]
+        else:
+            # One capacity query per courier, issued side by side
+            counts = gather(*(lambda c=c: _active_count(c[0]) for c in candidates))
+
+        eligible = [c for c, count in zip(candidates, counts) if count < 2]
+        if eligible:
+            # One matrix row: pickup -> every eligible courier (road km if configured)
+            dists = get_distance_provider().matrix(
+                [{"lat": lat2, "lng": lng2} for _, lat2, lng2 in eligible],
+                [{"lat": lat1, "lng": lng1}],
+            )[:, 0]
+            for best in np.argsort(dists, kind="stable"):
+                # The view lags behind other matchers' commits: confirm the pick from Firestore
+                if use_view and _active_count(eligible[best][0]) >= 2:
+                    continue
+                best_dist = float(dists[best])
+                best_courier = eligible[best][0]
+                break
 
         if not best_courier:
             print(f"[assign] No eligible courier for delivery {delivery_id}")
             return {"assignedCourier": None}
 
-        # update the firestore 
-        delivery_ref.update(
+        # update the firestore (and both parties' stats) in one commit
+        batch = db.batch()
+        batch.update(
+            delivery_ref,
             {
                 "assignedCourier": best_courier,
                 "status": "accepted",
+                "timestampAssigned": firestore.SERVER_TIMESTAMP,
                 "timestampUpdated": firestore.SERVER_TIMESTAMP,
-            }
+            },
+            option=db.write_option(last_update_time=delivery_doc.update_time),
         )
+        delivery_stats.record_assigned(batch, db, data, best_courier)
+        try:
+            batch.commit()
+        except FailedPrecondition:
+            # Assigned, cancelled or edited since the read: decide again on the new state
+            if attempt >= MATCH_MAX_ATTEMPTS:
+                print(f"[assign] {delivery_id} kept changing, left for the next rematch")
+                return {"assignedCourier": None}
+            return match_and_assign_courier.run(delivery_id, attempt + 1)
+        _unindex(delivery_id)
 
         # Build notify payloads
         bussiness = data.get("createdBy")
@@ -152,6 +319,125 @@ def match_and_assign_courier(delivery_id: str):
     except Exception as e:
         print(f"[assign] error for {delivery_id}: {e}")
         return {"error": str(e)}
+
+
+@celery.task(name="delivery_tasks.match_and_assign_couriers")
+def match_and_assign_couriers(delivery_ids):
+    """
+    Batch variant of match_and_assign_courier for /createDeliveries.
+    Courier locations and active-job counts are read once for the whole
+    batch and distances are computed as one courier x delivery matrix.
+    Deliveries are assigned oldest-first (input order) to the nearest
+    courier with spare capacity. The business gets a single aggregated
+    'deliveries_assigned' notification.
+    """
+    try:
+        refs = [db.collection("deliveries").document(d) for d in delivery_ids]
+        deliveries = []
+        for snap in db.get_all(refs):
+            data = snap.to_dict() if snap.exists else None
+            if not data or data.get("status", "pending") != "pending":
+                continue
+            pickup = data.get("pickupLocation") or {}
+            if pickup.get("lat") is None or pickup.get("lng") is None:
+                continue
+            deliveries.append((snap.id, data, snap.update_time))
+        if not deliveries:
+            return {"assigned": {}}
+
+        locations = active_view.courier_locations()
+        use_view = locations is not None
+        if not use_view:
+            locations = {d.id: d.to_dict() or {} for d in db.collection("courier_locations").stream()}
+
+        couriers, c_lat, c_lng, load = [], [], [], []
+        for courier_uid, loc in locations.items():
+            if loc.get("lat") is None or loc.get("lng") is None:
+                continue
+            couriers.append(courier_uid)
+            c_lat.append(float(loc["lat"]))
+            c_lng.append(float(loc["lng"]))
+        if couriers and use_view:
+            load = np.array([active_view.courier_load(c) for c in couriers])
+        elif couriers:
+            active = db.collection("deliveries").where(
+                "status", "in", ["accepted", "in_progress"]).stream()
+            counts = {}
+            for doc in active:
+                courier = (doc.to_dict() or {}).get("assignedCourier")
+                counts[courier] = counts.get(courier, 0) + 1
+            load = np.array([counts.get(c, 0) for c in couriers])
+
+        assigned = {}
+        if couriers:
+            p_lat = np.array([float(d["pickupLocation"]["lat"]) for _, d, _ in deliveries])
+            p_lng = np.array([float(d["pickupLocation"]["lng"]) for _, d, _ in deliveries])
+            # rows: deliveries, cols: couriers (courier -> pickup, road km if configured)
+            dist = get_distance_provider().matrix(
+                [{"lat": lat, "lng": lng} for lat, lng in zip(c_lat, c_lng)],
+                [{"lat": lat, "lng": lng} for lat, lng in zip(p_lat, p_lng)],
+            ).T
+            for row, (delivery_id, data, read_time) in enumerate(deliveries):
+                while True:
+                    candidates = np.where(load < 2, dist[row], np.inf)
+                    best = int(np.argmin(candidates))
+                    if not np.isfinite(candidates[best]) or not use_view:
+                        break
+                    # The view lags behind other matchers' commits: confirm the pick from Firestore
+                    load[best] = max(load[best], _active_count(couriers[best]))
+                    if load[best] < 2:
+                        break
+                if not np.isfinite(candidates[best]):
+                    break   # every courier is at capacity
+                best_courier = couriers[best]
+                batch = db.batch()
+                batch.update(
+                    db.collection("deliveries").document(delivery_id),
+                    {
+                        "assignedCourier": best_courier,
+                        "status": "accepted",
+                        "timestampAssigned": firestore.SERVER_TIMESTAMP,
+                        "timestampUpdated": firestore.SERVER_TIMESTAMP,
+                    },
+                    option=db.write_option(last_update_time=read_time),
+                )
+                delivery_stats.record_assigned(batch, db, data, best_courier)
+                try:
+                    batch.commit()
+                except FailedPrecondition:
+                    # Changed since the batch read: the single matcher re-reads it
+                    match_and_assign_courier.delay(delivery_id)
+                    continue
+                _unindex(delivery_id)
+                load[best] += 1
+                assigned[delivery_id] = best_courier
+                _ws_notify(best_courier, {
+                    "event": "delivery_assigned",
+                    "delivery_id": delivery_id,
+                    "courier_id": best_courier,
+                    "status": "accepted",
+                    "created_by": data.get("createdBy"),
+                })
+
+        by_business = {}
+        for delivery_id, data, _ in deliveries:
+            if delivery_id in assigned:
+                by_business.setdefault(data.get("createdBy"), []).append(
+                    {"delivery_id": delivery_id, "assignedCourier": assigned[delivery_id]}
+                )
+        for business, items in by_business.items():
+            _ws_notify(business, {
+                "event": "deliveries_assigned",
+                "status": "accepted",
+                "assignments": items,
+            })
+
+        print(f"[assign] batch: {len(assigned)}/{len(deliveries)} deliveries assigned")
+        return {"assigned": assigned}
+
+    except Exception as e:
+        print(f"[assign] batch error for {delivery_ids}: {e}")
+        return {"error": str(e)}
 """# backend/tasks/delivery_tasks.py
 
 from celery_app import celery
@@ -0,0 +1,77 @@
+# tests/fake_messaging.py
+"""
+Local fake of the firebase_admin.messaging calls PushDispatcher makes.
+
+send_each records every call and answers per message. `errors` maps a
+token to the exception its sends should fail with, or to a list of them
+to fail the first sends and succeed after. The error classes carry the
+names (and base classes) of the firebase_admin ones, which is what the
+dispatcher inspects.
+"""
+from types import SimpleNamespace
+
+
+class ResourceExhaustedError(Exception):
+    pass
+
+
+class QuotaExceededError(ResourceExhaustedError):
+    pass
+
+
+class UnavailableError(Exception):
+    pass
+
+
+class UnregisteredError(Exception):
+    pass
+
+
+class SenderIdMismatchError(Exception):
+    pass
+
+
+class InvalidArgumentError(Exception):
+    pass
+
+
+def invalid_token():
+    return InvalidArgumentError("The registration token is not a valid FCM registration token")
+
+
+class Notification:
+    def __init__(self, title=None, body=None):
+        self.title, self.body = title, body
+
+
+class Message:
+    def __init__(self, notification=None, token=None, data=None):
+        self.notification, self.token, self.data = notification, token, data or {}
+
+
+class FakeMessaging:
+    Message = Message
+    Notification = Notification
+
+    def __init__(self, errors=None):
+        self.errors = dict(errors or {})
+        self.calls = []        # one list of messages per send_each call
+        self.delivered = []    # messages that succeeded
+
+    def send_each(self, messages):
+        if len(messages) > 500:
+            raise InvalidArgumentError("send_each takes at most 500 messages")
+        self.calls.append(list(messages))
+        responses = []
+        for message in messages:
+            error = self.errors.get(message.token)
+            if isinstance(error, list):
+                error = error.pop(0) if error else None
+            if error is None:
+                self.delivered.append(message)
+                responses.append(SimpleNamespace(success=True, message_id=f"m{len(self.delivered)}",
+                                                 exception=None))
+            else:
+                responses.append(SimpleNamespace(success=False, message_id=None, exception=error))
+        return SimpleNamespace(responses=responses, success_count=sum(r.success for r in responses),
+                               failure_count=sum(not r.success for r in responses))
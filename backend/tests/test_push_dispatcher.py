@@ -0,0 +1,106 @@
+# tests/test_push_dispatcher.py
+import pytest
+
+import notifications_utils
+from fake_messaging import (FakeMessaging, InvalidArgumentError, QuotaExceededError,
+                            UnavailableError, UnregisteredError, invalid_token)
+from firestore_standin import MemoryFirestore
+from notifications_utils import DEVICE_TOKENS_FIELD, PushDispatcher
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(notifications_utils, "PUSH_RETRY_SECONDS", 0)
+
+
+def _dispatcher(users, errors=None):
+    db = MemoryFirestore()
+    for uid, tokens in users.items():
+        db.collection("users").document(uid).set({DEVICE_TOKENS_FIELD: tokens})
+    fake = FakeMessaging(errors)
+    return PushDispatcher(messaging_api=fake, db=db), fake, db
+
+
+def _assigned(uid):
+    return (uid, {"event": "delivery_assigned", "deliveryId": "d1"})
+
+
+def _stored_tokens(db, uid):
+    return db.collection("users").document(uid).get().to_dict()[DEVICE_TOKENS_FIELD]
+
+
+def test_batches_split_at_the_send_each_limit():
+    users = {f"u{i}": [f"t{i}a", f"t{i}b", f"t{i}c"] for i in range(200)}
+    dispatcher, fake, _ = _dispatcher(users)
+
+    dispatcher.flush([_assigned(uid) for uid in users])
+
+    assert [len(call) for call in fake.calls] == [500, 100]
+    assert len(fake.delivered) == 600
+    assert dispatcher.counters["sent"] == 600
+    assert dispatcher.counters["batches"] == 2
+    assert fake.delivered[0].notification.title == "New delivery"
+    assert fake.delivered[0].data == {"event": "delivery_assigned", "deliveryId": "d1"}
+
+
+def test_users_without_tokens_are_skipped():
+    dispatcher, fake, _ = _dispatcher({"u1": []})
+
+    dispatcher.flush([_assigned("u1"), _assigned("nobody")])
+
+    assert fake.calls == []
+    assert dispatcher.counters["no_token"] == 2
+
+
+def test_dead_tokens_are_pruned_from_cache_and_profile():
+    dispatcher, fake, db = _dispatcher(
+        {"u1": ["good", "gone", "bad"]},
+        errors={"gone": UnregisteredError("not registered"), "bad": invalid_token()})
+
+    dispatcher.flush([_assigned("u1")])
+
+    assert [m.token for m in fake.delivered] == ["good"]
+    assert _stored_tokens(db, "u1") == ["good"]
+    assert dispatcher.tokens_for(["u1"]) == {"u1": ["good"]}
+    assert dispatcher.counters["pruned"] == 2
+
+    dispatcher.flush([_assigned("u1")])
+    assert [m.token for m in fake.calls[-1]] == ["good"]
+
+
+def test_transient_errors_are_retried_and_not_pruned():
+    dispatcher, fake, db = _dispatcher(
+        {"u1": ["busy", "down"], "u2": ["fine"]},
+        errors={"busy": [QuotaExceededError("quota")], "down": [UnavailableError("503")]})
+
+    dispatcher.flush([_assigned("u1"), _assigned("u2")])
+
+    assert [len(call) for call in fake.calls] == [3, 2]
+    assert sorted(m.token for m in fake.delivered) == ["busy", "down", "fine"]
+    assert dispatcher.counters["retried"] == 2
+    assert dispatcher.counters["failed"] == 0
+    assert _stored_tokens(db, "u1") == ["busy", "down"]
+
+
+def test_retries_stop_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(notifications_utils, "PUSH_MAX_ATTEMPTS", 3)
+    dispatcher, fake, db = _dispatcher(
+        {"u1": ["busy"]}, errors={"busy": QuotaExceededError("quota")})
+
+    dispatcher.flush([_assigned("u1")])
+
+    assert len(fake.calls) == 3
+    assert dispatcher.counters["failed"] == 1
+    assert dispatcher.counters["pruned"] == 0
+    assert _stored_tokens(db, "u1") == ["busy"]
+
+
+def test_payload_errors_do_not_prune():
+    dispatcher, fake, db = _dispatcher(
+        {"u1": ["t1"]}, errors={"t1": InvalidArgumentError("Invalid data payload key")})
+
+    dispatcher.flush([_assigned("u1")])
+
+    assert len(fake.calls) == 1
+    assert dispatcher.counters["failed"] == 1
+    assert _stored_tokens(db, "u1") == ["t1"]
@@ -0,0 +1,115 @@
+# traffic_capture.py
+"""
+Anonymized capture of dispatch traffic, for bench/replay_traffic.py.
+
+With TRAFFIC_CAPTURE_DIR set, each API process appends one JSON array
+per event to TRAFFIC_CAPTURE_DIR/capture-<pid>-<start>.jsonl:
+
+    [t, "loc", courier, lat, lng, accepted]        /updateLocation
+    [t, "new", business, delivery, plat, plng, dlat, dlng, fee]
+                                                   /createDelivery(ies)
+    [t, "status", courier, delivery, status]       /updateDelivery
+
+t is the epoch time in seconds, to the millisecond. `accepted` says
+whether location_filter stored the fix. The first line of every file is a
+header object with the format version.
+
+Nothing identifying is written. uids and delivery ids are replaced by a
+keyed hash (HMAC-SHA256 with TRAFFIC_CAPTURE_KEY, 12 hex characters), so
+the same id maps to the same token in every process and file.
+Coordinates are rounded to TRAFFIC_CAPTURE_DECIMALS (4 is about 11 m).
+Names, addresses, phones and package details are dropped.
+
+Capture stays off without TRAFFIC_CAPTURE_KEY. Each event is a single
+O_APPEND write. When capture is off, a call returns after checking one
+attribute.
+"""
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+TRAFFIC_CAPTURE_DIR = os.environ.get("TRAFFIC_CAPTURE_DIR", "")
+TRAFFIC_CAPTURE_KEY = os.environ.get("TRAFFIC_CAPTURE_KEY", "")
+TRAFFIC_CAPTURE_DECIMALS = int(os.environ.get("TRAFFIC_CAPTURE_DECIMALS", 4))
+# A process stops appending once its file reaches this size
+TRAFFIC_CAPTURE_MAX_BYTES = int(os.environ.get("TRAFFIC_CAPTURE_MAX_BYTES", 1 << 30))
+
+CAPTURE_VERSION = 1
+
+
+class TrafficCapture:
+    def __init__(self, out_dir: str = TRAFFIC_CAPTURE_DIR, key: str = TRAFFIC_CAPTURE_KEY,
+                 decimals: int = TRAFFIC_CAPTURE_DECIMALS):
+        self.enabled = bool(out_dir and key)
+        if out_dir and not key:
+            print("[capture] TRAFFIC_CAPTURE_DIR is set but TRAFFIC_CAPTURE_KEY isn't; capture off")
+        self.out_dir = out_dir
+        self._key = key.encode()
+        self.decimals = decimals
+        self._fd = None
+        self._pid = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"events": 0, "dropped": 0}
+
+    def _anon(self, value) -> str:
+        if not value:
+            return None
+        return hmac.new(self._key, str(value).encode(), hashlib.sha256).hexdigest()[:12]
+
+    def _coord(self, value):
+        return None if value is None else round(float(value), self.decimals)
+
+    def _open(self) -> None:
+        # One file per process: a fork gets its own (gunicorn preloads the app)
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f"capture-{os.getpid()}-{int(time.time())}.jsonl")
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._pid = os.getpid()
+        self._bytes = 0
+        header = {"capture": CAPTURE_VERSION, "decimals": self.decimals, "started": round(time.time(), 3)}
+        self._bytes += os.write(self._fd, (json.dumps(header) + "\n").encode())
+
+    def _write(self, record: list) -> None:
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        try:
+            with self._lock:
+                if self._fd is None or self._pid != os.getpid():
+                    self._open()
+                if self._bytes >= TRAFFIC_CAPTURE_MAX_BYTES:
+                    self.counters["dropped"] += 1
+                    return
+                self._bytes += os.write(self._fd, line)
+                self.counters["events"] += 1
+        except OSError as e:
+            self.counters["dropped"] += 1
+            print(f"[capture] write failed: {e}")
+
+    def location(self, courier_uid: str, lat, lng, accepted: bool) -> None:
+        if not self.enabled:
+            return
+        self._write([round(time.time(), 3), "loc", self._anon(courier_uid),
+                     self._coord(lat), self._coord(lng), bool(accepted)])
+
+    def created(self, business_uid: str, delivery_id: str, pickup: dict, dropoff: dict, fee) -> None:
+        if not self.enabled:
+            return
+        self._write([round(time.time(), 3), "new", self._anon(business_uid), self._anon(delivery_id),
+                     self._coord(pickup.get("lat")), self._coord(pickup.get("lng")),
+                     self._coord(dropoff.get("lat")), self._coord(dropoff.get("lng")),
+                     round(float(fee or 0), 2)])
+
+    def status(self, courier_uid: str, delivery_id: str, status: str) -> None:
+        if not self.enabled:
+            return
+        self._write([round(time.time(), 3), "status", self._anon(courier_uid),
+                     self._anon(delivery_id), status])
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "dir": self.out_dir or None, **self.counters}
+
+
+traffic_capture = TrafficCapture()
@@ -1,30 +1,128 @@
 import asyncio
-import json
+import os
+import queue
+import resource
 import threading
-from typing import Set
+import time
+from typing import Optional, Set
+from urllib.parse import parse_qs, urlsplit
 
+import requests
 import websockets
+from websockets.asyncio.server import ServerConnection, broadcast
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+from encoding import decode_frame, encode_frame, frame_format, select_subprotocol
+from event_log import event_log
+
+# Base URL of the process that holds the sockets (e.g. http://ws-host:5002).
+# When set, this process serves no sockets itself and forwards every send to
+# that process's /internal/ws/* endpoints, the same bridge the Celery worker
+# uses. Needed when several gunicorn workers serve the REST API.
+WS_FORWARD_URL = os.environ.get("WS_FORWARD_URL")
+# Forwarded sends wait here for a background thread, so a slow socket
+# process never holds a request thread; beyond this many they are dropped.
+WS_FORWARD_QUEUE_MAX = int(os.environ.get("WS_FORWARD_QUEUE_MAX", 10_000))
+
+# Keepalive: a socket that doesn't answer a ping within the timeout is dropped
+# (catches clients that vanished without a close, e.g. phones losing signal).
+WS_PING_INTERVAL = float(os.environ.get("WS_PING_INTERVAL", 20))
+WS_PING_TIMEOUT = float(os.environ.get("WS_PING_TIMEOUT", 20))
+# Sockets that haven't registered a uid by then are closed (1008).
+WS_REGISTER_TIMEOUT_SECONDS = float(os.environ.get("WS_REGISTER_TIMEOUT_SECONDS", 15))
+# Close sockets that sent nothing for this long (1001). 0 = never: most
+# clients only listen, and pings already catch dead peers.
+WS_IDLE_TIMEOUT_SECONDS = float(os.environ.get("WS_IDLE_TIMEOUT_SECONDS", 0))
+WS_REAP_INTERVAL_SECONDS = float(os.environ.get("WS_REAP_INTERVAL_SECONDS", 5))
+# Open sockets per process; new ones are refused with 503 beyond it. 0 = no limit.
+WS_MAX_CONNECTIONS = int(os.environ.get("WS_MAX_CONNECTIONS", 0))
+# Clients only send small control frames (register)
+WS_MAX_MESSAGE_BYTES = int(os.environ.get("WS_MAX_MESSAGE_BYTES", 64 * 1024))
+# deflate | none. Clients can also opt out per socket with ?compression=0.
+WS_COMPRESSION = os.environ.get("WS_COMPRESSION", "deflate")
+# Event loop for the standalone server: uvloop when installed, else asyncio
+WS_LOOP = os.environ.get("WS_LOOP", "uvloop")
+WS_BACKLOG = int(os.environ.get("WS_BACKLOG", 4096))
+
+# permessage-deflate keeps a zlib compressor and decompressor per socket.
+# With these settings an idle socket costs ~48 KiB of RSS, against ~53 KiB
+# with the library defaults, ~110 KiB with zlib's and ~17 KiB with no
+# compression (bench/bench_ws_connections.py); our frames are short, so the
+# smaller window costs little ratio.
+_DEFLATE_WINDOW_BITS = 11
+_DEFLATE_MEM_LEVEL = 4
+
+
+def _new_loop() -> asyncio.AbstractEventLoop:
+    if WS_LOOP == "uvloop":
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            pass
+    return asyncio.new_event_loop()
+
+
+def raise_fd_limit() -> int:
+    """Raise the open-files soft limit to the hard limit; returns the new soft limit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError) as e:
+            print(f"[WS] could not raise open-files limit from {soft}: {e}")
+    return soft
+
+
+def rss_bytes() -> int:
+    """Resident memory of this process (0 where /proc isn't available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
 
 
 class WebSocketManager:
-    def __init__(self, host: str = "0.0.0.0", port: int = 6789):
+    def __init__(self, host: str = "0.0.0.0", port: int = 6789,
+                 forward_url: Optional[str] = WS_FORWARD_URL):
         self.host = host
         self.port = port
+        self.forward_url = forward_url.rstrip("/") if forward_url else None
         # Create a new event loop for the WebSocket server
-        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self.loop: asyncio.AbstractEventLoop = _new_loop()
         # Keep track of connected WebSocket clients
         self.connected_clients: Set[websockets.WebSocketServerProtocol] = set()
         self.clients_by_user: dict[str, set[websockets.WebSocketServerProtocol]] = {}
+        # socket -> [connected_at, last_message_at, uids registered on it]
+        self._meta: dict = {}
+        self._reaper: Optional[asyncio.Task] = None
+        self._baseline_rss = 0
+        self._send_tasks: Set[asyncio.Task] = set()
+        # Called as fn(uid, message) for every send_to_user, connected or not
+        self._listeners: list = []
+        # Per-user seq numbers for replay on reconnect (see event_log.py)
+        self.event_log = event_log
+        self._forward_queue: "queue.Queue[tuple]" = queue.Queue(maxsize=WS_FORWARD_QUEUE_MAX)
+        self._forwarder: Optional[threading.Thread] = None
+        self._forwarder_lock = threading.Lock()
+        self.counters = {"replayed": 0, "resyncs": 0, "rejected": 0,
+                         "reaped_unregistered": 0, "reaped_idle": 0,
+                         "forwarded": 0, "forward_failed": 0, "forward_dropped": 0}
 
     async def handler(self, websocket: websockets.WebSocketServerProtocol) -> None:
         # Register client
         self.connected_clients.add(websocket)
+        now = time.monotonic()
+        meta = self._meta[websocket] = [now, now, set()]
         try:
             async for raw_message in websocket:
+                meta[1] = time.monotonic()
                 try:
-                    data = json.loads(raw_message)
+                    data = decode_frame(raw_message)
                 except Exception:
-                    # Skip non‑JSON messages
+                    # Skip undecodable messages
                     continue
                 if isinstance(data, dict):
                     msg_type = data.get("type")
@@ -33,6 +131,9 @@ class WebSocketManager:
                         if isinstance(uid, str) and uid:
                             # Add this websocket to the set for the uid
                             self.clients_by_user.setdefault(uid, set()).add(websocket)
+                            meta[2].add(uid)
+                            if "last_seq" in data:
+                                await self._replay(websocket, uid, data["last_seq"])
                         continue
                 continue
         except websockets.ConnectionClosed:
@@ -41,15 +142,106 @@ class WebSocketManager:
         finally:
             # Remove the client from the active set
             self.connected_clients.discard(websocket)
-            for uid, ws_set in list(self.clients_by_user.items()):
-                if websocket in ws_set:
+            self._meta.pop(websocket, None)
+            # Only the uids this socket registered, not a scan of every user
+            for uid in meta[2]:
+                ws_set = self.clients_by_user.get(uid)
+                if ws_set is not None:
                     ws_set.discard(websocket)
                     if not ws_set:
                         del self.clients_by_user[uid]
 
+    def at_capacity(self) -> bool:
+        return 0 < WS_MAX_CONNECTIONS <= len(self.connected_clients)
+
+    def _process_request(self, connection, request):
+        """Refuse sockets over the limit; honour ?compression=0 before negotiation."""
+        if self.at_capacity():
+            self.counters["rejected"] += 1
+            return connection.respond(503, "Too many connections\n")
+        query = parse_qs(urlsplit(request.path).query)
+        if query.get("compression", [""])[0] in ("0", "false", "none"):
+            # No offer from the client means no permessage-deflate state for this socket
+            del request.headers["Sec-WebSocket-Extensions"]
+        return None
+
+    async def _reap(self) -> None:
+        """Close sockets that never registered, and idle ones if WS_IDLE_TIMEOUT_SECONDS is set."""
+        while True:
+            await asyncio.sleep(WS_REAP_INTERVAL_SECONDS)
+            now = time.monotonic()
+            for websocket, (connected_at, last_seen, uids) in list(self._meta.items()):
+                if not uids and now - connected_at > WS_REGISTER_TIMEOUT_SECONDS:
+                    reason, code = "reaped_unregistered", (1008, "register timeout")
+                elif WS_IDLE_TIMEOUT_SECONDS and now - last_seen > WS_IDLE_TIMEOUT_SECONDS:
+                    reason, code = "reaped_idle", (1001, "idle")
+                else:
+                    continue
+                self.counters[reason] += 1
+                # Out of the table now so the next pass doesn't close it again;
+                # the handler's finally still cleans up the rest
+                self._meta.pop(websocket, None)
+                self._submit(websocket.close(*code))
+
+    def _start_reaper(self) -> None:
+        self._baseline_rss = rss_bytes()
+        if self._reaper is None:
+            self._reaper = self.loop.create_task(self._reap())
+
+    def _read_backlog(self, uid: str, last_seq: int):
+        return self.event_log.since(uid, last_seq), self.event_log.position(uid)
+
+    async def _replay(self, websocket, uid: str, last_seq) -> None:
+        """
+        Catch a reconnecting client up: the events after `last_seq`, then
+        {"type": "registered", "seq": N}. If they can't all be replayed it
+        gets {"type": "resync_required", "seq": N} and refetches instead.
+        Registration happens first, so an event may arrive both live and
+        replayed; clients skip any seq they already applied.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            # Redis round trips; off the event loop so other sockets keep flowing
+            missed, position = await loop.run_in_executor(None, self._read_backlog, uid, int(last_seq))
+        except Exception as e:
+            print(f"[WS] replay failed for uid={uid}: {e}")
+            missed, position = None, None
+        if missed is None:
+            self.counters["resyncs"] += 1
+            await self.send_to(websocket, {"type": "resync_required", "seq": position})
+            return
+        self.counters["replayed"] += len(missed)
+        for message in missed:
+            await self.send_to(websocket, message)
+        await self.send_to(websocket, {"type": "registered", "seq": position})
+
     async def _run_server(self) -> None:
         """runs the WebSocket server forever."""
-        async with websockets.serve(self.handler, self.host, self.port):
+        self._start_reaper()
+        extensions = None
+        if WS_COMPRESSION == "deflate":
+            extensions = [ServerPerMessageDeflateFactory(
+                server_max_window_bits=_DEFLATE_WINDOW_BITS,
+                client_max_window_bits=_DEFLATE_WINDOW_BITS,
+                compress_settings={"memLevel": _DEFLATE_MEM_LEVEL},
+            )]
+        # Clients pick JSON text or MessagePack binary frames by subprotocol;
+        # clients that offer none still connect and get JSON
+        async with websockets.serve(
+            self.handler, self.host, self.port,
+            select_subprotocol=lambda conn, offered: select_subprotocol(offered),
+            process_request=self._process_request,
+            compression=None,
+            extensions=extensions,
+            ping_interval=WS_PING_INTERVAL or None,
+            ping_timeout=WS_PING_TIMEOUT or None,
+            max_size=WS_MAX_MESSAGE_BYTES,
+            # Small per-socket buffers: clients barely send, and a slow reader
+            # should back up into its own socket rather than our memory
+            max_queue=4,
+            write_limit=16 * 1024,
+            backlog=WS_BACKLOG,
+        ):
             # Keep the server running indefinitely
             await asyncio.Future()
 
@@ -62,37 +254,150 @@ class WebSocketManager:
         if hasattr(self, "_thread"):
             # Already started
             return
+        raise_fd_limit()
         self._thread = threading.Thread(target=self._start_loop, daemon=True)
         self._thread.start()
+
+    def attach(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Serve sockets from an existing event loop instead of our own thread
+        (ASGI mode: sockets are accepted by the ASGI app, see asgi.py).
+        Must be called from that loop.
+        """
+        self.loop = loop
+        self._start_reaper()
+
+    def _submit(self, coro) -> None:
+        """Schedule a send on the manager's loop from any thread."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            # Keep a reference so the task isn't garbage-collected mid-send
+            task = self.loop.create_task(coro)
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+        else:
+            asyncio.run_coroutine_threadsafe(coro, self.loop)
     
     async def send_to(self,websocket, payload):
-        if not isinstance(payload, str):
-            payload = json.dumps(payload)
+        if not isinstance(payload, (str, bytes)):
+            payload = encode_frame(payload, frame_format(websocket))
         await websocket.send(payload)
+
+    def _send_all(self, sockets, message: dict) -> None:
+        # Encode once per frame format, not once per socket
+        by_format = {}
+        for ws in sockets:
+            by_format.setdefault(frame_format(ws), []).append(ws)
+        frames = {fmt: encode_frame(message, fmt) for fmt in by_format}
+        # One hop onto the loop per message, however many sockets get it
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._fan_out(by_format, frames)
+        else:
+            self.loop.call_soon_threadsafe(self._fan_out, by_format, frames)
+
+    def _fan_out(self, by_format: dict, frames: dict) -> None:
+        """Write a frame to many sockets (on the loop)."""
+        for fmt, sockets in by_format.items():
+            native = [ws for ws in sockets if isinstance(ws, ServerConnection)]
+            if native:
+                # Writes straight into each connection's buffer: no task or
+                # coroutine per socket, and closed sockets are skipped
+                broadcast(native, frames[fmt])
+            for ws in sockets:
+                if not isinstance(ws, ServerConnection):
+                    try:
+                        self._submit(ws.send(frames[fmt]))
+                    except Exception:
+                        # ignore broken sockets; they will be removed on disconnect
+                        pass
+
+    def _forward(self, path: str, body: dict) -> None:
+        """Queue a send for the socket process; returns at once."""
+        try:
+            self._forward_queue.put_nowait((path, body))
+        except queue.Full:
+            self.counters["forward_dropped"] += 1
+            return
+        if self._forwarder is None or not self._forwarder.is_alive():
+            with self._forwarder_lock:
+                # After a fork the parent's thread object is there but not running
+                if self._forwarder is None or not self._forwarder.is_alive():
+                    self._forwarder = threading.Thread(target=self._run_forwarder,
+                                                       name="ws-forward", daemon=True)
+                    self._forwarder.start()
+
+    def _run_forwarder(self) -> None:
+        # One thread and one keep-alive session keep the sends in order
+        session = requests.Session()
+        while True:
+            path, body = self._forward_queue.get()
+            try:
+                session.post(self.forward_url + path, json=body, timeout=3.0).raise_for_status()
+                self.counters["forwarded"] += 1
+            except Exception as e:
+                self.counters["forward_failed"] += 1
+                print(f"[WS forward] {path} failed: {e}")
+
     def broadcast(self, message: dict) -> None:
+        if self.forward_url:
+            self._forward("/internal/ws/broadcast", {"message": message})
+            return
         if not self.connected_clients:
             return
-        data = json.dumps(message)
-        for ws in list(self.connected_clients):
-            try:
-                asyncio.run_coroutine_threadsafe(ws.send(data), self.loop)
-            except Exception:
-                # ignore broken sockets; they will be removed on disconnect
-                pass
+        self._send_all(list(self.connected_clients), message)
+
+    def is_connected(self, uid: str) -> bool:
+        """Whether the user has at least one registered socket in this process."""
+        return bool(self.clients_by_user.get(uid))
+
+    def add_listener(self, fn) -> None:
+        """Observe every per-user event (long-polling, push fallback, ...)."""
+        self._listeners.append(fn)
 
     def send_to_user(self, uid: str, message: dict) -> None:
         if not uid:
             return
+        if self.forward_url:
+            self._forward("/internal/ws/notify", {"uid": uid, "message": message})
+            return
+        try:
+            message = self.event_log.append(uid, message)
+        except Exception as e:
+            # Still delivered live, just without a seq (so not replayable)
+            print(f"[WS] event log append failed for uid={uid}: {e}")
+        for listener in self._listeners:
+            try:
+                listener(uid, message)
+            except Exception as e:
+                print(f"[WS] listener failed for uid={uid}: {e}")
         ws_set = self.clients_by_user.get(uid)
         if not ws_set:
             return
-        data = json.dumps(message)
-        for ws in list(ws_set):
-            try:
-                asyncio.run_coroutine_threadsafe(ws.send(data), self.loop)
-            except Exception:
-               print('there is an error in send to user')
-               
+        self._send_all(list(ws_set), message)
+
+    def stats(self) -> dict:
+        connections = len(self.connected_clients)
+        rss = rss_bytes()
+        return {
+            "connections": connections,
+            "users": len(self.clients_by_user),
+            "unregistered": sum(1 for m in list(self._meta.values()) if not m[2]),
+            "rss_bytes": rss,
+            # Growth since the server started, spread over the open sockets
+            "bytes_per_connection": (
+                int((rss - self._baseline_rss) / connections) if connections and self._baseline_rss else None),
+            "send_tasks": len(self._send_tasks),
+            "forward_pending": self._forward_queue.qsize() if self.forward_url else None,
+            "max_connections": WS_MAX_CONNECTIONS or None,
+            **self.counters,
+        }
 
 
 # Create a global manager instance and start the server.